@@ -0,0 +1,178 @@
+"""Throughput benchmark of the offline worker on top of the local harness.
+
+    python benchmark.py --requests 20000 --users 1000 --fetch-latency-ms 50
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import time
+from typing import Any, Callable
+
+import harness
+import js
+
+
+def _percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def _format_latencies(latencies: list[float]) -> str:
+    return (
+        f"mean {statistics.fmean(latencies) * 1e6:.0f}us, "
+        f"p50 {_percentile(latencies, 0.5) * 1e6:.0f}us, "
+        f"p99 {_percentile(latencies, 0.99) * 1e6:.0f}us"
+    )
+
+
+def _make_updates(args: argparse.Namespace) -> list[dict[str, Any]]:
+    rng = random.Random(args.seed)
+    updates = []
+    for _ in range(args.requests):
+        user_id = rng.randrange(args.users) + 1
+        if rng.random() < args.callback_fraction:
+            updates.append(harness.callback_query_update(user_id))
+        else:
+            updates.append(harness.message_update(user_id))
+    return updates
+
+
+async def _run_requests(
+    handler: Callable,
+    env: Any,
+    updates: list[dict[str, Any]],
+) -> tuple[float, list[float]]:
+    ctx = harness.ExecutionContext()
+    latencies = []
+    start_time = time.perf_counter()
+    for update in updates:
+        request = harness.webhook_request(env, update)
+        request_start = time.perf_counter()
+        await handler(request, env, ctx)
+        latencies.append(time.perf_counter() - request_start)
+    await ctx.wait_for_background_tasks()
+    return time.perf_counter() - start_time, latencies
+
+
+def _time_per_call(fn: Callable[[], Any], n: int) -> float:
+    start_time = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start_time) / n
+
+
+async def _time_per_async_call(fn: Callable[[], Any], n: int) -> float:
+    start_time = time.perf_counter()
+    for _ in range(n):
+        await fn()
+    return (time.perf_counter() - start_time) / n
+
+
+async def _benchmark(args: argparse.Namespace) -> None:
+    if args.import_runs:
+        import_times = harness.measure_import_time(args.import_runs)
+        print(
+            f"Cold module load over {args.import_runs} runs: "
+            f"min {min(import_times) * 1000:.2f}ms, "
+            f"median {statistics.median(import_times) * 1000:.2f}ms"
+        )
+
+    worker = harness.load_worker(reload=True)
+    telegram = worker.telegram
+    js.fetch_latency_seconds = args.fetch_latency_ms / 1000
+
+    updates = _make_updates(args)
+
+    env = harness.make_env(kv_latency_seconds=args.kv_latency_ms / 1000)
+    js.fetch_calls.clear()
+    elapsed, latencies = await _run_requests(worker.on_fetch, env, updates)
+    print(f"on_fetch: {len(updates)} requests in {elapsed:.2f}s")
+    print(f"  throughput: {len(updates) / elapsed:.0f} req/s")
+    print(f"  latency: {_format_latencies(latencies)}")
+    print(
+        f"  KV puts: {env.TELEGRAM_USERS.n_puts}, "
+        f"skipped as already written: {telegram._user_id_writer.n_skipped}"
+    )
+    print(f"  outbound fetches: {len(js.fetch_calls)}")
+
+    # Start from a cold isolate again, so that no user ids are cached
+    worker = harness.load_worker(reload=True)
+    env = harness.make_env(kv_latency_seconds=args.kv_latency_ms / 1000)
+    elapsed, handle_method_latencies = await _run_requests(
+        worker.handle_method, env, updates
+    )
+    on_fetch_overhead = statistics.fmean(latencies) - statistics.fmean(
+        handle_method_latencies
+    )
+    print(f"handle_method: {len(updates) / elapsed:.0f} req/s")
+    print(
+        "  on_fetch overhead: "
+        f"{on_fetch_overhead * 1e6:.1f}us/req"
+    )
+
+    for sample_rate in args.log_sample_rates:
+        worker = harness.load_worker(reload=True)
+        env = harness.make_env(
+            kv_latency_seconds=args.kv_latency_ms / 1000,
+            LOG_SAMPLE_RATE=str(sample_rate),
+        )
+        _, sampled_latencies = await _run_requests(worker.on_fetch, env, updates)
+        print(
+            f"LOG_SAMPLE_RATE={sample_rate}: "
+            f"mean {statistics.fmean(sampled_latencies) * 1e6:.1f}us/req"
+        )
+
+    n = args.micro_iterations
+    body = js.JSON.stringify(updates[0])
+    response = telegram._offline_reply(1)
+    parse_update = _time_per_call(lambda: json.loads(body), n)
+    offline_reply = _time_per_call(lambda: telegram._offline_reply(1), n)
+    clone_text = await _time_per_async_call(lambda: response.clone().text(), n)
+    print("Per-call costs:")
+    print(f"  parsing the update: {parse_update * 1e6:.1f}us")
+    print(f"  building the reply: {offline_reply * 1e6:.1f}us")
+    print(f"  response.clone().text(): {clone_text * 1e6:.1f}us")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--callback-fraction", type=float, default=0.5)
+    parser.add_argument("--fetch-latency-ms", type=float, default=0.0)
+    parser.add_argument("--kv-latency-ms", type=float, default=0.0)
+    parser.add_argument("--micro-iterations", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--log-sample-rates",
+        type=lambda x: [float(rate) for rate in x.split(",")],
+        default=[0.0, 0.01, 1.0],
+        help="Comma-separated LOG_SAMPLE_RATE values to compare",
+    )
+    parser.add_argument(
+        "--import-runs",
+        type=int,
+        default=10,
+        help="Fresh interpreters to measure module load time in, 0 to skip",
+    )
+    parser.add_argument(
+        "--show-worker-logs",
+        action="store_true",
+        help="Print worker logs instead of formatting them into /dev/null",
+    )
+    args = parser.parse_args()
+
+    # Logs are still formatted, as in the isolate, but not printed.
+    if not args.show_worker_logs:
+        logging.basicConfig(stream=open(os.devnull, "w"), level=logging.INFO)
+
+    asyncio.run(_benchmark(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""Runs the offline worker locally with in-memory stand-ins for Cloudflare.
+
+    import asyncio
+    import harness
+
+    worker = harness.load_worker()
+    env = harness.make_env()
+    ctx = harness.ExecutionContext()
+    request = harness.webhook_request(env, harness.message_update(42))
+    response = asyncio.run(worker.on_fetch(request, env, ctx))
+"""
+
+import asyncio
+import glob
+import importlib
+import itertools
+import json
+import os
+import subprocess
+import sys
+import types
+from typing import Any
+
+_LOCAL_DIR = os.path.dirname(os.path.abspath(__file__))
+_WORKER_DIR = os.path.dirname(_LOCAL_DIR)
+_SRC_DIR = os.path.join(_WORKER_DIR, "src")
+_DEV_VARS_PATH = os.path.join(_WORKER_DIR, ".dev.vars")
+
+_WORKER_URL = "https://check-sid-bot-offline.example.workers.dev"
+_WORKER_MODULES = ("entry", "telegram", "messages", "sid_index", "structured_log")
+
+for path in (_LOCAL_DIR, _SRC_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import js  # noqa: E402
+
+
+class InMemoryKV:
+    def __init__(self, latency_seconds: float = 0.0):
+        self.data: dict[str, str] = {}
+        self.latency_seconds = latency_seconds
+        self.n_puts = 0
+        self.n_gets = 0
+
+    async def _sleep(self) -> None:
+        if self.latency_seconds:
+            await asyncio.sleep(self.latency_seconds)
+
+    async def put(self, key: Any, value: Any) -> None:
+        await self._sleep()
+        self.n_puts += 1
+        # KV stores strings, the JS runtime coerces everything else.
+        self.data[str(key)] = "true" if value is True else str(value)
+
+    async def get(self, key: Any) -> str | None:
+        await self._sleep()
+        self.n_gets += 1
+        return self.data.get(str(key))
+
+    async def list(
+        self,
+        prefix: str = "",
+        limit: int = 1000,
+        cursor: str | None = None,
+    ) -> js.JsProxy:
+        await self._sleep()
+        names = sorted(x for x in self.data if x.startswith(prefix))
+        start = int(cursor) if cursor else 0
+        page = names[start : start + limit]
+        list_complete = start + limit >= len(names)
+        return js.JsProxy(
+            {
+                "keys": [{"name": x} for x in page],
+                "list_complete": list_complete,
+                "cursor": None if list_complete else str(start + limit),
+            }
+        )
+
+
+class ExecutionContext:
+    def __init__(self):
+        self._pending: list[asyncio.Future] = []
+
+    def waitUntil(self, awaitable: Any) -> None:
+        self._pending.append(asyncio.ensure_future(awaitable))
+
+    async def wait_for_background_tasks(self) -> None:
+        # The isolate keeps running waitUntil() tasks after the response is
+        # returned. Errors in them are only logged, never sent to the client.
+        while self._pending:
+            pending, self._pending = self._pending, []
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+def _read_dev_vars() -> dict[str, str]:
+    if not os.path.exists(_DEV_VARS_PATH):
+        return {}
+    result = {}
+    with open(_DEV_VARS_PATH) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            key, _, value = line.partition("=")
+            result[key.strip()] = value.strip()
+    return result
+
+
+def make_env(kv_latency_seconds: float = 0.0, **overrides: Any) -> types.SimpleNamespace:
+    values: dict[str, Any] = dict(_read_dev_vars())
+    values["TELEGRAM_USERS"] = InMemoryKV(latency_seconds=kv_latency_seconds)
+    values["SID_INDEX"] = InMemoryKV(latency_seconds=kv_latency_seconds)
+    values.update(overrides)
+    return types.SimpleNamespace(**values)
+
+
+def load_sid_index(env: types.SimpleNamespace, index_dir: str) -> None:
+    # Loads the output of tools/build_sid_index.py
+    for path in sorted(glob.glob(os.path.join(index_dir, "*.json"))):
+        with open(path) as f:
+            for pair in json.load(f):
+                env.SID_INDEX.data[pair["key"]] = pair["value"]
+
+
+def load_worker(reload: bool = False) -> types.ModuleType:
+    if reload:
+        for name in _WORKER_MODULES:
+            sys.modules.pop(name, None)
+    return importlib.import_module("entry")
+
+
+_IMPORT_TIME_SCRIPT = """
+import sys
+import time
+
+sys.path[:0] = [{local_dir!r}, {src_dir!r}]
+# The Workers runtime has these loaded before the worker module is imported.
+import asyncio
+import js
+
+start_time = time.perf_counter()
+import entry
+print(time.perf_counter() - start_time)
+"""
+
+
+def measure_import_time(n_runs: int = 10) -> list[float]:
+    # Every run is a fresh interpreter, like a cold isolate. Standard library
+    # modules that only the worker imports are counted too.
+    script = _IMPORT_TIME_SCRIPT.format(local_dir=_LOCAL_DIR, src_dir=_SRC_DIR)
+    timings = []
+    for _ in range(n_runs):
+        output = subprocess.run(
+            [sys.executable, "-S", "-c", script],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        timings.append(float(output))
+    return timings
+
+
+_update_ids = itertools.count(1)
+
+
+def message_update(user_id: int, text: str = "/start") -> dict[str, Any]:
+    update_id = next(_update_ids)
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+            "chat": {"id": user_id, "type": "private"},
+            "date": 1710000000,
+            "text": text,
+        },
+    }
+
+
+def callback_query_update(user_id: int, data: str = "info") -> dict[str, Any]:
+    update_id = next(_update_ids)
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+            "message": {
+                "message_id": update_id,
+                "chat": {"id": user_id, "type": "private"},
+                "date": 1710000000,
+            },
+            "chat_instance": "1",
+            "data": data,
+        },
+    }
+
+
+def webhook_request(env: types.SimpleNamespace, update: dict[str, Any]) -> js.Request:
+    return js.Request(
+        f"{_WORKER_URL}/webhook",
+        body=update,
+        headers={"X-Telegram-Bot-Api-Secret-Token": env.WEBHOOK_SECRET},
+    )
+
+
+def admin_request(env: types.SimpleNamespace, path: str) -> js.Request:
+    return js.Request(
+        f"{_WORKER_URL}{path}?token={env.WEBHOOK_ACCESS_TOKEN}",
+        method="GET",
+    )
+
+
+def main() -> None:
+    worker = load_worker()
+    env = make_env()
+    ctx = ExecutionContext()
+
+    async def run() -> None:
+        for request in (
+            admin_request(env, "/register_webhook"),
+            webhook_request(env, message_update(1)),
+            webhook_request(env, callback_query_update(1)),
+        ):
+            response = await worker.on_fetch(request, env, ctx)
+            print(request.url, response.status, await response.text())
+        await ctx.wait_for_background_tasks()
+        print("KV contents:", env.TELEGRAM_USERS.data)
+        print("Outbound fetches:", js.fetch_calls)
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
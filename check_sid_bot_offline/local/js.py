@@ -0,0 +1,165 @@
+"""Local stand-in for the `js` module of Cloudflare Python Workers.
+
+Only the parts used by the worker are implemented: `Response`, `fetch` and
+`JSON`. JS values are wrapped in `JsProxy` so that code which forgets to
+convert them to Python fails locally the same way it fails in the isolate.
+"""
+
+import asyncio
+import json
+from typing import Any, Callable
+
+
+class JsProxy:
+    def __init__(self, value: Any):
+        self._value = value
+
+    def to_py(self) -> Any:
+        return self._value
+
+    def __getattr__(self, name: str) -> Any:
+        if isinstance(self._value, dict) and name in self._value:
+            return _to_js(self._value[name])
+        raise AttributeError(name)
+
+    def __repr__(self) -> str:
+        return "[object Object]"
+
+
+def _to_js(value: Any) -> Any:
+    if isinstance(value, (dict, list)):
+        return JsProxy(value)
+    return value
+
+
+def _to_py(value: Any) -> Any:
+    if isinstance(value, JsProxy):
+        return value.to_py()
+    return value
+
+
+class JSON:
+    @staticmethod
+    def stringify(value: Any) -> str:
+        return json.dumps(_to_py(value), ensure_ascii=False, separators=(",", ":"))
+
+    @staticmethod
+    def parse(value: str) -> Any:
+        return _to_js(json.loads(value))
+
+
+class Headers:
+    def __init__(self, headers: Any = None):
+        if isinstance(headers, Headers):
+            headers = headers.items()
+        elif isinstance(headers, dict):
+            headers = headers.items()
+        self._headers = {k.lower(): v for k, v in (headers or [])}
+
+    @classmethod
+    def new(cls, headers: Any = None) -> "Headers":
+        return cls(headers)
+
+    def get(self, name: str) -> str | None:
+        return self._headers.get(name.lower())
+
+    def items(self):
+        return self._headers.items()
+
+    def __repr__(self) -> str:
+        return "[object Headers]"
+
+
+_STATUS_TEXT = {
+    200: "OK",
+    403: "Forbidden",
+    404: "Not Found",
+    500: "Internal Server Error",
+}
+
+
+class _JsonMethod:
+    # `Response.json(value)` builds a response, `response.json()` parses one.
+    def __get__(self, instance, owner):
+        if instance is None:
+            return owner._from_json
+        return instance._parse_json
+
+
+class Response:
+    json = _JsonMethod()
+
+    def __init__(self, body: str, status: int, headers: Headers):
+        self._body = body
+        self.status = status
+        self.statusText = _STATUS_TEXT.get(status, "")
+        self.ok = 200 <= status < 300
+        self.headers = headers
+
+    @classmethod
+    def new(
+        cls,
+        body: str | None = None,
+        status: int = 200,
+        headers: Any = None,
+    ) -> "Response":
+        return cls("" if body is None else str(body), status, Headers(headers))
+
+    @classmethod
+    def _from_json(cls, value: Any, status: int = 200) -> "Response":
+        return cls(
+            JSON.stringify(value),
+            status,
+            Headers({"content-type": "application/json"}),
+        )
+
+    def clone(self) -> "Response":
+        return Response(self._body, self.status, self.headers)
+
+    async def text(self) -> str:
+        return self._body
+
+    async def _parse_json(self) -> Any:
+        return JSON.parse(self._body)
+
+    def __repr__(self) -> str:
+        return "[object Response]"
+
+
+class Request:
+    def __init__(
+        self,
+        url: str,
+        body: Any = None,
+        headers: dict[str, str] | None = None,
+        method: str = "POST",
+    ):
+        self.url = url
+        self.method = method
+        self.headers = Headers(headers)
+        self._body = "" if body is None else JSON.stringify(body)
+
+    async def json(self) -> Any:
+        return JSON.parse(self._body)
+
+    async def text(self) -> str:
+        return self._body
+
+
+def _default_fetch_handler(url: str) -> Response:
+    del url
+    return Response.json({"ok": True, "result": True})
+
+
+# Tests and benchmarks replace these to control outbound requests.
+fetch_handler: Callable[[str], Response] = _default_fetch_handler
+fetch_latency_seconds = 0.0
+fetch_calls: list[str] = []
+
+
+async def fetch(url: str, *args, **kwargs) -> Response:
+    del args, kwargs
+    fetch_calls.append(url)
+    if fetch_latency_seconds:
+        await asyncio.sleep(fetch_latency_seconds)
+    return fetch_handler(url)
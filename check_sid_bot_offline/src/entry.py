@@ -1,10 +1,9 @@
-import enum
-import urllib.parse
 import logging
 import sys
 
 from js import Response
 
+import structured_log
 import telegram
 
 logger = logging.getLogger(__name__)
@@ -12,88 +11,66 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 
 
-def check_webhook_access_token(request, env):
-    parsed_url = urllib.parse.urlparse(request.url)
-    url_params = urllib.parse.parse_qs(parsed_url.query)
+def _url_path(url: str) -> str:
+    # Same as urllib.parse.urlparse(url).path, without importing urllib.parse
+    # on every cold start.
+    path_start = url.find("/", url.find("://") + 3)
+    if path_start == -1:
+        return "/"
+    path = url[path_start:]
+    for separator in "?#":
+        path = path.split(separator, 1)[0]
+    return path
 
-    token = url_params.get("token", [None])[0]
-    logging.info(f"Got token: {token}")
-    if token == env.WEBHOOK_ACCESS_TOKEN:
-        return
 
-    logging.warning(f"Got invlaid access at request URL: {request.url}")
-    return Response.new("Got invalid access token", status=403)
+async def on_register_webhook(request, env, ctx):
+    del ctx
+    import webhook_admin
 
+    return await webhook_admin.on_register_webhook(request, env)
 
-class Method(enum.Enum):
-    INDEX = "/"
-    REGISTER_WEBHOOK = "/register_webhook"
-    UNREGISTER_WEBHOOK = "/unregister_webhook"
-    WEBHOOK = "/webhook"
 
+async def on_unregister_webhook(request, env, ctx):
+    del ctx
+    import webhook_admin
 
-def _get_telegram(request, env) -> telegram.Telegram:
-    request_url = request.url
-    parsed_url = urllib.parse.urlparse(request_url)
-    return telegram.Telegram(
-        token=env.TELEGRAM_BOT_TOKEN,
-        webhook_secret=env.WEBHOOK_SECRET,
-        webhook_url=parsed_url.scheme
-        + "://"
-        + parsed_url.netloc
-        + Method.WEBHOOK.value,
-    )
-
-
-async def on_register_webhook(request, env):
-    logger.info("Registering webhook")
-    if response := check_webhook_access_token(request, env):
-        return response
-
-    telegram = _get_telegram(request, env)
-    response = await telegram.register_webhook()
-    logger.info(f"Webhook registered, response: {response}")
-    return Response.new(f"Webhook registered, response: {response}")
+    return await webhook_admin.on_unregister_webhook(request, env)
 
 
-async def on_unregister_webhook(request, env):
-    print("Unregistering webhook")
-    if response := check_webhook_access_token(request, env):
-        return response
-    telegram = _get_telegram(request, env)
-    response = await telegram.unregister_webhook()
-    logger.info(f"Webhook unregistered, response: {response}")
-    return Response.new("Webhook unregistered")
-
-
-async def on_webhook(request, env):
-    logging.info("Webhook received")
-    return await _get_telegram(request, env).handle_request(request, env)
+async def on_webhook(request, env, ctx):
+    return await telegram.Telegram(
+        token=env.TELEGRAM_BOT_TOKEN,
+        webhook_secret=env.WEBHOOK_SECRET,
+    ).handle_request(request, env, ctx)
 
 
-async def on_index(request, env):
+async def on_index(request, env, ctx):
     del request
     del env
+    del ctx
     return Response.new("Nothing to see here")
 
 
 _METHOD_TO_HANDLER = {
-    Method.INDEX: on_index,
-    Method.REGISTER_WEBHOOK: on_register_webhook,
-    Method.UNREGISTER_WEBHOOK: on_unregister_webhook,
-    Method.WEBHOOK: on_webhook,
+    "/": on_index,
+    "/register_webhook": on_register_webhook,
+    "/unregister_webhook": on_unregister_webhook,
+    "/webhook": on_webhook,
 }
 
 
-async def handle_method(request, env) -> Response:
-    url = request.url
-    method_str = urllib.parse.urlparse(url).path
-    method = Method(method_str)
-    return await _METHOD_TO_HANDLER[method](request, env)
+async def handle_method(request, env, ctx) -> Response:
+    method_str = _url_path(request.url)
+    if method_str not in _METHOD_TO_HANDLER:
+        raise ValueError(f"Unknown method: {method_str}")
+    return await _METHOD_TO_HANDLER[method_str](request, env, ctx)
 
 
-async def on_fetch(request, env):
-    logging.info(f"Got request: {request.url}")
-    response = await handle_method(request, env)
-    logging.info(f"Returning response: {await response.clone().text()}")
+async def on_fetch(request, env, ctx):
+    structured_log.start_request(env)
+    # Only the path: the query string of admin requests has the access token.
+    path = _url_path(request.url)
+    structured_log.event("request", path=path)
+    response = await handle_method(request, env, ctx)
+    structured_log.event("response", path=path, status=response.status)
     return response
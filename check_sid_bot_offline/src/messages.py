@@ -6,3 +6,15 @@ BOT_OFFLINE_MESSAGE = """
 
 Во время голосований бот проверит, что ваш голос учтён. А после завершения голосования бот скажет, за кого учёлся голос.
 """.strip()
+
+SID_FOUND_FOOTER = """
+Что-то не так? Напишите @PeterZhizhin.
+
+Пришлите ещё один адрес транзакции, чтобы проверить его.
+""".strip()
+
+SID_NOT_FOUND_MESSAGE = """
+Этот адрес транзакции не найден в базе данных Московского голосования.
+
+Проверьте, что адрес введён без ошибок. Если ошибки нет, напишите @PeterZhizhin.
+""".strip()
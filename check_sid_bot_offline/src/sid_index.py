@@ -0,0 +1,118 @@
+# SID lookups from the SID_INDEX KV namespace, built by tools/build_sid_index.py.
+# The index holds the SIDs of a single election, given by --voting-id.
+#
+# SIDs are sharded by their first SID_INDEX_PREFIX_LENGTH characters. A shard
+# is stored under "sid:<prefix>" as JSON:
+#
+#   {
+#     "c": {"<candidate id>": "<candidate name>", ...},
+#     "s": {"<sid>": [source, ballot_timestamp, data, decode_timestamp,
+#                     decrypted_value], ...}
+#   }
+#
+# so answering a lookup takes a single KV read. `data` is only kept for
+# ballots which are not decoded yet, the decode fields are null for those.
+import collections
+import datetime
+import json
+
+_DEFAULT_PREFIX_LENGTH = 3
+_MAX_CACHED_SHARDS = 64
+
+_ALLOWED_SID_SYMBOLS = frozenset("0123456789abcdef-")
+
+# Moscow has not had daylight saving time since 2014.
+_MOSCOW_TIMEZONE = datetime.timezone(datetime.timedelta(hours=3))
+
+_SOURCE_HUMAN_READABLE = {
+    "DEG": "ДЭГ через интернет",
+    "EVT": "ДЭГ на участке через терминал",
+}
+
+# The decoded results never change, so shards are kept for the isolate lifetime.
+_cached_shards = collections.OrderedDict()
+
+
+def shard_key(sid: str, prefix_length: int = _DEFAULT_PREFIX_LENGTH) -> str:
+    return f"sid:{sid[:prefix_length]}"
+
+
+def message_to_sid(message: str) -> str | None:
+    # Same normalization as check_sid.message_to_sid and check_sid.is_valid_sid
+    # in the online bot. Returns the canonical 8-4-4-4-12 form.
+    message = message.strip().lower()
+    sid = "".join(x for x in message if x in _ALLOWED_SID_SYMBOLS)
+    hex_digits = sid.replace("-", "")
+    if len(hex_digits) != 32:
+        return None
+    return "-".join(
+        (
+            hex_digits[:8],
+            hex_digits[8:12],
+            hex_digits[12:16],
+            hex_digits[16:20],
+            hex_digits[20:],
+        )
+    )
+
+
+def _format_time(timestamp: int) -> str:
+    local_time = datetime.datetime.fromtimestamp(timestamp, _MOSCOW_TIMEZONE)
+    return local_time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def human_readable(sid: str, record: list, candidates: dict[str, str]) -> str:
+    # Mirrors check_sid.SidQueryResult.human_readable of the online bot.
+    source, ballot_timestamp, data, decode_timestamp, decrypted_value = record
+    return_base = f"""
+Адрес транзакции: {sid}
+Через что голосовали: {_SOURCE_HUMAN_READABLE[source]}
+Время приёма бюллетеня (московское время): {_format_time(ballot_timestamp)}
+""".strip()
+
+    if decode_timestamp is None:
+        ending_message = f"""
+Поле data: {data}
+
+Пока тут есть только информация о приёме бюллетеня. Информация о том, за кого учёлся голос будет доступна после подведения итогов.
+""".strip()
+    else:
+        candidate_names_joined = ", ".join(
+            str(candidates.get(str(x))) for x in decrypted_value
+        )
+        ending_message = "\n" + f"""
+За кого расшифровалось: {candidate_names_joined}
+Время расшифровки (московское время): {_format_time(decode_timestamp)}
+""".strip()
+
+    return f"""
+{return_base}
+{ending_message}
+"""
+
+
+async def _get_shard(kv, key: str) -> dict | None:
+    if key in _cached_shards:
+        _cached_shards.move_to_end(key)
+        return _cached_shards[key]
+
+    shard_json = await kv.get(key)
+    shard = None if shard_json is None else json.loads(shard_json)
+    _cached_shards[key] = shard
+    if len(_cached_shards) > _MAX_CACHED_SHARDS:
+        _cached_shards.popitem(last=False)
+    return shard
+
+
+async def lookup(env, sid: str) -> str | None:
+    # Returns the human readable result, None if the SID is not in the index.
+    prefix_length = int(
+        getattr(env, "SID_INDEX_PREFIX_LENGTH", None) or _DEFAULT_PREFIX_LENGTH
+    )
+    shard = await _get_shard(env.SID_INDEX, shard_key(sid, prefix_length))
+    if shard is None:
+        return None
+    record = shard["s"].get(sid)
+    if record is None:
+        return None
+    return human_readable(sid, record, shard["c"])
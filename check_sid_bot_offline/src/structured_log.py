@@ -0,0 +1,101 @@
+# Sampled, structured logging for the webhook hot path.
+#
+# A request is either logged completely or not at all. The decision is made
+# once in start_request() with probability LOG_SAMPLE_RATE. Only fields in the
+# comma-separated LOG_FIELDS allowlist are written. Warnings and errors do
+# not go through here and are always logged.
+import contextvars
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_SAMPLE_RATE = 1.0
+_DEFAULT_FIELDS = frozenset(
+    {
+        "event",
+        "path",
+        "status",
+        "duration_ms",
+        "update_type",
+        "n_written",
+        "n_skipped",
+    }
+)
+
+
+class _RequestLog:
+    __slots__ = ("sampled", "fields", "start_time")
+
+    def __init__(self, sampled: bool, fields: frozenset, start_time: float):
+        self.sampled = sampled
+        self.fields = fields
+        self.start_time = start_time
+
+
+_current_request_log = contextvars.ContextVar("current_request_log", default=None)
+
+# (LOG_SAMPLE_RATE, LOG_FIELDS) as strings -> parsed values
+_parsed_configs = {}
+
+
+def _parse_config(env) -> tuple[float, frozenset]:
+    sample_rate_str = getattr(env, "LOG_SAMPLE_RATE", None)
+    fields_str = getattr(env, "LOG_FIELDS", None)
+    key = (sample_rate_str, fields_str)
+    if key not in _parsed_configs:
+        sample_rate = (
+            float(sample_rate_str) if sample_rate_str else _DEFAULT_SAMPLE_RATE
+        )
+        fields = (
+            frozenset(x.strip() for x in fields_str.split(",") if x.strip())
+            if fields_str
+            else _DEFAULT_FIELDS
+        )
+        _parsed_configs[key] = (sample_rate, fields | {"event"})
+    return _parsed_configs[key]
+
+
+def _sample(sample_rate: float) -> bool:
+    if sample_rate >= 1:
+        return True
+    if sample_rate <= 0:
+        return False
+    # Imported here: `random` alone is a noticeable share of the cold start.
+    import random
+
+    return random.random() < sample_rate
+
+
+def start_request(env) -> None:
+    sample_rate, fields = _parse_config(env)
+    _current_request_log.set(
+        _RequestLog(
+            sampled=_sample(sample_rate),
+            fields=fields,
+            start_time=time.perf_counter(),
+        )
+    )
+
+
+def is_sampled() -> bool:
+    request_log = _current_request_log.get()
+    return request_log is not None and request_log.sampled
+
+
+def event(name: str, **fields) -> None:
+    request_log = _current_request_log.get()
+    if request_log is None or not request_log.sampled:
+        return
+
+    allowed_fields = request_log.fields
+    record = {"event": name}
+    for key, value in fields.items():
+        if key in allowed_fields:
+            record[key] = value
+    if "duration_ms" in allowed_fields:
+        record["duration_ms"] = round(
+            (time.perf_counter() - request_log.start_time) * 1000, 3
+        )
+    logger.info(json.dumps(record, ensure_ascii=False))
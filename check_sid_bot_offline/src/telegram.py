@@ -1,16 +1,22 @@
-import urllib.parse
+import asyncio
+import collections
 
 import logging
 import json
 
-from js import Response, fetch, JSON
+from js import Headers, Response, fetch
 
 import messages
+import sid_index
+import structured_log
 
 
 _TELEGRAM_URL = "https://api.telegram.org/bot{bot_token}/{method_name}"
 _TELEGRAM_SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
 
+# How many user ids an isolate remembers as already written to KV.
+_MAX_SEEN_USER_IDS = 10000
+
 logger = logging.getLogger(__name__)
 
 
@@ -18,14 +24,48 @@ def get_telegram_url(bot_token: str, method_name: str):
     return _TELEGRAM_URL.format(bot_token=bot_token, method_name=method_name)
 
 
-def _js_json_to_json(js_value):
-    json_str = JSON.stringify(js_value)
-    return json.loads(json_str)
+# Only chat_id differs between replies, so everything else is serialized once
+# per isolate.
+_OFFLINE_REPLY_PREFIX = json.dumps(
+    {"method": "sendMessage", "text": messages.BOT_OFFLINE_MESSAGE},
+    ensure_ascii=False,
+)[:-1]
+_JSON_HEADERS = Headers.new({"content-type": "application/json"}.items())
+
+
+def _offline_reply(chat_id: int):
+    body = f'{_OFFLINE_REPLY_PREFIX}, "chat_id": {int(chat_id)}}}'
+    return Response.new(body, headers=_JSON_HEADERS)
+
 
+def _reply(chat_id: int, text: str):
+    body = json.dumps(
+        {"method": "sendMessage", "chat_id": int(chat_id), "text": text},
+        ensure_ascii=False,
+    )
+    return Response.new(body, headers=_JSON_HEADERS)
 
-def _json_to_js_json(py_value):
-    json_str = json.dumps(py_value)
-    return JSON.parse(json_str)
+
+async def _sid_reply_text(request_json, env) -> str | None:
+    # Returns None if the update is not a SID check
+    if getattr(env, "SID_INDEX", None) is None:
+        return None
+    text = request_json.get("message", {}).get("text")
+    if not text:
+        return None
+    sid = sid_index.message_to_sid(text)
+    if sid is None:
+        return None
+
+    structured_log.event("sid_lookup")
+    sid_data_formatted = await sid_index.lookup(env, sid)
+    if sid_data_formatted is None:
+        return messages.SID_NOT_FOUND_MESSAGE
+    return f"""
+{sid_data_formatted}
+
+{messages.SID_FOUND_FOOTER}
+""".strip()
 
 
 def _user_id_from_request(request_json):
@@ -38,33 +78,96 @@ def _user_id_from_request(request_json):
     raise ValueError(f"Invalid request JSON: {request_json}")
 
 
+class _UserIdWriter:
+    def __init__(self, max_seen_user_ids: int):
+        self._max_seen_user_ids = max_seen_user_ids
+        self._seen_user_ids = collections.OrderedDict()
+        self._pending_user_ids = set()
+        self.n_writes = 0
+        self.n_skipped = 0
+
+    def add(self, user_id) -> bool:
+        # Returns whether the user id has to be written.
+        if user_id in self._seen_user_ids:
+            self._seen_user_ids.move_to_end(user_id)
+            self.n_skipped += 1
+            return False
+
+        self._seen_user_ids[user_id] = None
+        if len(self._seen_user_ids) > self._max_seen_user_ids:
+            self._seen_user_ids.popitem(last=False)
+        self._pending_user_ids.add(user_id)
+        return True
+
+    async def flush(self, kv):
+        user_ids = list(self._pending_user_ids)
+        self._pending_user_ids = set()
+        if not user_ids:
+            return
+
+        results = await asyncio.gather(
+            *(kv.put(user_id, True) for user_id in user_ids),
+            return_exceptions=True,
+        )
+        for user_id, result in zip(user_ids, results):
+            if isinstance(result, Exception):
+                logging.error(f"Failed to persist user id {user_id}: {result}")
+                # Forget the id so that the next request retries the write
+                self._seen_user_ids.pop(user_id, None)
+                continue
+            self.n_writes += 1
+
+        structured_log.event(
+            "kv_flush",
+            n_written=self.n_writes,
+            n_skipped=self.n_skipped,
+        )
+
+
+_user_id_writer = _UserIdWriter(_MAX_SEEN_USER_IDS)
+
+
+async def _log_errors(coroutine, description: str):
+    try:
+        await coroutine
+    except Exception:
+        logging.exception(f"Failed to {description}")
+
+
+def _run_after_response(ctx, coroutine, description: str):
+    # The isolate keeps running the task after the response is returned.
+    # Errors are only logged: the user already got the reply.
+    ctx.waitUntil(asyncio.ensure_future(_log_errors(coroutine, description)))
+
+
 class Telegram:
     def __init__(
         self,
         token: str,
         webhook_secret: str,
-        webhook_url: str,
+        webhook_url: str | None = None,
     ):
         self._token = token
         self._webhook_secret = webhook_secret
         self._webhook_url = webhook_url
 
     async def _validate_response(self, response):
-        logging.info(f"Got response: {response} ({type(response)})")
-
         if not response.ok:
             response_text = await response.text()
             raise ValueError(
                 f"Got invalid response ({response.status} {response.statusText}): {response_text}"
             )
 
-        json_py_value = _js_json_to_json(await response.json())
+        json_py_value = json.loads(await response.text())
 
         if "ok" not in json_py_value or not json_py_value["ok"]:
             raise ValueError(f"Got exception from telegram: {json}")
         return json_py_value["result"]
 
     async def register_webhook(self):
+        # Not imported at the top: only needed once per deployment
+        import urllib.parse
+
         url = get_telegram_url(self._token, "setWebhook")
         params = {
             "url": self._webhook_url,
@@ -81,22 +184,19 @@ class Telegram:
         return await self._validate_response(fetch_response)
 
     async def _verify_telegram_secret(self, request):
-        request_headers = request.headers
-        logger.info(f"Request headers: {request_headers}")
-
-        telegram_header = request_headers.get(_TELEGRAM_SECRET_HEADER)
+        telegram_header = request.headers.get(_TELEGRAM_SECRET_HEADER)
         if telegram_header == self._webhook_secret:
             # Everyhing is fine
             return
 
-        logging.warning(f"Got invalid telegram header: {telegram_header}")
+        logging.warning("Got request with invalid telegram secret header")
         return Response.new("Got invalid telegram header", status=403)
 
     async def _remove_keyboard_if_callback_query(self, request_json):
         if "callback_query" not in request_json:
             return
 
-        logging.info("Removing keyboard from callback query")
+        structured_log.event("remove_keyboard")
         callback_query = request_json["callback_query"]
         message = callback_query.get("message", {})
         message_id = message.get("message_id")
@@ -107,34 +207,49 @@ class Telegram:
             return
 
         url = get_telegram_url(self._token, "editMessageReplyMarkup")
-        url_params = urllib.parse.urlencode(
-            {
-                "chat_id": chat_id,
-                "message_id": message_id,
-            }
+        url_with_params = (
+            f"{url}?chat_id={int(chat_id)}&message_id={int(message_id)}"
         )
-        url_with_params = f"{url}?{url_params}"
         await self._validate_response(await fetch(url_with_params))
 
-    async def handle_request(self, request, env):
+    async def handle_request(self, request, env, ctx):
         if invalid_response := await self._verify_telegram_secret(request):
             return invalid_response
 
-        request_json = _js_json_to_json(await request.json())
-        logging.info(f"Request JSON: {request_json}")
-
-        await self._remove_keyboard_if_callback_query(request_json)
-
+        # Parsing the body text is cheaper than building a JS object and
+        # converting it back with JSON.stringify.
+        request_json = json.loads(await request.text())
         chat_id = _user_id_from_request(request_json)
+        if structured_log.is_sampled():
+            is_callback_query = "callback_query" in request_json
+            structured_log.event(
+                "update",
+                update_type="callback_query" if is_callback_query else "message",
+                update_id=request_json.get("update_id"),
+                user_id=chat_id,
+            )
 
-        logging.info(f"Persisting user id in KV storage: {chat_id}")
-        await env.TELEGRAM_USERS.put(chat_id, True)
+        _run_after_response(
+            ctx,
+            self._remove_keyboard_if_callback_query(request_json),
+            "remove keyboard",
+        )
 
-        logging.info("Sending response")
-        json_response = {
-            "method": "sendMessage",
-            "chat_id": chat_id,
-            "text": messages.BOT_OFFLINE_MESSAGE,
-        }
+        if _user_id_writer.add(chat_id):
+            _run_after_response(
+                ctx,
+                _user_id_writer.flush(env.TELEGRAM_USERS),
+                "persist user ids",
+            )
 
-        return Response.json(_json_to_js_json(json_response))
+        try:
+            sid_reply_text = await _sid_reply_text(request_json, env)
+        except Exception:
+            # A failed KV read or a corrupt shard. Answering with the offline
+            # reply keeps Telegram from retrying the update.
+            logging.exception("Failed to look up a SID")
+            structured_log.event("sid_lookup_failed")
+            sid_reply_text = None
+        if sid_reply_text is not None:
+            return _reply(chat_id, sid_reply_text)
+        return _offline_reply(chat_id)
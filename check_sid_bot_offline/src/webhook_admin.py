@@ -0,0 +1,55 @@
+# Registering and unregistering the webhook happens once per deployment, so
+# this module is only imported by entry.py when one of these is requested.
+import logging
+import urllib.parse
+
+from js import Response
+
+import telegram
+
+logger = logging.getLogger(__name__)
+
+_WEBHOOK_PATH = "/webhook"
+
+
+def check_webhook_access_token(request, env):
+    parsed_url = urllib.parse.urlparse(request.url)
+    url_params = urllib.parse.parse_qs(parsed_url.query)
+
+    token = url_params.get("token", [None])[0]
+    if token == env.WEBHOOK_ACCESS_TOKEN:
+        return
+
+    logging.warning(f"Got invlaid access token at {parsed_url.path}")
+    return Response.new("Got invalid access token", status=403)
+
+
+def _get_telegram(request, env) -> telegram.Telegram:
+    request_url = request.url
+    parsed_url = urllib.parse.urlparse(request_url)
+    return telegram.Telegram(
+        token=env.TELEGRAM_BOT_TOKEN,
+        webhook_secret=env.WEBHOOK_SECRET,
+        webhook_url=parsed_url.scheme + "://" + parsed_url.netloc + _WEBHOOK_PATH,
+    )
+
+
+async def on_register_webhook(request, env):
+    logger.info("Registering webhook")
+    if response := check_webhook_access_token(request, env):
+        return response
+
+    telegram = _get_telegram(request, env)
+    response = await telegram.register_webhook()
+    logger.info(f"Webhook registered, response: {response}")
+    return Response.new(f"Webhook registered, response: {response}")
+
+
+async def on_unregister_webhook(request, env):
+    print("Unregistering webhook")
+    if response := check_webhook_access_token(request, env):
+        return response
+    telegram = _get_telegram(request, env)
+    response = await telegram.unregister_webhook()
+    logger.info(f"Webhook unregistered, response: {response}")
+    return Response.new("Webhook unregistered")
@@ -0,0 +1,187 @@
+"""Builds the SID_INDEX KV namespace from an export of sid_to_store_decode.
+
+The index holds the SIDs of one election, sid_to_store_decode has the SIDs of
+all elections. Export the election ordered by sid, so that every shard is
+written out as soon as it is complete:
+
+    \\copy (SELECT voting_id, sid, storageballot, storagedecodeballot FROM sid_to_store_decode WHERE voting_id = '<VotingId>' ORDER BY sid) TO 'sid_to_store_decode.csv' CSV HEADER
+    \\copy candidate_id_to_name TO 'candidate_id_to_name.csv' CSV HEADER
+
+Then build the index and upload it:
+
+    python build_sid_index.py --voting-id '<VotingId>' sid_to_store_decode.csv candidate_id_to_name.csv out/
+    for f in out/*.json; do wrangler kv:bulk put --binding SID_INDEX "$f"; done
+
+See src/sid_index.py for the format of the shards.
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+_SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "src")
+sys.path.insert(0, _SRC_DIR)
+
+import sid_index  # noqa: E402
+
+# `wrangler kv:bulk put` accepts at most 10000 pairs per file
+_MAX_PAIRS_PER_FILE = 10000
+
+# Cloudflare limits a KV value to 25 MiB
+_MAX_SHARD_BYTES = 25 * 1024 * 1024
+
+csv.field_size_limit(sys.maxsize)
+
+
+def _read_candidates(path: str) -> dict[str, str]:
+    with open(path, newline="") as f:
+        return {
+            str(int(row["candidate_id"])): row["candidate_name"]
+            for row in csv.DictReader(f)
+        }
+
+
+def _compact_record(storage_ballot: dict, storage_decode_ballot: dict | None) -> list:
+    if storage_decode_ballot is None:
+        return [
+            storage_ballot["Source"],
+            storage_ballot["Timestamp"],
+            storage_ballot["Data"],
+            None,
+            None,
+        ]
+    return [
+        storage_ballot["Source"],
+        storage_ballot["Timestamp"],
+        None,
+        storage_decode_ballot["Timestamp"],
+        storage_decode_ballot["DecryptedValue"],
+    ]
+
+
+class _BulkFileWriter:
+    def __init__(self, output_dir: str):
+        self._output_dir = output_dir
+        self._pairs: list[dict[str, str]] = []
+        self.n_files = 0
+
+    def add(self, key: str, value: str) -> None:
+        self._pairs.append({"key": key, "value": value})
+        if len(self._pairs) >= _MAX_PAIRS_PER_FILE:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._pairs:
+            return
+        path = os.path.join(self._output_dir, f"sid_index_{self.n_files:05d}.json")
+        with open(path, "w") as f:
+            json.dump(self._pairs, f, ensure_ascii=False)
+        logger.info(f"Wrote {len(self._pairs)} shards to {path}")
+        self._pairs = []
+        self.n_files += 1
+
+
+def build_index(
+    export_path: str,
+    candidates: dict[str, str],
+    output_dir: str,
+    prefix_length: int,
+    voting_id: str,
+) -> None:
+    os.makedirs(output_dir, exist_ok=True)
+    writer = _BulkFileWriter(output_dir)
+
+    current_key = None
+    current_sids: dict[str, list] = {}
+    n_sids = 0
+
+    def write_shard() -> None:
+        if current_key is None:
+            return
+        shard_candidates = {}
+        for record in current_sids.values():
+            for candidate_id in record[4] or []:
+                candidate_id = str(candidate_id)
+                if candidate_id in candidates:
+                    shard_candidates[candidate_id] = candidates[candidate_id]
+        value = json.dumps(
+            {"c": shard_candidates, "s": current_sids},
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+        if len(value.encode()) > _MAX_SHARD_BYTES:
+            raise ValueError(
+                f"Shard {current_key} is larger than the KV limit, "
+                "increase --prefix-length"
+            )
+        writer.add(current_key, value)
+
+    with open(export_path, newline="") as f:
+        reader = csv.DictReader(f)
+        if "voting_id" not in (reader.fieldnames or []):
+            raise ValueError(f"{export_path} has no voting_id column")
+        for row in reader:
+            # SIDs of other elections would overwrite the ones of this election.
+            if row["voting_id"] != voting_id:
+                continue
+            sid = row["sid"]
+            key = sid_index.shard_key(sid, prefix_length)
+            if current_key is not None and key < current_key:
+                raise ValueError(
+                    f"Export is not ordered by sid: {sid} after {current_key}"
+                )
+            if key != current_key:
+                write_shard()
+                current_key = key
+                current_sids = {}
+
+            storage_decode_ballot = row["storagedecodeballot"]
+            current_sids[sid] = _compact_record(
+                json.loads(row["storageballot"]),
+                json.loads(storage_decode_ballot) if storage_decode_ballot else None,
+            )
+            n_sids += 1
+            if n_sids % 100000 == 0:
+                logger.info(f"Read {n_sids} SIDs")
+
+    write_shard()
+    writer.flush()
+    logger.info(f"Indexed {n_sids} SIDs into {writer.n_files} bulk files")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("sid_to_store_decode_csv")
+    parser.add_argument("candidate_id_to_name_csv")
+    parser.add_argument("output_dir")
+    parser.add_argument(
+        "--voting-id", required=True, help="VotingId of the election to index"
+    )
+    parser.add_argument(
+        "--prefix-length",
+        type=int,
+        default=3,
+        help="Must match SID_INDEX_PREFIX_LENGTH of the worker",
+    )
+    args = parser.parse_args()
+
+    build_index(
+        args.sid_to_store_decode_csv,
+        _read_candidates(args.candidate_id_to_name_csv),
+        args.output_dir,
+        args.prefix_length,
+        args.voting_id,
+    )
+
+
+if __name__ == "__main__":
+    main()
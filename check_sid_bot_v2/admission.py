@@ -0,0 +1,156 @@
+import collections
+import datetime
+import enum
+import logging
+
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import ApplicationHandlerStop, ContextTypes
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(enum.Enum):
+    # SID checks and /start
+    HIGH = "high"
+    # Navigation between the menus
+    NORMAL = "normal"
+    # Static information screens
+    LOW = "low"
+
+
+_LOW_PRIORITY_CALLBACK_DATA = {
+    "info",
+    "why_bot_exists",
+    "moscow_in_person_info",
+    "voting_in_moscow_deg",
+    "voting_in_region_deg",
+    "how_deg_works",
+    "voting_in_person_redirect",
+    "did_not_check_get_info",
+    "moscow_what_is_data_field",
+}
+
+_MAX_TRACKED_MESSAGES = 10000
+
+_BUSY_TEXT = "Бот сейчас перегружен, попробуйте ещё раз через минуту."
+
+# (chat_id, message text) -> when it was admitted
+_recent_messages: collections.OrderedDict[tuple[int, str], datetime.datetime] = (
+    collections.OrderedDict()
+)
+
+
+def _update_priority(update: Update) -> Priority:
+    query = update.callback_query
+    if query is None:
+        return Priority.HIGH
+    if query.data in _LOW_PRIORITY_CALLBACK_DATA:
+        return Priority.LOW
+    return Priority.NORMAL
+
+
+def _update_age_seconds(update: Update) -> float | None:
+    # Callback queries carry the date of the message with the keyboard, not of
+    # the button press, so we only know the age of plain messages.
+    if update.callback_query is not None or update.message is None:
+        return None
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return (now - update.message.date).total_seconds()
+
+
+def _is_duplicate_message(update: Update) -> bool:
+    """Whether the same text was sent again before the first one was admitted.
+
+    Only repeats that were waiting in the queue together with the first
+    message are duplicates. A repeat sent after the bot got to the first one,
+    e.g. a SID sent again after the bot asked for it, is a new request.
+    Commands are never duplicates.
+    """
+    if update.message is None or update.message.text is None:
+        return False
+    if update.effective_chat is None:
+        return False
+    text = update.message.text.strip().lower()
+    if text.startswith("/"):
+        return False
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    window = datetime.timedelta(seconds=config.ADMISSION_DUPLICATE_WINDOW_SECONDS)
+    while _recent_messages:
+        oldest_key, oldest_time = next(iter(_recent_messages.items()))
+        if (
+            now - oldest_time < window
+            and len(_recent_messages) <= _MAX_TRACKED_MESSAGES
+        ):
+            break
+        del _recent_messages[oldest_key]
+
+    key = (update.effective_chat.id, text)
+    admitted_at = _recent_messages.get(key)
+    # Message dates are whole seconds, so a repeat sent in the second the
+    # first message was admitted is not a duplicate.
+    if admitted_at is not None and update.message.date < admitted_at:
+        return True
+    _recent_messages[key] = now.replace(microsecond=0)
+    _recent_messages.move_to_end(key)
+    return False
+
+
+async def _tell_user_about_shedding(update: Update) -> None:
+    try:
+        if update.callback_query is not None:
+            # Otherwise the button keeps spinning until the client times out.
+            await update.callback_query.answer(_BUSY_TEXT)
+        elif update.message is not None:
+            await update.message.reply_text(_BUSY_TEXT)
+    except TelegramError:
+        logger.exception(f"Could not tell about dropped update {update.update_id}")
+
+
+def _shed_reason(update: Update, priority: Priority, queue_depth: int) -> str | None:
+    age = _update_age_seconds(update)
+    if age is not None:
+        metrics.UPDATE_AGE_SECONDS.observe(age)
+        if age > config.ADMISSION_MAX_UPDATE_AGE_SECONDS:
+            return "too_old"
+
+    if (
+        priority == Priority.LOW
+        and queue_depth >= config.ADMISSION_SHED_LOW_PRIORITY_QUEUE_DEPTH
+    ):
+        return "queue_depth"
+    if (
+        priority == Priority.NORMAL
+        and queue_depth >= config.ADMISSION_SHED_NORMAL_PRIORITY_QUEUE_DEPTH
+    ):
+        return "queue_depth"
+
+    if _is_duplicate_message(update):
+        return "duplicate"
+
+    return None
+
+
+async def admit_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    queue_depth = context.application.update_queue.qsize()
+    metrics.UPDATE_QUEUE_DEPTH.set(queue_depth)
+
+    priority = _update_priority(update)
+    reason = _shed_reason(update, priority, queue_depth)
+    if reason is None:
+        metrics.UPDATES_ADMITTED.labels(priority=priority.value).inc()
+        return
+
+    logger.info(
+        f"Dropping update {update.update_id} ({priority.value} priority): "
+        f"{reason}, queue depth {queue_depth}"
+    )
+    metrics.UPDATES_SHED.labels(priority=priority.value, reason=reason).inc()
+    # The first of the duplicates is answered.
+    if reason != "duplicate":
+        await _tell_user_about_shedding(update)
+    raise ApplicationHandlerStop
@@ -0,0 +1,381 @@
+"""Flags unusual bursts of ballots and decodes while they are being ingested.
+
+Polls moscow_blockchain_txs for new transactions and counts, per closed
+minute:
+
+  - stored ballots per source,
+  - decoded votes per source and candidate.
+
+Every count is compared with a sliding window of the previous --window-minutes
+minutes, kept as a ring buffer with running sums, so memory does not grow with
+the election. A minute is flagged when the number of stored ballots is more
+than --z-threshold standard deviations above the window mean, or when a
+candidate's share of the votes decoded in a minute is that far above the
+window share. Alerts go to a table Grafana can show:
+
+CREATE TABLE vote_anomaly_alerts (
+    Id BIGSERIAL PRIMARY KEY,
+    Minute TIMESTAMP WITH TIME ZONE NOT NULL,
+    Kind TEXT NOT NULL,
+    Source TEXT NOT NULL,
+    CandidateId INT,
+    Observed DOUBLE PRECISION NOT NULL,
+    Expected DOUBLE PRECISION NOT NULL,
+    ZScore DOUBLE PRECISION NOT NULL,
+    CreatedAt TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
+
+CREATE UNIQUE INDEX vote_anomaly_alerts_unique
+    ON vote_anomaly_alerts (Minute, Kind, Source, COALESCE(CandidateId, -1));
+
+GRANT INSERT, SELECT ON vote_anomaly_alerts TO check_sid_moscow_ingest;
+GRANT USAGE ON SEQUENCE vote_anomaly_alerts_id_seq TO check_sid_moscow_ingest;
+GRANT SELECT ON vote_anomaly_alerts TO grafana;
+
+On start the windows are filled from the last --window-minutes minutes
+without alerting.
+
+    python anomaly_detector.py --interval-seconds 30
+"""
+
+import argparse
+import collections
+import dataclasses
+import datetime
+import logging
+import math
+import time
+
+import sqlalchemy
+from sqlalchemy import create_engine, text
+
+import check_sid
+import config
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+
+_SECONDS_PER_MINUTE = 60
+
+_MAX_TIMESTAMP = text("SELECT MAX(Timestamp) FROM moscow_blockchain_txs")
+
+# The source of a decode is only known from its ballot.
+_NEW_TRANSACTIONS = text(
+    """
+SELECT t.Timestamp, t.StorageBallot, t.StorageDecodeBallot, s.storageballot
+FROM moscow_blockchain_txs AS t
+LEFT JOIN sid_to_store_decode AS s
+    ON t.StorageDecodeBallot IS NOT NULL
+    AND s.voting_id = t.VotingId
+    AND s.sid = t.Sid
+WHERE t.Timestamp >= :since AND t.Timestamp < :until
+    AND (t.StorageBallot IS NOT NULL OR t.StorageDecodeBallot IS NOT NULL)
+"""
+)
+
+_INSERT_ALERT = text(
+    """
+INSERT INTO vote_anomaly_alerts
+    (Minute, Kind, Source, CandidateId, Observed, Expected, ZScore)
+VALUES (:minute, :kind, :source, :candidate_id, :observed, :expected, :z_score)
+ON CONFLICT DO NOTHING
+"""
+)
+
+
+class _RollingWindow:
+    def __init__(self, size: int):
+        self._values: collections.deque[float] = collections.deque(maxlen=size)
+        self.total = 0.0
+        self._total_of_squares = 0.0
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def push(self, x: float) -> None:
+        if len(self._values) == self._values.maxlen:
+            oldest = self._values[0]
+            self.total -= oldest
+            self._total_of_squares -= oldest * oldest
+        self._values.append(x)
+        self.total += x
+        self._total_of_squares += x * x
+
+    def mean(self) -> float:
+        return self.total / len(self._values)
+
+    def std(self) -> float:
+        mean = self.mean()
+        return math.sqrt(max(self._total_of_squares / len(self._values) - mean**2, 0))
+
+
+@dataclasses.dataclass(frozen=True)
+class Alert:
+    minute: datetime.datetime
+    kind: str
+    source: str
+    candidate_id: int | None
+    observed: float
+    expected: float
+    z_score: float
+
+
+@dataclasses.dataclass
+class _MinuteCounts:
+    stored_ballots: collections.Counter = dataclasses.field(
+        default_factory=collections.Counter
+    )
+    # (source, candidate_id) -> votes
+    votes: collections.Counter = dataclasses.field(
+        default_factory=collections.Counter
+    )
+
+
+class AnomalyDetector:
+    def __init__(
+        self,
+        window_minutes: int,
+        z_threshold: float,
+        min_count: int,
+    ):
+        self._window_minutes = window_minutes
+        self._z_threshold = z_threshold
+        self._min_count = min_count
+        self._stored_ballots: dict[str, _RollingWindow] = {}
+        self._votes: dict[tuple[str, int], _RollingWindow] = {}
+        self._total_votes: dict[str, _RollingWindow] = {}
+
+    def _window(self, windows: dict, key) -> _RollingWindow:
+        if key not in windows:
+            windows[key] = _RollingWindow(self._window_minutes)
+        return windows[key]
+
+    def _has_history(self, window: _RollingWindow) -> bool:
+        return len(window) >= self._window_minutes // 2
+
+    def _burst_alert(
+        self, window: _RollingWindow, observed: int, **alert_fields
+    ) -> Alert | None:
+        if not self._has_history(window) or observed < self._min_count:
+            return None
+        expected = window.mean()
+        # Counts are at least as noisy as a Poisson process.
+        std = max(window.std(), math.sqrt(expected), 1.0)
+        z_score = (observed - expected) / std
+        if z_score < self._z_threshold:
+            return None
+        return Alert(
+            observed=observed, expected=expected, z_score=z_score, **alert_fields
+        )
+
+    def _share_alert(
+        self,
+        window: _RollingWindow,
+        total_window: _RollingWindow,
+        observed: int,
+        total: int,
+        **alert_fields,
+    ) -> Alert | None:
+        if not self._has_history(total_window) or total < self._min_count:
+            return None
+        if total_window.total == 0:
+            return None
+        expected_share = window.total / total_window.total
+        # Binomial standard deviation of the share, with a floor for shares
+        # that were 0 or 1 so far.
+        variance = max(expected_share * (1 - expected_share), 1 / total)
+        z_score = (observed / total - expected_share) / math.sqrt(variance / total)
+        if z_score < self._z_threshold:
+            return None
+        return Alert(
+            observed=observed / total * 100,
+            expected=expected_share * 100,
+            z_score=z_score,
+            **alert_fields,
+        )
+
+    def close_minute(
+        self, minute: datetime.datetime, counts: _MinuteCounts
+    ) -> list[Alert]:
+        alerts = []
+
+        for source in self._stored_ballots.keys() | counts.stored_ballots.keys():
+            window = self._window(self._stored_ballots, source)
+            observed = counts.stored_ballots[source]
+            alert = self._burst_alert(
+                window,
+                observed,
+                minute=minute,
+                kind="stored_ballots_burst",
+                source=source,
+                candidate_id=None,
+            )
+            if alert is not None:
+                alerts.append(alert)
+            window.push(observed)
+
+        total_votes = collections.Counter()
+        for (source, _), count in counts.votes.items():
+            total_votes[source] += count
+        for source, candidate_id in self._votes.keys() | counts.votes.keys():
+            observed = counts.votes[source, candidate_id]
+            alert = self._share_alert(
+                self._window(self._votes, (source, candidate_id)),
+                self._window(self._total_votes, source),
+                observed,
+                total_votes[source],
+                minute=minute,
+                kind="candidate_share_jump",
+                source=source,
+                candidate_id=candidate_id,
+            )
+            if alert is not None:
+                alerts.append(alert)
+        # Shares are computed against the windows before this minute.
+        for source, candidate_id in self._votes.keys() | counts.votes.keys():
+            self._window(self._votes, (source, candidate_id)).push(
+                counts.votes[source, candidate_id]
+            )
+        for source in self._total_votes.keys() | total_votes.keys():
+            self._window(self._total_votes, source).push(total_votes[source])
+
+        return alerts
+
+
+def _count_transactions(
+    connection: sqlalchemy.Connection, since: int, until: int
+) -> dict[int, _MinuteCounts]:
+    counts: dict[int, _MinuteCounts] = collections.defaultdict(_MinuteCounts)
+    rows = connection.execution_options(stream_results=True, yield_per=10000).execute(
+        _NEW_TRANSACTIONS, {"since": since, "until": until}
+    )
+    for timestamp, storage_ballot, storage_decode_ballot, decoded_ballot in rows:
+        minute_counts = counts[timestamp // _SECONDS_PER_MINUTE * _SECONDS_PER_MINUTE]
+        try:
+            if storage_ballot is not None:
+                source = check_sid.StorageBallot.from_json(storage_ballot).source
+                minute_counts.stored_ballots[source.value] += 1
+            if storage_decode_ballot is not None and decoded_ballot is not None:
+                source = check_sid.StorageBallot.from_json(decoded_ballot).source
+                decode = check_sid.StorageDecodeBallot.from_json(storage_decode_ballot)
+                for candidate_id in decode.decrypted_value:
+                    minute_counts.votes[source.value, candidate_id] += 1
+        except ValueError:
+            logger.exception(f"Skipping invalid transaction at {timestamp}")
+    return counts
+
+
+def _insert_alerts(engine: sqlalchemy.Engine, pending_alerts: list[Alert]) -> None:
+    """Inserts and clears pending_alerts, keeps them to retry if that fails."""
+    if not pending_alerts:
+        return
+    try:
+        with engine.begin() as connection:
+            connection.execute(
+                _INSERT_ALERT, [dataclasses.asdict(x) for x in pending_alerts]
+            )
+    except sqlalchemy.exc.DBAPIError:
+        logger.exception(
+            f"Could not insert {len(pending_alerts)} alerts, retrying on the next poll"
+        )
+        return
+    pending_alerts.clear()
+
+
+def _poll(
+    engine: sqlalchemy.Engine,
+    detector: AnomalyDetector,
+    args: argparse.Namespace,
+    next_minute: int | None,
+    pending_alerts: list[Alert],
+) -> int | None:
+    """Closes the minutes that are complete, returns the next minute to close.
+
+    The closed minutes are already in the detector windows, so their alerts
+    are added to pending_alerts, which are inserted until it succeeds, and the
+    minutes are never closed again.
+    """
+    with engine.connect() as connection:
+        max_timestamp = connection.execute(_MAX_TIMESTAMP).scalar()
+    if max_timestamp is None:
+        return next_minute
+
+    # Minutes are closed once no more transactions are expected.
+    until = (
+        (max_timestamp - args.lateness_seconds)
+        // _SECONDS_PER_MINUTE
+        * _SECONDS_PER_MINUTE
+    )
+    is_warm_up = next_minute is None
+    if is_warm_up:
+        next_minute = until - args.window_minutes * _SECONDS_PER_MINUTE
+    if until <= next_minute:
+        _insert_alerts(engine, pending_alerts)
+        return next_minute
+
+    with engine.connect() as connection:
+        counts = _count_transactions(connection, next_minute, until)
+    alerts = []
+    for minute in range(next_minute, until, _SECONDS_PER_MINUTE):
+        alerts.extend(
+            detector.close_minute(
+                datetime.datetime.fromtimestamp(minute, datetime.timezone.utc),
+                counts.get(minute, _MinuteCounts()),
+            )
+        )
+
+    if not is_warm_up:
+        for alert in alerts:
+            logger.warning(f"Anomaly: {alert}")
+        pending_alerts.extend(alerts)
+    _insert_alerts(engine, pending_alerts)
+    return until
+
+
+def _run(
+    engine: sqlalchemy.Engine, detector: AnomalyDetector, args: argparse.Namespace
+) -> None:
+    next_minute = None
+    pending_alerts: list[Alert] = []
+    while True:
+        try:
+            next_minute = _poll(engine, detector, args, next_minute, pending_alerts)
+        except sqlalchemy.exc.DBAPIError:
+            logger.exception("Polling failed, retrying on the next interval")
+        time.sleep(args.interval_seconds)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--database-url",
+        default=config.MOSCOW_SID_DATABASE_URL,
+        help="Defaults to MOSCOW_SID_DATABASE_URL",
+    )
+    parser.add_argument("--interval-seconds", type=int, default=30)
+    parser.add_argument("--lateness-seconds", type=int, default=120)
+    parser.add_argument("--window-minutes", type=int, default=60)
+    parser.add_argument("--z-threshold", type=float, default=6.0)
+    parser.add_argument(
+        "--min-count",
+        type=int,
+        default=20,
+        help="Minutes with fewer transactions are never flagged",
+    )
+    args = parser.parse_args()
+
+    if not args.database_url:
+        parser.error("--database-url or MOSCOW_SID_DATABASE_URL must be set")
+    engine = create_engine(args.database_url, pool_pre_ping=True)
+    detector = AnomalyDetector(args.window_minutes, args.z_threshold, args.min_count)
+    _run(engine, detector, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+"""Checks that every ballot and decode in the raw dumps is in sid_to_store_decode.
+
+Reads the JSON-lines dumps in the 2024 format that moscow_deg_postgres_ingest
+loads (`<dumps-dir>/*.json`) for one election, --voting-id or the active
+election of MOSCOW_VOTING_IDS. Files are split into byte ranges that are
+scanned in parallel by a process pool, line by line. For every transaction of
+the election with a StorageBallot or StorageDecodeBallot the workers keep
+(Sid, type, Hash) and a digest of the payload. Like
+refresh_sid_to_store_decode.py, the first ballot and the last decode of a SID
+by Timestamp are kept. The result is compared with the SIDs of the election in
+sid_to_store_decode, streamed from a server-side cursor, and these SIDs are
+written to --output-dir, one `<sid> <tx hash>` per line:
+
+    missing_ballots.txt     ballot in the dumps, not in the database
+    missing_decodes.txt     decode in the dumps, not in the database
+    mismatched_ballots.txt  ballot in the database differs from the dumps
+    mismatched_decodes.txt  decode in the database differs from the dumps
+    extra_ballots.txt       ballot in the database, not in the dumps
+    extra_decodes.txt       decode in the database, not in the dumps
+
+The whole SID set is kept in memory. For very large dumps, audit SID ranges
+one by one with --sid-prefix.
+
+    python audit_dumps.py --dumps-dir dumps/ --output-dir audit/ --processes 8
+"""
+
+import argparse
+import dataclasses
+import glob
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import time
+from typing import Any
+
+from sqlalchemy import create_engine, text
+
+import config
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+
+_BALLOT = "ballot"
+_DECODE = "decode"
+_PAYLOAD_KEYS = {_BALLOT: "StorageBallot", _DECODE: "StorageDecodeBallot"}
+
+_DATABASE_QUERY = text(
+    "SELECT sid, storageballot, storagedecodeballot FROM sid_to_store_decode "
+    "WHERE voting_id = :voting_id AND sid LIKE :sid_prefix"
+)
+
+# sid -> (tx timestamp, payload digest, tx hash)
+Transactions = dict[str, tuple[int, int, str]]
+
+
+def _digest(payload: Any) -> int:
+    """Digest of a JSON value that does not depend on the key order."""
+    canonical = json.dumps(
+        payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    )
+    return int.from_bytes(
+        hashlib.blake2b(canonical.encode(), digest_size=8).digest(), "little"
+    )
+
+
+def _keep(
+    transactions: dict[str, Transactions],
+    tx_type: str,
+    sid: str,
+    x: tuple[int, int, str],
+) -> None:
+    """Keeps the transaction of the SID that refresh_sid_to_store_decode keeps."""
+    kept = transactions[tx_type].get(sid)
+    if kept is None:
+        transactions[tx_type][sid] = x
+    elif tx_type == _BALLOT and x[0] < kept[0]:
+        transactions[tx_type][sid] = x
+    elif tx_type == _DECODE and x[0] > kept[0]:
+        transactions[tx_type][sid] = x
+
+
+@dataclasses.dataclass(frozen=True)
+class _Chunk:
+    path: str
+    start: int
+    end: int
+    voting_id: str
+    sid_prefix: str
+
+
+def _split_into_chunks(
+    paths: list[str], chunk_bytes: int, voting_id: str, sid_prefix: str
+) -> list[_Chunk]:
+    chunks = []
+    for path in paths:
+        size = os.path.getsize(path)
+        for start in range(0, size, chunk_bytes):
+            chunks.append(
+                _Chunk(
+                    path, start, min(start + chunk_bytes, size), voting_id, sid_prefix
+                )
+            )
+    return chunks
+
+
+def _scan_chunk(chunk: _Chunk) -> tuple[dict[str, Transactions], int, int]:
+    """Returns transactions by type, number of lines and bytes read.
+
+    A chunk owns every line that starts in [start, end), so the partial line
+    at the start belongs to the previous chunk.
+    """
+    transactions: dict[str, Transactions] = {_BALLOT: {}, _DECODE: {}}
+    n_lines = 0
+    with open(chunk.path, "rb") as f:
+        if chunk.start > 0:
+            # Skips the rest of the line containing the byte before start.
+            f.seek(chunk.start - 1)
+            f.readline()
+        while f.tell() < chunk.end:
+            line = f.readline()
+            if not line:
+                break
+            n_lines += 1
+            # Most transactions are neither, skip them without parsing.
+            if b"StorageBallot" not in line and b"StorageDecodeBallot" not in line:
+                continue
+            try:
+                tx = json.loads(line)
+            except ValueError:
+                logger.warning(f"Invalid JSON in {chunk.path}: {line[:100]!r}")
+                continue
+            sid = tx.get("Sid")
+            decode_data = tx.get("DecodeData") or {}
+            if not sid or not sid.startswith(chunk.sid_prefix):
+                continue
+            if tx.get("VotingId") != chunk.voting_id:
+                continue
+            timestamp = int(tx.get("Timestamp") or 0)
+            for tx_type, key in _PAYLOAD_KEYS.items():
+                payload = decode_data.get(key)
+                if payload is not None:
+                    _keep(
+                        transactions,
+                        tx_type,
+                        sid,
+                        (timestamp, _digest(payload), tx.get("Hash")),
+                    )
+    return transactions, n_lines, chunk.end - chunk.start
+
+
+def _scan_dumps(chunks: list[_Chunk], processes: int) -> dict[str, Transactions]:
+    transactions: dict[str, Transactions] = {_BALLOT: {}, _DECODE: {}}
+    n_lines = 0
+    n_bytes = 0
+    total_bytes = sum(x.end - x.start for x in chunks)
+    start_time = time.perf_counter()
+    with multiprocessing.Pool(processes) as pool:
+        for chunk_transactions, chunk_lines, chunk_bytes in pool.imap_unordered(
+            _scan_chunk, chunks
+        ):
+            for tx_type, x in chunk_transactions.items():
+                for sid, y in x.items():
+                    _keep(transactions, tx_type, sid, y)
+            n_lines += chunk_lines
+            n_bytes += chunk_bytes
+            elapsed = time.perf_counter() - start_time
+            logger.info(
+                f"Scanned {n_bytes / total_bytes * 100:.0f}%, {n_lines} lines, "
+                f"{n_bytes / elapsed / 2**20:.0f} MiB/s"
+            )
+    return transactions
+
+
+def _diff_with_database(
+    database_url: str,
+    transactions: dict[str, Transactions],
+    voting_id: str,
+    sid_prefix: str,
+) -> dict[str, list[tuple[str, str]]]:
+    report: dict[str, list[tuple[str, str]]] = {
+        f"{kind}_{tx_type}s": []
+        for kind in ("missing", "mismatched", "extra")
+        for tx_type in (_BALLOT, _DECODE)
+    }
+    seen: dict[str, set[str]] = {_BALLOT: set(), _DECODE: set()}
+
+    engine = create_engine(database_url)
+    with engine.connect() as connection:
+        rows = connection.execution_options(
+            stream_results=True, yield_per=10000
+        ).execute(
+            _DATABASE_QUERY, {"voting_id": voting_id, "sid_prefix": f"{sid_prefix}%"}
+        )
+        for sid, storage_ballot, storage_decode_ballot in rows:
+            for tx_type, payload in (
+                (_BALLOT, storage_ballot),
+                (_DECODE, storage_decode_ballot),
+            ):
+                if payload is None:
+                    continue
+                dumped = transactions[tx_type].get(sid)
+                if dumped is None:
+                    report[f"extra_{tx_type}s"].append((sid, "-"))
+                    continue
+                seen[tx_type].add(sid)
+                _, digest, tx_hash = dumped
+                if _digest(payload) != digest:
+                    report[f"mismatched_{tx_type}s"].append((sid, tx_hash))
+
+    for tx_type, dumped in transactions.items():
+        for sid, (_, _, tx_hash) in dumped.items():
+            if sid not in seen[tx_type]:
+                report[f"missing_{tx_type}s"].append((sid, tx_hash))
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--dumps-dir", required=True)
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-mib", type=int, default=64)
+    parser.add_argument(
+        "--voting-id",
+        default=config.MOSCOW_ACTIVE_VOTING_ID,
+        help="Election to audit, defaults to the first of MOSCOW_VOTING_IDS",
+    )
+    parser.add_argument(
+        "--sid-prefix", default="", help="Only audit SIDs starting with this"
+    )
+    parser.add_argument(
+        "--database-url",
+        default=config.MOSCOW_SID_DATABASE_URL,
+        help="Defaults to MOSCOW_SID_DATABASE_URL",
+    )
+    args = parser.parse_args()
+
+    if not args.database_url:
+        parser.error("--database-url or MOSCOW_SID_DATABASE_URL must be set")
+    if not args.voting_id:
+        parser.error("--voting-id or MOSCOW_VOTING_IDS must be set")
+    paths = sorted(glob.glob(os.path.join(args.dumps_dir, "*.json")))
+    if not paths:
+        parser.error(f"No *.json files in {args.dumps_dir}")
+
+    chunks = _split_into_chunks(
+        paths, args.chunk_mib * 2**20, args.voting_id, args.sid_prefix
+    )
+    logger.info(
+        f"Scanning {len(paths)} files in {len(chunks)} chunks "
+        f"with {args.processes} processes"
+    )
+    transactions = _scan_dumps(chunks, args.processes)
+    logger.info(
+        f"Found {len(transactions[_BALLOT])} ballots and "
+        f"{len(transactions[_DECODE])} decodes, comparing with the database"
+    )
+    report = _diff_with_database(
+        args.database_url, transactions, args.voting_id, args.sid_prefix
+    )
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for name, entries in report.items():
+        with open(os.path.join(args.output_dir, f"{name}.txt"), "w") as f:
+            for sid, tx_hash in sorted(entries):
+                f.write(f"{sid} {tx_hash}\n")
+        logger.info(f"{name}: {len(entries)}")
+
+
+if __name__ == "__main__":
+    main()
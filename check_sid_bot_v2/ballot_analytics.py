@@ -0,0 +1,216 @@
+"""Vectorized aggregates over shards written by export_decoded_ballots.py.
+
+All shards in --input-dir must be of the same election.
+
+    python ballot_analytics.py --input-dir export/ --source DEG
+
+Candidate names are resolved through check_sid, so MOSCOW_SID_DATABASE_URL
+must be set to print them. Without it, candidates are printed by id and no
+ballot is counted as spoiled. Needs the packages from requirements-analysis.txt.
+"""
+
+import argparse
+import dataclasses
+import glob
+import logging
+import os
+import time
+
+import numpy as np
+
+import check_sid
+
+logger = logging.getLogger(__name__)
+
+_SOURCES = list(check_sid.Source)
+_SECONDS_PER_MINUTE = 60
+
+
+@dataclasses.dataclass(frozen=True)
+class DecodedBallots:
+    voting_id: np.ndarray
+    sid: np.ndarray
+    source: np.ndarray
+    ballot_timestamp: np.ndarray
+    decode_timestamp: np.ndarray
+    decrypted_offsets: np.ndarray
+    decrypted_values: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.sid)
+
+    @property
+    def is_decoded(self) -> np.ndarray:
+        return self.decode_timestamp >= 0
+
+    def source_mask(self, source: check_sid.Source | None) -> np.ndarray:
+        if source is None:
+            return np.ones(len(self), dtype=bool)
+        return self.source == _SOURCES.index(source)
+
+    def value_rows(self) -> np.ndarray:
+        """Index of the ballot of every entry of decrypted_values."""
+        return np.repeat(np.arange(len(self)), np.diff(self.decrypted_offsets))
+
+
+def load_shards(input_dir: str) -> DecodedBallots:
+    paths = sorted(glob.glob(os.path.join(input_dir, "decoded_ballots-*.npz")))
+    if not paths:
+        raise ValueError(f"No shards in {input_dir}")
+
+    columns: dict[str, list[np.ndarray]] = {
+        x.name: [] for x in dataclasses.fields(DecodedBallots)
+    }
+    n_values = 0
+    for path in paths:
+        with np.load(path) as shard:
+            for name in columns:
+                array = shard[name]
+                if name == "decrypted_offsets":
+                    # Shifted to index the concatenated values, the leading 0
+                    # is only kept for the first shard.
+                    array = array[1:] + n_values
+                columns[name].append(array)
+            n_values += len(shard["decrypted_values"])
+
+    columns["decrypted_offsets"].insert(0, np.zeros(1, dtype=np.int64))
+    ballots = DecodedBallots(**{k: np.concatenate(v) for k, v in columns.items()})
+    voting_ids = np.unique(ballots.voting_id)
+    if len(voting_ids) > 1:
+        raise ValueError(
+            f"Shards in {input_dir} are of several elections: "
+            f"{', '.join(x.decode() for x in voting_ids)}"
+        )
+    return ballots
+
+
+def votes_per_candidate_per_minute(
+    ballots: DecodedBallots, source: check_sid.Source | None = None
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Votes by the minute the ballot was stored.
+
+    Returns minute start timestamps, candidate ids and a
+    (len(minutes), len(candidate_ids)) matrix of vote counts.
+    """
+    rows = ballots.value_rows()
+    mask = ballots.source_mask(source)[rows]
+    rows = rows[mask]
+    values = ballots.decrypted_values[mask]
+
+    minutes, minute_index = np.unique(
+        ballots.ballot_timestamp[rows] // _SECONDS_PER_MINUTE * _SECONDS_PER_MINUTE,
+        return_inverse=True,
+    )
+    candidate_ids, candidate_index = np.unique(values, return_inverse=True)
+    counts = np.bincount(
+        minute_index * len(candidate_ids) + candidate_index,
+        minlength=len(minutes) * len(candidate_ids),
+    ).reshape(len(minutes), len(candidate_ids))
+    return minutes, candidate_ids, counts
+
+
+def decode_delay_histogram(
+    ballots: DecodedBallots,
+    bins: int | np.ndarray = 50,
+    source: check_sid.Source | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Histogram of seconds between the ballot and its decode."""
+    mask = ballots.is_decoded & ballots.source_mask(source)
+    delays = ballots.decode_timestamp[mask] - ballots.ballot_timestamp[mask]
+    return np.histogram(delays, bins=bins)
+
+
+def spoiled_ballots_per_minute(
+    ballots: DecodedBallots,
+    valid_candidate_ids: np.ndarray,
+    source: check_sid.Source | None = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Spoiled and all decoded ballots by the minute the ballot was stored.
+
+    A decoded ballot is spoiled if it has no valid candidate or a value that is
+    not a candidate id, as on the dashboards.
+    """
+    n_values = np.diff(ballots.decrypted_offsets)
+    rows = ballots.value_rows()
+    n_valid_values = np.bincount(
+        rows,
+        weights=np.isin(ballots.decrypted_values, valid_candidate_ids),
+        minlength=len(ballots),
+    )
+    is_spoiled = (n_values == 0) | (n_valid_values < n_values)
+
+    mask = ballots.is_decoded & ballots.source_mask(source)
+    minutes, minute_index = np.unique(
+        ballots.ballot_timestamp[mask] // _SECONDS_PER_MINUTE * _SECONDS_PER_MINUTE,
+        return_inverse=True,
+    )
+    spoiled = np.bincount(
+        minute_index, weights=is_spoiled[mask], minlength=len(minutes)
+    ).astype(np.int64)
+    decoded = np.bincount(minute_index, minlength=len(minutes))
+    return minutes, spoiled, decoded
+
+
+def candidate_names(candidate_ids: np.ndarray) -> dict[int, str | None]:
+    """Names by candidate id, None for ids of no candidate, i.e. spoiled ballots.
+
+    Without a database every id is named by itself.
+    """
+    try:
+        return {
+            int(x): check_sid.candidate_id_to_name(int(x))
+            for x in np.unique(candidate_ids)
+        }
+    except ValueError:
+        logger.warning("No candidate names without MOSCOW_SID_DATABASE_URL")
+        return {int(x): str(x) for x in np.unique(candidate_ids)}
+
+
+def main() -> None:
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--input-dir", required=True)
+    parser.add_argument(
+        "--source", choices=[x.value for x in check_sid.Source], default=None
+    )
+    args = parser.parse_args()
+    source = check_sid.Source(args.source) if args.source else None
+
+    start_time = time.perf_counter()
+    ballots = load_shards(args.input_dir)
+    logger.info(
+        f"Loaded {len(ballots)} ballots in {time.perf_counter() - start_time:.1f}s"
+    )
+
+    start_time = time.perf_counter()
+    minutes, candidate_ids, counts = votes_per_candidate_per_minute(ballots, source)
+    names = candidate_names(candidate_ids)
+    valid_candidate_ids = np.array(
+        [x for x, name in names.items() if name is not None], dtype=np.int32
+    )
+    _, spoiled, decoded = spoiled_ballots_per_minute(
+        ballots, valid_candidate_ids, source
+    )
+    delay_counts, delay_edges = decode_delay_histogram(ballots, source=source)
+    logger.info(f"Computed aggregates in {time.perf_counter() - start_time:.1f}s")
+
+    totals = counts.sum(axis=0)
+    for candidate_id, total in zip(candidate_ids, totals):
+        name = names[int(candidate_id)] or "Испорченный бюллетень"
+        print(f"{name}: {total} ({total / totals.sum() * 100:.2f}%)")
+    print(f"Spoiled ballots: {spoiled.sum()} of {decoded.sum()} decoded")
+    median_delay_bin = np.searchsorted(np.cumsum(delay_counts), delay_counts.sum() / 2)
+    print(
+        f"Median decode delay: {delay_edges[median_delay_bin] / 3600:.1f}"
+        f"-{delay_edges[median_delay_bin + 1] / 3600:.1f} hours"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,11 @@
+import asyncio
 from collections.abc import Sequence
 import functools
 import logging
+import time
 import traceback
 
+from sqlalchemy.exc import DBAPIError
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (
     Application,
@@ -11,13 +14,22 @@ from telegram.ext import (
     ConversationHandler,
     ContextTypes,
     MessageHandler,
+    TypeHandler,
     filters,
 )
 
+import admission
 import check_sid
 import config
 import database_fns
+import decode_notifications
+import federal_deg
+import metrics
 import photos
+import profiler
+import sid_suggestions
+import usage_sketches
+import user_state
 
 logger = logging.getLogger(__name__)
 
@@ -32,6 +44,9 @@ MENU, ASKED_FOR_INFO_OPTIONS, MOSCOW_ASKED_IF_CHECKED_SID, MOSCOW_ASKED_FOR_SID
     4
 )
 
+_DEFAULT_PROFILE_SECONDS = 30
+_MAX_PROFILE_SECONDS = 300
+
 
 async def photo_message_handler(
     update: Update, context: ContextTypes.DEFAULT_TYPE
@@ -53,6 +68,63 @@ async def photo_message_handler(
     )
 
 
+async def _profile_and_reply(
+    chat_id: int,
+    duration_seconds: int,
+    context: ContextTypes.DEFAULT_TYPE,
+) -> None:
+    result = await profiler.profile(duration_seconds)
+
+    await context.bot.send_message(chat_id=chat_id, text=result.summary())
+    if result.stacks:
+        await context.bot.send_document(
+            chat_id=chat_id,
+            document=result.to_folded().encode(),
+            filename=f"profile_{int(time.time())}.folded",
+        )
+
+
+async def profile_command_handler(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    assert update.effective_chat is not None
+
+    try:
+        duration_seconds = (
+            int(context.args[0]) if context.args else _DEFAULT_PROFILE_SECONDS
+        )
+    except ValueError:
+        duration_seconds = 0
+    if not 0 < duration_seconds <= _MAX_PROFILE_SECONDS:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=f"Usage: /profile [seconds], at most {_MAX_PROFILE_SECONDS}",
+        )
+        return
+
+    if not profiler.try_start_profiling():
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="Profiling is already running",
+        )
+        return
+
+    logger.info(
+        f"Profiling for {duration_seconds}s requested by {update.effective_chat.id}"
+    )
+    # Run in the background, otherwise we would block processing of other
+    # updates and profile an idle bot. The task releases the profiler, so it is
+    # created right after claiming it.
+    context.application.create_task(
+        _profile_and_reply(update.effective_chat.id, duration_seconds, context),
+        update=update,
+    )
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=f"Profiling for {duration_seconds}s",
+    )
+
+
 async def _send_delimiter(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
@@ -257,6 +329,77 @@ async def moscow_yes_i_checked_sid(
     return MOSCOW_ASKED_FOR_SID
 
 
+def _did_you_mean(sid: str) -> str:
+    suggestions = sid_suggestions.suggest(sid)
+    if not suggestions:
+        return ""
+    suggestions_joined = "\n".join(suggestions)
+    return f"""
+
+Возможно, вы имели в виду:
+{suggestions_joined}"""
+
+
+async def _federal_deg_message_handler(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    tokens: tuple[str, str],
+    reply_buttons: list[list[InlineKeyboardButton]],
+) -> int:
+    try:
+        verification = await asyncio.to_thread(federal_deg.verify, *tokens)
+    except DBAPIError:
+        logging.exception("Database error while verifying a federal DEG transaction")
+        text = """
+База данных сейчас недоступна. Попробуйте еще раз через несколько минут.
+""".strip()
+    except ValueError as e:
+        logging.exception("Error while verifying a federal DEG transaction")
+        text = f"""
+Упс, проверка транзакций федерального ДЭГ сейчас не работает:
+
+{e}
+
+Напишите @PeterZhizhin.
+""".strip()
+    else:
+        if verification is None:
+            text = """
+Эта транзакция не найдена в данных федерального ДЭГ.
+
+Проверьте, что вы прислали идентификатор транзакции и senderPublicKey полностью. Данные загружаются после подведения итогов.
+""".strip()
+        else:
+            text = verification.human_readable()
+
+    msg = await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=text,
+        reply_markup=InlineKeyboardMarkup(reply_buttons),
+    )
+    context.user_data["delete_keyboard_message_id"] = msg.message_id
+    return MOSCOW_ASKED_FOR_SID
+
+
+def _query_and_persist_sid(
+    sid: str,
+) -> tuple[check_sid.SidQueryResult | None, str | None]:
+    """The SID and its reply text, None if it is not found.
+
+    Blocks on the databases, so it is run off the event loop.
+    """
+    try:
+        sid_data = check_sid.query_sid(sid)
+    except ValueError as e:
+        database_fns.persist_sid_data(sid=sid, error_info=str(e), sid_data=None)
+        raise
+
+    database_fns.persist_sid_data(sid=sid, error_info=None, sid_data=sid_data)
+    if sid_data is None:
+        return None, None
+    return sid_data, sid_data.human_readable()
+
+
 async def moscow_sid_message_handler(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
@@ -280,6 +423,12 @@ async def moscow_sid_message_handler(
             reply_markup=None,  # This removes the keyboard
         )
 
+    federal_deg_tokens = federal_deg.parse_message(user_text)
+    if federal_deg_tokens is not None:
+        return await _federal_deg_message_handler(
+            update, context, federal_deg_tokens, reply_buttons
+        )
+
     sid = check_sid.message_to_sid(user_text)
 
     if not check_sid.is_valid_sid(sid):
@@ -289,15 +438,31 @@ async def moscow_sid_message_handler(
             text="""
 Это не похоже на адрес транзакции. Попробуйте еще раз.
 
-Если вы голосовали в ДЭГ с регионом прописки не в Москве, то на данный момент функционал проверки находится в разработке.
-    """.strip(),
+Если вы голосовали в федеральном ДЭГ с регионом прописки не в Москве, пришлите идентификатор транзакции и senderPublicKey одним сообщением.
+    """.strip()
+            + _did_you_mean(sid),
             reply_markup=InlineKeyboardMarkup(reply_buttons),
         )
         user_data["delete_keyboard_message_id"] = msg.message_id
         return MOSCOW_ASKED_FOR_SID
 
     try:
-        sid_data = check_sid.query_sid(sid)
+        # Off the event loop, so lookups of many users run concurrently.
+        sid_data, sid_data_formatted = await asyncio.to_thread(
+            _query_and_persist_sid, sid
+        )
+    except DBAPIError:
+        # The router already retried on another database.
+        logging.exception("Database error while querying SID")
+        msg = await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="""
+База данных сейчас недоступна. Попробуйте еще раз через несколько минут.
+    """.strip(),
+            reply_markup=InlineKeyboardMarkup(reply_buttons),
+        )
+        user_data["delete_keyboard_message_id"] = msg.message_id
+        return MOSCOW_ASKED_FOR_SID
     except ValueError as e:
         msg = await context.bot.send_message(
             chat_id=update.effective_chat.id,
@@ -313,20 +478,8 @@ async def moscow_sid_message_handler(
         user_data["delete_keyboard_message_id"] = msg.message_id
         logging.exception(f"Error while querying SID:\n{traceback.format_exc()}")
 
-        database_fns.persist_sid_data(
-            sid=sid,
-            error_info=str(e),
-            sid_data=None,
-        )
-
         return await start(update, context)
 
-    database_fns.persist_sid_data(
-        sid=sid,
-        error_info=None,
-        sid_data=sid_data,
-    )
-
     if sid_data is None:
         msg = await context.bot.send_message(
             chat_id=update.effective_chat.id,
@@ -337,15 +490,14 @@ async def moscow_sid_message_handler(
 Если прошло много времени, а транзакции нет, то напишите @PeterZhizhin.
 
 Введите другой SID или нажмите кнопку чтобы выйти в меню.
-    """.strip(),
+    """.strip()
+            + _did_you_mean(sid),
             reply_markup=InlineKeyboardMarkup(reply_buttons),
         )
         user_data["delete_keyboard_message_id"] = msg.message_id
 
         return MOSCOW_ASKED_FOR_SID
 
-    sid_data_formatted = sid_data.human_readable()
-
     reply_buttons.append(
         [
             InlineKeyboardButton(
@@ -354,6 +506,18 @@ async def moscow_sid_message_handler(
             ),
         ]
     )
+    if sid_data.storage_decode_ballot is None:
+        user_data["undecoded_sid"] = sid
+        reply_buttons.append(
+            [
+                InlineKeyboardButton(
+                    "Сообщить, когда голос расшифруют",
+                    callback_data="moscow_subscribe_to_decode",
+                ),
+            ]
+        )
+    else:
+        user_data.pop("undecoded_sid", None)
 
     msg = await context.bot.send_message(
         chat_id=update.effective_chat.id,
@@ -411,6 +575,42 @@ async def moscow_what_is_data_field_handler(
     return MOSCOW_ASKED_FOR_SID
 
 
+async def moscow_subscribe_to_decode_handler(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+) -> int:
+    query = update.callback_query
+    assert query is not None
+    assert update.effective_chat is not None
+
+    await query.answer()
+
+    await query.edit_message_reply_markup(reply_markup=None)
+
+    reply_buttons = [[InlineKeyboardButton("В главное меню", callback_data="back")]]
+
+    user_data = context.user_data or {}
+    sid = user_data.pop("undecoded_sid", None)
+    if sid is None:
+        text = "Не получилось подписаться. Пришлите адрес транзакции ещё раз."
+    else:
+        database_fns.subscribe_to_decode(user_id=update.effective_chat.id, sid=sid)
+        text = f"""
+Пришлю сообщение, когда голос с адресом транзакции {sid} расшифруют.
+
+Пришлите ещё один адрес транзакции или нажмите кнопку чтобы выйти в меню.
+""".strip()
+
+    msg = await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=text,
+        reply_markup=InlineKeyboardMarkup(reply_buttons),
+    )
+    user_data["delete_keyboard_message_id"] = msg.message_id
+
+    return MOSCOW_ASKED_FOR_SID
+
+
 async def moscow_did_not_check_sid(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
@@ -587,7 +787,15 @@ async def menu_handler(
     return await start(update, context)
 
 
+async def update_refresh_generation(context: ContextTypes.DEFAULT_TYPE) -> None:
+    del context
+    await asyncio.to_thread(check_sid.update_refresh_generation)
+
+
 def main() -> None:
+    if not config.BOT_TOKEN:
+        raise ValueError("CHECK_SID_BOT_TOKEN environment variable is not set")
+
     application = Application.builder().token(config.BOT_TOKEN).build()
 
     conv_handler = ConversationHandler(
@@ -628,6 +836,10 @@ def main() -> None:
                     moscow_what_is_data_field_handler,
                     pattern="moscow_what_is_data_field",
                 ),
+                CallbackQueryHandler(
+                    moscow_subscribe_to_decode_handler,
+                    pattern="^moscow_subscribe_to_decode$",
+                ),
             ],
         },
         fallbacks=[
@@ -635,11 +847,61 @@ def main() -> None:
             MessageHandler(filters.TEXT, start),
             CallbackQueryHandler(start),
         ],
+        conversation_timeout=config.CONVERSATION_TIMEOUT_SECONDS,
     )
 
+    application.add_handler(TypeHandler(Update, admission.admit_update), group=-2)
+    application.add_handler(
+        TypeHandler(Update, user_state.track_user_activity), group=-1
+    )
+    application.add_handler(
+        CommandHandler(
+            "profile",
+            profile_command_handler,
+            filters=filters.Chat(chat_id=config.REPLY_WITH_PHOTO_ID_USER_IDS),
+        )
+    )
     application.add_handler(conv_handler)
     application.add_handler(MessageHandler(filters.PHOTO, photo_message_handler))
 
+    # Readers of the refresh generation, e.g. candidate names in replies, then
+    # only read the cached value on the event loop.
+    application.job_queue.run_repeating(
+        update_refresh_generation,
+        interval=check_sid.REFRESH_GENERATION_TTL_SECONDS,
+        first=0,
+    )
+
+    application.job_queue.run_repeating(
+        user_state.sweep_user_data,
+        interval=config.USER_DATA_SWEEP_INTERVAL_SECONDS,
+        first=config.USER_DATA_SWEEP_INTERVAL_SECONDS,
+    )
+
+    application.job_queue.run_repeating(
+        decode_notifications.notify_decoded_subscriptions,
+        interval=config.DECODE_NOTIFICATION_INTERVAL_SECONDS,
+        first=config.DECODE_NOTIFICATION_INTERVAL_SECONDS,
+    )
+
+    application.job_queue.run_repeating(
+        usage_sketches.flush_sketches,
+        interval=config.USAGE_SKETCHES_FLUSH_INTERVAL_SECONDS,
+        first=config.USAGE_SKETCHES_FLUSH_INTERVAL_SECONDS,
+    )
+
+    if (
+        config.SID_SUGGESTIONS_REFRESH_INTERVAL_SECONDS
+        and config.MOSCOW_SID_DATABASE_URL
+    ):
+        application.job_queue.run_repeating(
+            sid_suggestions.refresh_index,
+            interval=config.SID_SUGGESTIONS_REFRESH_INTERVAL_SECONDS,
+            first=1,
+        )
+
+    metrics.start_metrics_server()
+
     application.run_polling()
 
 
@@ -2,17 +2,21 @@ import dataclasses
 import datetime
 import enum
 import functools
+from collections.abc import Iterator
 from typing import Any, Self
 import logging
+import time
 import uuid
 
 import pytz
-from sqlalchemy import create_engine, Column, Integer, String
+from sqlalchemy import func, BigInteger, Column, Integer, String
 from sqlalchemy.dialects.postgresql import JSONB  # Import JSONB type
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session
 
 import config
+import db_router
 
 Base = declarative_base()
 
@@ -20,11 +24,13 @@ Base = declarative_base()
 logger = logging.getLogger(__name__)
 
 
+# Partitioned by voting_id, see refresh_sid_to_store_decode.py.
 class SidToStoreDecode(Base):
     __tablename__ = "sid_to_store_decode"
     sid = Column(
         String, primary_key=True
     )  # Assuming 'sid' is of type String and serves as a unique identifier
+    voting_id = Column(String, primary_key=True)
     storageballot = Column(JSONB)  # Use JSONB type for storageballot
     storagedecodeballot = Column(JSONB)  # Use JSONB type for storagedecodeballot
 
@@ -41,44 +47,122 @@ class CandidateIdToName(Base):
         return f"<CandidateIdToName(id={self.id}, name={self.name})>"
 
 
+# Written by refresh_sid_to_store_decode.py after every refresh.
+class SidToStoreDecodeRefresh(Base):
+    __tablename__ = "sid_to_store_decode_refresh"
+    generation = Column(BigInteger, primary_key=True)
+    watermark = Column(BigInteger)
+
+
 if not config.MOSCOW_SID_DATABASE_URL:
     logger.error(
         "MOSCOW_SID_DATABASE_URL environment variable not set. Disabling database."
     )
+    _router = None
     _engine = None
     _SessionLocal = None
 else:
-    _engine = create_engine(config.MOSCOW_SID_DATABASE_URL)
-    _SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=_engine)
+    _router = db_router.DatabaseRouter(
+        config.MOSCOW_SID_DATABASE_URL,
+        config.MOSCOW_SID_REPLICA_DATABASE_URLS,
+        policy=config.MOSCOW_SID_REPLICA_ROUTING,
+        pool_size=config.MOSCOW_SID_DATABASE_POOL_SIZE,
+        max_overflow=config.MOSCOW_SID_DATABASE_MAX_OVERFLOW,
+        pool_recycle=config.MOSCOW_SID_DATABASE_POOL_RECYCLE_SECONDS,
+        pool_timeout=config.MOSCOW_SID_DATABASE_POOL_TIMEOUT_SECONDS,
+    )
+    _engine = _router.primary.engine
+    _SessionLocal = _router.primary.session_factory
+
+
+def database_router() -> db_router.DatabaseRouter | None:
+    """Router of the Moscow database, None if it is not configured."""
+    return _router
 
 
-@functools.lru_cache(maxsize=128)
-def _candidate_id_to_name_mapping() -> dict[int, str] | None:
-    if _SessionLocal is None:
+# How often the bot checks for a new refresh generation.
+REFRESH_GENERATION_TTL_SECONDS = 60
+_refresh_generation: int = 0
+_refresh_generation_checked_at: float | None = None
+_refresh_generation_updated_by_job = False
+
+
+def _query_refresh_generation() -> None:
+    global _refresh_generation, _refresh_generation_checked_at
+    _refresh_generation_checked_at = time.monotonic()
+    try:
+        # From the primary, which has the refresh first.
+        with _SessionLocal() as session:
+            generation = session.query(
+                func.max(SidToStoreDecodeRefresh.generation)
+            ).scalar()
+    except DBAPIError:
+        logger.exception("Could not query sid_to_store_decode_refresh")
+        return
+
+    if generation is not None and generation != _refresh_generation:
+        logger.info(f"sid_to_store_decode refresh generation is now {generation}")
+        _refresh_generation = int(generation)
+
+
+def update_refresh_generation() -> None:
+    """Queries the refresh generation, for a job that runs every TTL.
+
+    Once it ran, current_refresh_generation() never queries the database,
+    so it can be called on the event loop.
+    """
+    global _refresh_generation_updated_by_job
+    _refresh_generation_updated_by_job = True
+    if _SessionLocal is not None:
+        _query_refresh_generation()
+
+
+def current_refresh_generation() -> int:
+    """Generation of the last sid_to_store_decode refresh, 0 if unknown.
+
+    Cached for REFRESH_GENERATION_TTL_SECONDS, or updated by
+    update_refresh_generation() in the bot. Caches of data derived from the
+    Moscow database should be keyed by it.
+    """
+    if (
+        _SessionLocal is not None
+        and not _refresh_generation_updated_by_job
+        and (
+            _refresh_generation_checked_at is None
+            or time.monotonic() - _refresh_generation_checked_at
+            >= REFRESH_GENERATION_TTL_SECONDS
+        )
+    ):
+        _query_refresh_generation()
+    return _refresh_generation
+
+
+@functools.lru_cache(maxsize=1)
+def _candidate_id_to_name_mapping(generation: int) -> dict[int, str] | None:
+    if _router is None:
         return None
 
-    with _SessionLocal() as session:
-        logger.info("Querying candidate_id_to_name")
-        result = session.query(CandidateIdToName).all()
-        result_dict = {}
-        for x in result:
-            candidate_id = x.candidate_id
-            candidate_name = x.candidate_name
+    logger.info("Querying candidate_id_to_name")
+    result = _router.read(lambda session: session.query(CandidateIdToName).all())
+    result_dict = {}
+    for x in result:
+        candidate_id = x.candidate_id
+        candidate_name = x.candidate_name
 
-            if candidate_id is None:
-                raise ValueError(f"Invalid candidate_id: {candidate_id}")
-            if candidate_name is None:
-                raise ValueError(f"Invalid candidate_name: {candidate_name}")
+        if candidate_id is None:
+            raise ValueError(f"Invalid candidate_id: {candidate_id}")
+        if candidate_name is None:
+            raise ValueError(f"Invalid candidate_name: {candidate_name}")
 
-            candidate_id = int(candidate_id)
-            candidate_name = str(candidate_name)
+        candidate_id = int(candidate_id)
+        candidate_name = str(candidate_name)
 
-            result_dict[candidate_id] = candidate_name
-        return result_dict
+        result_dict[candidate_id] = candidate_name
+    return result_dict
 
 
 def candidate_id_to_name(candidate_id: int) -> str | None:
-    mapping = _candidate_id_to_name_mapping()
+    mapping = _candidate_id_to_name_mapping(current_refresh_generation())
     if mapping is None:
         raise ValueError("Database not initialized")
     return mapping.get(candidate_id)
@@ -195,6 +279,7 @@ class StorageDecodeBallot:
 @dataclasses.dataclass(frozen=True)
 class SidQueryResult:
     sid: str
+    voting_id: str
     storage_ballot: StorageBallot
     storage_decode_ballot: StorageDecodeBallot | None
 
@@ -208,6 +293,7 @@ class SidQueryResult:
             storage_decode_ballot = StorageDecodeBallot.from_json(x.storagedecodeballot)
         return cls(
             sid=sid,
+            voting_id=str(x.voting_id),
             storage_ballot=storage_ballot,
             storage_decode_ballot=storage_decode_ballot,
         )
@@ -246,6 +332,7 @@ class SidQueryResult:
     def to_json(self) -> Any:
         return {
             "sid": self.sid,
+            "voting_id": self.voting_id,
             "storage_ballot": self.storage_ballot.to_json(),
             "storage_decode_ballot": (
                 self.storage_decode_ballot.to_json()
@@ -255,12 +342,16 @@ class SidQueryResult:
         }
 
 
-def message_to_sid(message: str) -> str:
-    original_message = message
+def parse_sid(message: str) -> str:
+    """message_to_sid() without logging, for batches of SIDs."""
     message = message.strip().lower()
     allowed_symbols = set("0123456789abcdef-")
-    sid_str = "".join(x for x in message if x in allowed_symbols)
-    logging.info(f"Converting message {original_message} to sid {sid_str}")
+    return "".join(x for x in message if x in allowed_symbols)
+
+
+def message_to_sid(message: str) -> str:
+    sid_str = parse_sid(message)
+    logging.info(f"Converting message {message} to sid {sid_str}")
     return sid_str
 
 
@@ -273,17 +364,101 @@ def is_valid_sid(sid: str) -> bool:
         return False
 
 
+def _election_probes() -> list[list[str] | None]:
+    """VotingIds to look up SIDs in, in order. None is all elections.
+
+    Most lookups are for the active election, so they only touch its
+    partition. The other elections are probed together in one query.
+    """
+    voting_ids = config.MOSCOW_VOTING_IDS
+    if not voting_ids:
+        return [None]
+    if len(voting_ids) == 1:
+        return [voting_ids]
+    return [voting_ids[:1], voting_ids[1:]]
+
+
+def _filter_election(query, voting_ids: list[str] | None):
+    if voting_ids is None:
+        return query
+    return query.filter(SidToStoreDecode.voting_id.in_(voting_ids))
+
+
 def query_sid(sid: str) -> SidQueryResult | None:
-    if _SessionLocal is None:
+    if _router is None:
         raise ValueError(
             "Tried to query SID from database without a database URL. "
             "Set MOSCOW_SID_DATABASE_URL environment variable."
         )
 
-    with _SessionLocal() as session:
-        result = (
-            session.query(SidToStoreDecode).filter(SidToStoreDecode.sid == sid).first()
+    def read(session: Session) -> SidQueryResult | None:
+        for voting_ids in _election_probes():
+            result = _filter_election(
+                session.query(SidToStoreDecode).filter(SidToStoreDecode.sid == sid),
+                voting_ids,
+            ).first()
+            if result is not None:
+                return SidQueryResult.from_row(result)
+        return None
+
+    return _router.read(read)
+
+
+def existing_sids(sids: list[str]) -> set[str]:
+    """Subset of sids that are in sid_to_store_decode, in one query per probe."""
+    if _router is None:
+        raise ValueError("Database not initialized")
+
+    def read(session: Session) -> set[str]:
+        found = set()
+        for voting_ids in _election_probes():
+            remaining = [x for x in sids if x not in found]
+            if not remaining:
+                break
+            result = _filter_election(
+                session.query(SidToStoreDecode.sid).filter(
+                    SidToStoreDecode.sid.in_(remaining)
+                ),
+                voting_ids,
+            )
+            found.update(x for (x,) in result)
+        return found
+
+    return _router.read(read)
+
+
+def query_sids(
+    sids: list[str], decoded_only: bool = False
+) -> dict[str, SidQueryResult]:
+    """Results for the sids that are in the database, in one query per probe."""
+    if _router is None:
+        raise ValueError("Database not initialized")
+
+    def read(session: Session) -> dict[str, SidQueryResult]:
+        found: dict[str, SidQueryResult] = {}
+        for voting_ids in _election_probes():
+            remaining = [x for x in sids if x not in found]
+            if not remaining:
+                break
+            query = session.query(SidToStoreDecode).filter(
+                SidToStoreDecode.sid.in_(remaining)
+            )
+            if decoded_only:
+                query = query.filter(SidToStoreDecode.storagedecodeballot.is_not(None))
+            for x in _filter_election(query, voting_ids):
+                found.setdefault(str(x.sid), SidQueryResult.from_row(x))
+        return found
+
+    return _router.read(read)
+
+
+def all_sids() -> Iterator[str]:
+    if _router is None:
+        raise ValueError("Database not initialized")
+
+    with _router.read_session() as session:
+        query = _filter_election(
+            session.query(SidToStoreDecode.sid), config.MOSCOW_VOTING_IDS or None
         )
-        if result is None:
-            return None
-        return SidQueryResult.from_row(result)
+        for (sid,) in query.yield_per(100000):
+            yield sid
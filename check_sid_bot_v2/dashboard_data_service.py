@@ -0,0 +1,435 @@
+"""Serves the Grafana dashboard panels from memory.
+
+Implements the API of the Grafana JSON datasource plugin
+(https://grafana.com/grafana/plugins/simpod-json-datasource/):
+
+    GET  /         health check
+    POST /search   list of panels
+    POST /query    panels for the `targets` of the request
+
+and a plain `GET /panels/<panel>?from=...&to=...&source=...&cutoff=...`.
+
+The rollup tables from vote_rollups.py are loaded once per refresh generation
+(see refresh_sid_to_store_decode.py), and every rendered response is cached
+until the next generation. Responses carry an ETag, and requests with a
+matching If-None-Match get an empty 304. Time ranges are aligned to the
+bucket size, so viewers with slightly different ranges share cache entries.
+
+    python dashboard_data_service.py --port 8080
+"""
+
+import argparse
+import collections
+import dataclasses
+import datetime
+import hashlib
+import http.server
+import json
+import logging
+import threading
+import time
+import urllib.parse
+from typing import Any, Callable
+
+from sqlalchemy import create_engine, text
+
+import check_sid
+import config
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+
+_DEFAULT_BUCKET_SECONDS = 5 * 60
+_MAX_CACHED_RESPONSES = 1024
+# Reload interval when sid_to_store_decode_refresh is not available.
+_UNKNOWN_GENERATION_TTL_SECONDS = 60
+
+_SPOILED_BALLOT_NAME = "Испорченный бюллетень"
+_SOURCE_NAMES = {
+    '"DEG"': "ДЭГ",
+    '"EVT"': "ТЭГ",
+    "DEG": "ДЭГ",
+    "EVT": "ТЭГ",
+}
+
+_BALLOT_TX_COUNTS_QUERY = text(
+    "SELECT tx_time, tx_source, tx_type, transaction_cnt "
+    "FROM ballot_tx_counts_by_minute ORDER BY tx_time"
+)
+_CANDIDATE_VOTES_QUERY = text(
+    "SELECT storage_timestamp, source, candidate_id, cnt "
+    "FROM candidate_votes_by_minute ORDER BY storage_timestamp"
+)
+
+
+def _to_ms(x: datetime.datetime) -> int:
+    return int(x.timestamp() * 1000)
+
+
+@dataclasses.dataclass(frozen=True)
+class _Snapshot:
+    generation: int
+    loaded_at: float
+    # (minute in ms, tx_source, tx_type, count), ordered by time.
+    ballot_tx_counts: list[tuple[int, str, str, int]]
+    # (minute in ms, source, candidate_id, count), ordered by time.
+    candidate_votes: list[tuple[int, str, int, int]]
+
+
+@dataclasses.dataclass(frozen=True)
+class _PanelParams:
+    panel: str
+    from_ms: int | None = None
+    to_ms: int | None = None
+    source: str | None = None
+    cutoff: datetime.datetime | None = None
+    bucket_seconds: int = _DEFAULT_BUCKET_SECONDS
+    min_total: int = 0
+
+    @classmethod
+    def parse(
+        cls,
+        panel: str,
+        values: dict[str, Any],
+        from_ms: int | None,
+        to_ms: int | None,
+    ) -> "_PanelParams":
+        bucket_seconds = int(values.get("bucket_seconds", _DEFAULT_BUCKET_SECONDS))
+        if bucket_seconds < 60 or bucket_seconds % 60 != 0:
+            raise ValueError(f"Invalid bucket_seconds: {bucket_seconds}")
+        bucket_ms = bucket_seconds * 1000
+        # Aligned to the buckets, so that the result only depends on them.
+        if from_ms is not None:
+            from_ms = from_ms // bucket_ms * bucket_ms
+        if to_ms is not None:
+            to_ms = -(-to_ms // bucket_ms) * bucket_ms
+        cutoff = values.get("cutoff")
+        return cls(
+            panel=panel,
+            from_ms=from_ms,
+            to_ms=to_ms,
+            source=values.get("source") or None,
+            cutoff=datetime.datetime.fromisoformat(cutoff) if cutoff else None,
+            bucket_seconds=bucket_seconds,
+            min_total=int(values.get("min_total", 0)),
+        )
+
+    def in_range(self, ts_ms: int) -> bool:
+        return (self.from_ms is None or ts_ms >= self.from_ms) and (
+            self.to_ms is None or ts_ms < self.to_ms
+        )
+
+    def bucket(self, ts_ms: int) -> int:
+        bucket_ms = self.bucket_seconds * 1000
+        return ts_ms // bucket_ms * bucket_ms
+
+
+def _candidate_name(candidate_id: int) -> str:
+    return check_sid.candidate_id_to_name(candidate_id) or _SPOILED_BALLOT_NAME
+
+
+def _table(columns: list[str], rows: list[list[Any]]) -> dict[str, Any]:
+    return {
+        "type": "table",
+        "columns": [{"text": x} for x in columns],
+        "rows": rows,
+    }
+
+
+def _timeseries(series: dict[str, dict[int, float | None]]) -> list[dict[str, Any]]:
+    return [
+        {"target": name, "datapoints": [[v, ts] for ts, v in sorted(points.items())]}
+        for name, points in series.items()
+    ]
+
+
+def _ballot_totals(snapshot: _Snapshot, params: _PanelParams) -> Any:
+    cutoff_ms = _to_ms(params.cutoff) if params.cutoff is not None else None
+    totals: dict[str, collections.Counter] = collections.defaultdict(
+        collections.Counter
+    )
+    for ts_ms, tx_source, tx_type, count in snapshot.ballot_tx_counts:
+        if cutoff_ms is not None and ts_ms >= cutoff_ms:
+            break
+        totals[tx_source][tx_type] += count
+
+    rows = []
+    for tx_source, counts in sorted(totals.items()):
+        issued, stored = counts["issueBallot"], counts["storeBallot"]
+        rows.append(
+            [
+                _SOURCE_NAMES.get(tx_source, tx_source),
+                issued,
+                stored,
+                issued / config.TOTAL_VOTERS * 100,
+                (1 - stored / issued) * 100 if issued else None,
+            ]
+        )
+
+    paper_issued = config.PAPER_BALLOTS_ISSUED.get(params.cutoff)
+    if paper_issued is not None:
+        electronic_issued = sum(x["issueBallot"] for x in totals.values())
+        rows.append(["Бумага", paper_issued - electronic_issued, None, None, None])
+
+    return [
+        _table(
+            [
+                "Тип голосования",
+                "Выданно бюллетеней",
+                "Принято бюллетеней",
+                "Явка, %",
+                "Унесли «домой», %",
+            ],
+            rows,
+        )
+    ]
+
+
+def _ballot_txs_by_time(snapshot: _Snapshot, params: _PanelParams) -> Any:
+    series: dict[str, dict[int, float | None]] = collections.defaultdict(
+        collections.Counter
+    )
+    for ts_ms, tx_source, tx_type, count in snapshot.ballot_tx_counts:
+        if not params.in_range(ts_ms):
+            continue
+        if params.source is not None and tx_source.strip('"') != params.source:
+            continue
+        name = f"{tx_type} {_SOURCE_NAMES.get(tx_source, tx_source)}"
+        series[name][params.bucket(ts_ms)] += count
+    return _timeseries(series)
+
+
+def _candidate_votes(snapshot: _Snapshot, params: _PanelParams) -> Any:
+    votes: collections.Counter = collections.Counter()
+    for _, source, candidate_id, count in snapshot.candidate_votes:
+        if params.source is None or source == params.source:
+            votes[candidate_id] += count
+    rows = [
+        [_candidate_name(candidate_id), count]
+        for candidate_id, count in sorted(votes.items())
+    ]
+    return [_table(["candidate_name", "candidate_votes"], rows)]
+
+
+def _candidate_share_by_time(snapshot: _Snapshot, params: _PanelParams) -> Any:
+    votes: dict[int, collections.Counter] = collections.defaultdict(
+        collections.Counter
+    )
+    for ts_ms, source, candidate_id, count in snapshot.candidate_votes:
+        if not params.in_range(ts_ms):
+            continue
+        if params.source is None or source == params.source:
+            votes[params.bucket(ts_ms)][candidate_id] += count
+
+    series: dict[str, dict[int, float | None]] = collections.defaultdict(dict)
+    for bucket_ms, counts in votes.items():
+        total = sum(counts.values())
+        for candidate_id, count in counts.items():
+            share = None if total < params.min_total else count / total * 100
+            series[_candidate_name(candidate_id)][bucket_ms] = share
+    return _timeseries(series)
+
+
+_PANELS: dict[str, Callable[[_Snapshot, _PanelParams], Any]] = {
+    "ballot_totals": _ballot_totals,
+    "ballot_txs_by_time": _ballot_txs_by_time,
+    "candidate_votes": _candidate_votes,
+    "candidate_share_by_time": _candidate_share_by_time,
+}
+
+
+class _PanelCache:
+    def __init__(self, database_url: str):
+        self._engine = create_engine(database_url, pool_pre_ping=True)
+        self._lock = threading.Lock()
+        self._snapshot: _Snapshot | None = None
+        # Cache key -> (ETag, body). Cleared when a new snapshot is loaded.
+        self._responses: collections.OrderedDict[str, tuple[str, bytes]] = (
+            collections.OrderedDict()
+        )
+
+    def _is_stale(self, snapshot: _Snapshot | None, generation: int) -> bool:
+        if snapshot is None or snapshot.generation != generation:
+            return True
+        return (
+            generation == 0
+            and time.monotonic() - snapshot.loaded_at > _UNKNOWN_GENERATION_TTL_SECONDS
+        )
+
+    def _load_snapshot(self, generation: int) -> _Snapshot:
+        start_time = time.perf_counter()
+        with self._engine.connect() as connection:
+            ballot_tx_counts = [
+                (_to_ms(tx_time), tx_source, tx_type, int(count))
+                for tx_time, tx_source, tx_type, count in connection.execute(
+                    _BALLOT_TX_COUNTS_QUERY
+                )
+            ]
+            candidate_votes = [
+                (_to_ms(storage_timestamp), source, int(candidate_id), int(count))
+                for storage_timestamp, source, candidate_id, count in connection.execute(
+                    _CANDIDATE_VOTES_QUERY
+                )
+            ]
+        logger.info(
+            f"Loaded generation {generation}: {len(ballot_tx_counts)} ballot "
+            f"and {len(candidate_votes)} candidate rows in "
+            f"{time.perf_counter() - start_time:.2f}s"
+        )
+        return _Snapshot(
+            generation=generation,
+            loaded_at=time.monotonic(),
+            ballot_tx_counts=ballot_tx_counts,
+            candidate_votes=candidate_votes,
+        )
+
+    def _current_snapshot(self) -> _Snapshot:
+        generation = check_sid.current_refresh_generation()
+        snapshot = self._snapshot
+        if not self._is_stale(snapshot, generation):
+            return snapshot
+        # Only one thread queries the database, the others wait for it.
+        with self._lock:
+            if self._is_stale(self._snapshot, generation):
+                self._snapshot = self._load_snapshot(generation)
+                self._responses.clear()
+            return self._snapshot
+
+    def render(self, params_list: list[_PanelParams]) -> tuple[str, bytes]:
+        snapshot = self._current_snapshot()
+        key = repr(params_list)
+        with self._lock:
+            cached = self._responses.get(key)
+            if cached is not None:
+                self._responses.move_to_end(key)
+                return cached
+
+        results = []
+        for params in params_list:
+            result = _PANELS[params.panel](snapshot, params)
+            results.extend(result if isinstance(result, list) else [result])
+        body = json.dumps(results, ensure_ascii=False).encode()
+        etag = f'"{snapshot.generation}-{hashlib.sha1(body).hexdigest()[:16]}"'
+
+        with self._lock:
+            # Dropped if a new snapshot was loaded while rendering.
+            if self._snapshot is snapshot:
+                self._responses[key] = (etag, body)
+                if len(self._responses) > _MAX_CACHED_RESPONSES:
+                    self._responses.popitem(last=False)
+        return etag, body
+
+
+def _parse_grafana_time(x: str | None) -> int | None:
+    if not x:
+        return None
+    return _to_ms(datetime.datetime.fromisoformat(x.replace("Z", "+00:00")))
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    cache: _PanelCache
+
+    def _send(self, status: int, body: bytes = b"", etag: str | None = None) -> None:
+        self.send_response(status)
+        if etag is not None:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        if body:
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_panels(self, params_list: list[_PanelParams]) -> None:
+        etag, body = self.cache.render(params_list)
+        if_none_match = self.headers.get("If-None-Match", "")
+        if etag in (x.strip() for x in if_none_match.split(",")):
+            self._send(304, etag=etag)
+        else:
+            self._send(200, body, etag=etag)
+
+    def _handle(self, handler: Callable[[], None]) -> None:
+        try:
+            handler()
+        except (KeyError, ValueError) as e:
+            self._send(400, json.dumps({"error": str(e)}).encode())
+        except Exception:
+            logger.exception(f"Failed to handle {self.command} {self.path}")
+            self._send(500)
+
+    def do_GET(self) -> None:
+        self._handle(self._get)
+
+    def do_POST(self) -> None:
+        self._handle(self._post)
+
+    def _get(self) -> None:
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/":
+            self._send(200, b"{}")
+            return
+        if not url.path.startswith("/panels/"):
+            self._send(404)
+            return
+
+        panel = url.path.removeprefix("/panels/")
+        if panel not in _PANELS:
+            self._send(404)
+            return
+        values = dict(urllib.parse.parse_qsl(url.query))
+        from_ms = int(values["from"]) if "from" in values else None
+        to_ms = int(values["to"]) if "to" in values else None
+        self._send_panels([_PanelParams.parse(panel, values, from_ms, to_ms)])
+
+    def _post(self) -> None:
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        match self.path:
+            case "/search":
+                self._send(200, json.dumps(sorted(_PANELS)).encode())
+            case "/query":
+                time_range = request.get("range", {})
+                from_ms = _parse_grafana_time(time_range.get("from"))
+                to_ms = _parse_grafana_time(time_range.get("to"))
+                params_list = []
+                for target in request.get("targets", []):
+                    panel = target["target"]
+                    if panel not in _PANELS:
+                        raise ValueError(f"Unknown panel: {panel}")
+                    params_list.append(
+                        _PanelParams.parse(
+                            panel, target.get("payload") or {}, from_ms, to_ms
+                        )
+                    )
+                self._send_panels(params_list)
+            case _:
+                self._send(404)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(format % args)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+
+    # Candidate names and the refresh generation come from check_sid, which
+    # uses the same database.
+    if not config.MOSCOW_SID_DATABASE_URL:
+        parser.error("MOSCOW_SID_DATABASE_URL must be set")
+
+    _Handler.cache = _PanelCache(config.MOSCOW_SID_DATABASE_URL)
+    server = http.server.ThreadingHTTPServer((args.host, args.port), _Handler)
+    logger.info(f"Serving dashboard data on {args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,15 @@
 from sqlalchemy import (
     create_engine,
     Column,
+    Index,
     Integer,
     String,
     BigInteger,
     Boolean,
     DateTime,
+    LargeBinary,
 )
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -54,7 +57,66 @@ class User(Base):
     do_not_send = Column(Boolean)
 
 
+# One row per SID that was ever checked and not found, see
+# reconcile_not_found_sids.py.
+class SidResolution(Base):
+    __tablename__ = "sid_resolutions"
+    sid = Column(String, primary_key=True)
+    first_not_found_at = Column(DateTime(timezone=True), nullable=False)
+    resolved_at = Column(DateTime(timezone=True), nullable=True, index=True)
+    resolved_refresh_generation = Column(BigInteger, nullable=True)
+
+
+class SidReconciliationRun(Base):
+    __tablename__ = "sid_reconciliation_runs"
+    run_id = Column(Integer, primary_key=True, autoincrement=True)
+    run_timestamp = Column(DateTime(timezone=True), nullable=False)
+    refresh_generation = Column(BigInteger, nullable=False)
+    # checking_sids rows up to this one were added to sid_resolutions.
+    last_checking_sids_row_id = Column(Integer, nullable=False)
+    n_checked = Column(Integer, nullable=False)
+    n_resolved = Column(Integer, nullable=False)
+    total_not_found = Column(Integer, nullable=False)
+    total_resolved = Column(Integer, nullable=False)
+
+
+# Links users to SIDs, so it is kept apart from checking_sids, and rows are
+# deleted as soon as the user is notified.
+class DecodeSubscription(Base):
+    __tablename__ = "decode_subscriptions"
+    row_id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(BigInteger, nullable=False)
+    sid = Column(String, nullable=False, index=True)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index("decode_subscriptions_user_id_sid", "user_id", "sid", unique=True),
+    )
+
+
+# HyperLogLog registers of usage_sketches.py. Every bot replica writes its own
+# rows, which are merged when read.
+class UsageSketch(Base):
+    __tablename__ = "usage_sketches"
+    name = Column(String, primary_key=True)
+    period_start = Column(DateTime(timezone=True), primary_key=True)
+    replica_id = Column(String, primary_key=True)
+    registers = Column(LargeBinary, nullable=False)
+    updated_at = Column(DateTime(timezone=True), nullable=False)
+
+
 engine = create_engine(config.DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base.metadata.create_all(bind=engine)
+
+
+def dialect_insert():
+    """insert() of the bot database dialect, with on_conflict_do_*()."""
+    match engine.dialect.name:
+        case "postgresql":
+            return postgresql.insert
+        case "sqlite":
+            return sqlite.insert
+        case dialect:
+            raise ValueError(f"Unsupported database dialect: {dialect}")
@@ -7,6 +7,7 @@ from telegram import Update
 import config
 import check_sid
 import database
+import usage_sketches
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +32,7 @@ def persist_sid_data(
         return
 
     found_sid = sid_data is not None
+    usage_sketches.add_checked_sid(sid, found_sid)
     tx_info = None if sid_data is None else sid_data.to_json()
     check_timestamp = datetime.datetime.now(datetime.timezone.utc)
 
@@ -52,3 +54,18 @@ def persist_sid_data(
         with session.begin():
             session.add(row)
         logger.info(f"Successfully persisted check sid row:\n{row}")
+
+
+def subscribe_to_decode(*, user_id: int, sid: str) -> None:
+    statement = (
+        database.dialect_insert()(database.DecodeSubscription)
+        .values(
+            user_id=user_id,
+            sid=sid,
+            created_at=datetime.datetime.now(datetime.timezone.utc),
+        )
+        .on_conflict_do_nothing(index_elements=["user_id", "sid"])
+    )
+    with database.SessionLocal() as session:
+        with session.begin():
+            session.execute(statement)
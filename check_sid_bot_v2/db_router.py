@@ -0,0 +1,178 @@
+"""Routes reads of the Moscow database between the primary and read replicas.
+
+Writes and reads that must see the latest data go to the primary. Lookups go
+to the replicas, either round-robin or to the replica with the fewest queries
+in flight. A replica that fails to connect or times out is skipped for a
+while, and the primary serves reads when there are no healthy replicas.
+Reads run with read() are retried once on another database when the first
+one is unavailable. When a replica has been skipped for long enough, the
+next read pings it and only routes to it again if the ping succeeds.
+"""
+
+import contextlib
+import itertools
+import logging
+import threading
+import time
+from collections.abc import Callable, Iterator
+from typing import Any, TypeVar
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.orm import Session, sessionmaker
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+ROUND_ROBIN = "round_robin"
+LEAST_LOADED = "least_loaded"
+
+T = TypeVar("T")
+
+
+def _is_unavailable(e: DBAPIError) -> bool:
+    # Connection failures and timeouts, not errors in the query.
+    return e.connection_invalidated or isinstance(e, OperationalError)
+
+
+class _Database:
+    def __init__(self, name: str, url: str, engine_kwargs: dict[str, Any]):
+        self.name = name
+        self.engine = create_engine(url, **engine_kwargs)
+        self.session_factory = sessionmaker(
+            autocommit=False, autoflush=False, bind=self.engine
+        )
+        self.in_flight = 0
+        # 0 while healthy, otherwise when to ping it again.
+        self.unhealthy_until = 0.0
+
+
+class DatabaseRouter:
+    def __init__(
+        self,
+        primary_url: str,
+        replica_urls: list[str],
+        *,
+        policy: str = LEAST_LOADED,
+        unhealthy_seconds: float = 30,
+        **engine_kwargs,
+    ):
+        if policy not in (ROUND_ROBIN, LEAST_LOADED):
+            raise ValueError(f"Unknown routing policy: {policy}")
+        self._policy = policy
+        self._unhealthy_seconds = unhealthy_seconds
+        # Connections are checked before use, so connections dropped by a
+        # restarted or failed over server are not handed to queries.
+        engine_kwargs.setdefault("pool_pre_ping", True)
+        self.primary = _Database("primary", primary_url, engine_kwargs)
+        self._replicas = [
+            _Database(f"replica{i}", url, engine_kwargs)
+            for i, url in enumerate(replica_urls)
+        ]
+        for database in [self.primary, *self._replicas]:
+            logger.info(
+                f"Moscow database {database.name}: "
+                f"{database.engine.url.render_as_string(hide_password=True)}"
+            )
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+
+    def _reprobe(self) -> None:
+        """Pings the replicas that have been unhealthy for long enough."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [x for x in self._replicas if 0 < x.unhealthy_until <= now]
+            # Claimed until the ping is done, other reads keep skipping them.
+            for database in expired:
+                database.unhealthy_until = now + self._unhealthy_seconds
+        for database in expired:
+            try:
+                with database.engine.connect() as connection:
+                    connection.execute(text("SELECT 1"))
+            except DBAPIError:
+                metrics.MOSCOW_DB_ERRORS.labels(database.name).inc()
+                logger.warning(
+                    f"{database.name} is still unavailable, not using it for "
+                    f"{self._unhealthy_seconds}s"
+                )
+                continue
+            logger.info(f"{database.name} is available again")
+            database.unhealthy_until = 0.0
+
+    def _acquire(self, exclude: _Database | None = None) -> _Database | None:
+        """Picks a database other than exclude, None if there is none."""
+        with self._lock:
+            healthy = [
+                x for x in self._replicas if x.unhealthy_until == 0 and x is not exclude
+            ]
+            if healthy:
+                # The counter breaks ties between equally loaded replicas.
+                offset = next(self._next) % len(healthy)
+                if self._policy == ROUND_ROBIN:
+                    database = healthy[offset]
+                else:
+                    database = min(
+                        healthy[offset:] + healthy[:offset], key=lambda x: x.in_flight
+                    )
+            elif self.primary is not exclude:
+                database = self.primary
+            else:
+                return None
+            database.in_flight += 1
+        return database
+
+    @contextlib.contextmanager
+    def _session(self, database: _Database) -> Iterator[Session]:
+        """Session of an acquired database, released on exit."""
+        metrics.MOSCOW_DB_IN_FLIGHT.labels(database.name).inc()
+        start_time = time.perf_counter()
+        try:
+            with database.session_factory() as session:
+                yield session
+        except DBAPIError as e:
+            metrics.MOSCOW_DB_ERRORS.labels(database.name).inc()
+            if _is_unavailable(e) and database is not self.primary:
+                logger.warning(
+                    f"{database.name} is unavailable, not using it for "
+                    f"{self._unhealthy_seconds}s"
+                )
+                database.unhealthy_until = time.monotonic() + self._unhealthy_seconds
+            raise
+        finally:
+            with self._lock:
+                database.in_flight -= 1
+            metrics.MOSCOW_DB_IN_FLIGHT.labels(database.name).dec()
+            metrics.MOSCOW_DB_QUERY_SECONDS.labels(database.name).observe(
+                time.perf_counter() - start_time
+            )
+
+    @contextlib.contextmanager
+    def read_session(self) -> Iterator[Session]:
+        """Session for reads that cannot be retried, e.g. streamed ones."""
+        self._reprobe()
+        database = self._acquire()
+        assert database is not None
+        with self._session(database) as session:
+            yield session
+
+    def read(self, fn: Callable[[Session], T]) -> T:
+        """Runs fn in a read session, once more on another database if the
+        first one is unavailable. fn must only read."""
+        self._reprobe()
+        database = self._acquire()
+        assert database is not None
+        try:
+            with self._session(database) as session:
+                return fn(session)
+        except DBAPIError as e:
+            if not _is_unavailable(e):
+                raise
+            retry_database = self._acquire(exclude=database)
+            if retry_database is None:
+                raise
+            logger.warning(
+                f"Retrying a read of {database.name} on {retry_database.name}"
+            )
+        with self._session(retry_database) as session:
+            return fn(session)
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+
+import telegram.error
+from sqlalchemy import delete, func, select
+from telegram.ext import ContextTypes
+
+import check_sid
+import config
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_SID_CHUNK_SIZE = 10000
+
+# Refresh generation the subscriptions were last matched against.
+_matched_generation: int | None = None
+
+
+def _pending_sids() -> list[str]:
+    with database.SessionLocal() as session:
+        return list(
+            session.scalars(select(database.DecodeSubscription.sid).distinct())
+        )
+
+
+def _subscriptions_for(sids: list[str]) -> list[database.DecodeSubscription]:
+    with database.SessionLocal() as session:
+        return list(
+            session.scalars(
+                select(database.DecodeSubscription).where(
+                    database.DecodeSubscription.sid.in_(sids)
+                )
+            )
+        )
+
+
+def _decoded_subscriptions(
+    sids: list[str],
+) -> list[tuple[database.DecodeSubscription, check_sid.SidQueryResult]]:
+    """Subscriptions to the sids that are decoded, with their decodes."""
+    decoded = check_sid.query_sids(sids, decoded_only=True)
+    if not decoded:
+        return []
+    return [(x, decoded[x.sid]) for x in _subscriptions_for(list(decoded))]
+
+
+def _delete_subscription(row_id: int) -> None:
+    with database.SessionLocal() as session:
+        with session.begin():
+            session.execute(
+                delete(database.DecodeSubscription).where(
+                    database.DecodeSubscription.row_id == row_id
+                )
+            )
+
+
+def _update_pending_metric() -> None:
+    with database.SessionLocal() as session:
+        metrics.DECODE_SUBSCRIPTIONS_PENDING.set(
+            session.scalar(select(func.count(database.DecodeSubscription.row_id)))
+        )
+
+
+async def _notify(
+    context: ContextTypes.DEFAULT_TYPE,
+    subscription: database.DecodeSubscription,
+    sid_data: check_sid.SidQueryResult,
+) -> None:
+    text = f"""
+Ваш голос расшифрован.
+
+{sid_data.human_readable().strip()}
+
+Что-то не так? Напишите @PeterZhizhin.
+""".strip()
+    while True:
+        try:
+            await context.bot.send_message(chat_id=subscription.user_id, text=text)
+            metrics.DECODE_NOTIFICATIONS.labels(result="sent").inc()
+            break
+        except telegram.error.RetryAfter as e:
+            logger.warning(f"Hit Telegram rate limit, waiting {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+        except telegram.error.Forbidden:
+            # The user has blocked the bot, there is no one to notify.
+            metrics.DECODE_NOTIFICATIONS.labels(result="forbidden").inc()
+            break
+        except telegram.error.TelegramError:
+            # Kept for the next refresh generation.
+            logger.exception(f"Failed to notify subscription {subscription.row_id}")
+            metrics.DECODE_NOTIFICATIONS.labels(result="error").inc()
+            return
+    await asyncio.to_thread(_delete_subscription, subscription.row_id)
+
+
+async def notify_decoded_subscriptions(context: ContextTypes.DEFAULT_TYPE) -> None:
+    global _matched_generation
+    # Database queries run in a thread, so updates are processed meanwhile.
+    generation = await asyncio.to_thread(check_sid.current_refresh_generation)
+    # Generation 0 means the refresh generation is not known, so every run
+    # matches.
+    if generation != 0 and generation == _matched_generation:
+        return
+
+    sids = await asyncio.to_thread(_pending_sids)
+    logger.info(
+        f"Matching {len(sids)} subscribed SIDs against refresh generation "
+        f"{generation}"
+    )
+    send_interval = 1 / config.DECODE_NOTIFICATIONS_PER_SECOND
+    n_notified = 0
+    for i in range(0, len(sids), _SID_CHUNK_SIZE):
+        subscriptions = await asyncio.to_thread(
+            _decoded_subscriptions, sids[i : i + _SID_CHUNK_SIZE]
+        )
+        for subscription, sid_data in subscriptions:
+            await _notify(context, subscription, sid_data)
+            n_notified += 1
+            await asyncio.sleep(send_interval)
+
+    _matched_generation = generation
+    await asyncio.to_thread(_update_pending_metric)
+    logger.info(f"Notified {n_notified} subscriptions about decoded votes")
@@ -0,0 +1,178 @@
+"""Exports the SIDs of one election in sid_to_store_decode to NumPy shards.
+
+The election is --voting-id or the active election of MOSCOW_VOTING_IDS. Rows
+are streamed from a server-side cursor and flattened in SQL, so memory
+use is bounded by --rows-per-shard regardless of the table size. Every shard
+is written with numpy.savez_compressed as `decoded_ballots-NNNNN.npz` and
+holds these arrays, one entry per SID unless noted:
+
+    voting_id            bytes, VotingId of the election
+    sid                  S36, the SID
+    source               uint8, index in check_sid.Source
+    ballot_timestamp     int64, StorageBallot Timestamp, seconds
+    decode_timestamp     int64, StorageDecodeBallot Timestamp, -1 if not decoded
+    decrypted_offsets    int64, len(sid) + 1 entries, DecryptedValue of the
+                         i-th SID is decrypted_values[offsets[i]:offsets[i + 1]]
+    decrypted_values     int32, all DecryptedValue entries concatenated
+
+Needs the packages from requirements-analysis.txt.
+
+    python export_decoded_ballots.py --output-dir export/
+"""
+
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+from sqlalchemy import create_engine, text
+
+import check_sid
+import config
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+
+_SOURCES = list(check_sid.Source)
+_SOURCE_TO_INDEX = {x.value: i for i, x in enumerate(_SOURCES)}
+
+_EXPORT_QUERY = text("""
+SELECT
+    voting_id,
+    sid,
+    storageballot->>'Source',
+    (storageballot->>'Timestamp')::BIGINT,
+    (storagedecodeballot->>'Timestamp')::BIGINT,
+    storagedecodeballot->'DecryptedValue'
+FROM sid_to_store_decode
+WHERE voting_id = :voting_id
+ORDER BY sid
+""")
+
+
+class _ShardWriter:
+    def __init__(self, output_dir: str):
+        self._output_dir = output_dir
+        self.n_shards = 0
+        self.n_rows = 0
+        self._reset()
+
+    def _reset(self) -> None:
+        self._voting_ids: list[str] = []
+        self._sids: list[str] = []
+        self._sources: list[int] = []
+        self._ballot_timestamps: list[int] = []
+        self._decode_timestamps: list[int] = []
+        self._decrypted_offsets: list[int] = [0]
+        self._decrypted_values: list[int] = []
+
+    def __len__(self) -> int:
+        return len(self._sids)
+
+    def add(
+        self,
+        voting_id: str,
+        sid: str,
+        source: str,
+        ballot_timestamp: int,
+        decode_timestamp: int | None,
+        decrypted_value: list[int] | None,
+    ) -> None:
+        self._voting_ids.append(voting_id)
+        self._sids.append(sid)
+        self._sources.append(_SOURCE_TO_INDEX[source])
+        self._ballot_timestamps.append(ballot_timestamp)
+        self._decode_timestamps.append(
+            -1 if decode_timestamp is None else decode_timestamp
+        )
+        if decrypted_value:
+            self._decrypted_values.extend(decrypted_value)
+        self._decrypted_offsets.append(len(self._decrypted_values))
+
+    def flush(self) -> None:
+        if not self._sids:
+            return
+        path = os.path.join(
+            self._output_dir, f"decoded_ballots-{self.n_shards:05d}.npz"
+        )
+        # Written under a temporary name, so that readers never see a partial
+        # shard.
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(
+                f,
+                voting_id=np.array(self._voting_ids, dtype=np.bytes_),
+                sid=np.array(self._sids, dtype="S36"),
+                source=np.array(self._sources, dtype=np.uint8),
+                ballot_timestamp=np.array(self._ballot_timestamps, dtype=np.int64),
+                decode_timestamp=np.array(self._decode_timestamps, dtype=np.int64),
+                decrypted_offsets=np.array(self._decrypted_offsets, dtype=np.int64),
+                decrypted_values=np.array(self._decrypted_values, dtype=np.int32),
+            )
+        os.replace(tmp_path, path)
+        self.n_shards += 1
+        self.n_rows += len(self._sids)
+        self._reset()
+
+
+def export(
+    database_url: str, voting_id: str, output_dir: str, rows_per_shard: int
+) -> None:
+    os.makedirs(output_dir, exist_ok=True)
+    engine = create_engine(database_url)
+    writer = _ShardWriter(output_dir)
+    start_time = time.perf_counter()
+
+    with engine.connect() as connection:
+        result = connection.execution_options(
+            stream_results=True, yield_per=rows_per_shard
+        ).execute(_EXPORT_QUERY, {"voting_id": voting_id})
+        for row in result:
+            writer.add(*row)
+            if len(writer) >= rows_per_shard:
+                writer.flush()
+                elapsed = time.perf_counter() - start_time
+                logger.info(
+                    f"Exported {writer.n_rows} rows to {writer.n_shards} shards, "
+                    f"{writer.n_rows / elapsed:.0f} rows/s"
+                )
+    writer.flush()
+
+    logger.info(
+        f"Done: {writer.n_rows} rows in {writer.n_shards} shards, "
+        f"took {time.perf_counter() - start_time:.1f}s"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--rows-per-shard", type=int, default=500000)
+    parser.add_argument(
+        "--voting-id",
+        default=config.MOSCOW_ACTIVE_VOTING_ID,
+        help="Election to export, defaults to the first of MOSCOW_VOTING_IDS",
+    )
+    parser.add_argument(
+        "--database-url",
+        default=config.MOSCOW_SID_DATABASE_URL,
+        help="Defaults to MOSCOW_SID_DATABASE_URL",
+    )
+    args = parser.parse_args()
+
+    if not args.database_url:
+        parser.error("--database-url or MOSCOW_SID_DATABASE_URL must be set")
+    if not args.voting_id:
+        parser.error("--voting-id or MOSCOW_VOTING_IDS must be set")
+    export(args.database_url, args.voting_id, args.output_dir, args.rows_per_shard)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""Verification of federal DEG votes by transaction id and senderPublicKey.
+
+Federal DEG voters keep the transaction id and senderPublicKey of their vote,
+both base58 strings. Transactions are loaded from the federal dump by
+load_federal_deg_dump.py into this table, which only keeps digests, so tens
+of millions of transactions fit in a few GB:
+
+CREATE TABLE federal_deg_txs (
+    TxIdDigest BYTEA NOT NULL,
+    SenderPublicKeyDigest BYTEA NOT NULL,
+    Timestamp BIGINT NOT NULL
+);
+
+CREATE INDEX federal_deg_txs_tx_id ON federal_deg_txs USING HASH (TxIdDigest);
+
+GRANT INSERT, SELECT, TRUNCATE ON federal_deg_txs TO check_sid_moscow_ingest;
+GRANT SELECT ON federal_deg_txs TO check_sid_bot;
+
+A hash index finds a transaction id in constant time regardless of the
+number of transactions and stores 4 bytes per row instead of the key.
+"""
+
+import dataclasses
+import datetime
+import hashlib
+import logging
+import re
+
+import pytz
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+import check_sid
+import config
+import db_router
+
+logger = logging.getLogger(__name__)
+
+_TX_ID_DIGEST_SIZE = 16
+# Only used to check a key the voter already has, a collision would need a
+# key with the same digest for the same transaction.
+_SENDER_PUBLIC_KEY_DIGEST_SIZE = 8
+
+# Transaction ids and public keys are 32 bytes, 43 or 44 characters in base58.
+# Moscow SIDs, with or without dashes, are shorter. Longer base58 runs are
+# not split into tokens.
+_BASE58_CHAR = "[1-9A-HJ-NP-Za-km-z]"
+_BASE58_TOKEN = re.compile(
+    rf"(?<!{_BASE58_CHAR}){_BASE58_CHAR}{{43,44}}(?!{_BASE58_CHAR})"
+)
+
+_QUERY_TX = text(
+    "SELECT SenderPublicKeyDigest, Timestamp FROM federal_deg_txs "
+    "WHERE TxIdDigest = :tx_id_digest LIMIT 1"
+)
+
+
+def tx_id_digest(tx_id: str) -> bytes:
+    return hashlib.blake2b(tx_id.encode(), digest_size=_TX_ID_DIGEST_SIZE).digest()
+
+
+def sender_public_key_digest(sender_public_key: str) -> bytes:
+    return hashlib.blake2b(
+        sender_public_key.encode(), digest_size=_SENDER_PUBLIC_KEY_DIGEST_SIZE
+    ).digest()
+
+
+if not config.FEDERAL_DEG_DATABASE_URL:
+    logger.error(
+        "FEDERAL_DEG_DATABASE_URL environment variable not set. "
+        "Disabling federal DEG verification."
+    )
+    _router = None
+elif config.FEDERAL_DEG_DATABASE_URL == config.MOSCOW_SID_DATABASE_URL:
+    # Shares the pools and the replicas of the Moscow lookups instead of
+    # opening a second pool to the primary.
+    _router = check_sid.database_router()
+else:
+    _router = db_router.DatabaseRouter(config.FEDERAL_DEG_DATABASE_URL, [])
+
+
+def parse_message(message: str) -> tuple[str, str] | None:
+    """Transaction id and senderPublicKey if message has exactly both."""
+    tokens = _BASE58_TOKEN.findall(message)
+    if len(tokens) != 2:
+        return None
+    return tokens[0], tokens[1]
+
+
+@dataclasses.dataclass(frozen=True)
+class FederalVerification:
+    tx_id: str
+    timestamp: datetime.datetime
+    sender_public_key_matches: bool
+
+    def human_readable(self) -> str:
+        local_time = self.timestamp.astimezone(pytz.timezone("Europe/Moscow"))
+        time_str = local_time.strftime("%Y-%m-%d %H:%M:%S")
+        if not self.sender_public_key_matches:
+            return f"""
+Транзакция {self.tx_id} найдена в федеральном ДЭГ, но senderPublicKey не совпадает с тем, что вы прислали.
+
+Проверьте, что вы скопировали senderPublicKey полностью. Если он точно верный, то это повод написать @PeterZhizhin.
+""".strip()
+        return f"""
+Транзакция найдена в федеральном ДЭГ, senderPublicKey совпадает.
+
+Идентификатор транзакции: {self.tx_id}
+Время транзакции (московское время): {time_str}
+
+Федеральный ДЭГ не раскрывает, как учёлся индивидуальный голос, но ваш голос попал в общий итог.
+""".strip()
+
+
+def verify(first: str, second: str) -> FederalVerification | None:
+    """Looks up the transaction, None if it is not in the dump.
+
+    Users send the transaction id and senderPublicKey in any order, so the
+    second token is tried as the transaction id too.
+    """
+    if _router is None:
+        raise ValueError(
+            "Tried to verify a federal DEG transaction without a database URL. "
+            "Set FEDERAL_DEG_DATABASE_URL environment variable."
+        )
+
+    def read(session: Session) -> FederalVerification | None:
+        for tx_id, sender_public_key in ((first, second), (second, first)):
+            row = session.execute(
+                _QUERY_TX, {"tx_id_digest": tx_id_digest(tx_id)}
+            ).first()
+            if row is None:
+                continue
+            stored_key_digest, timestamp_ms = row
+            return FederalVerification(
+                tx_id=tx_id,
+                timestamp=datetime.datetime.fromtimestamp(
+                    timestamp_ms / 1000, datetime.timezone.utc
+                ),
+                sender_public_key_matches=bytes(stored_key_digest)
+                == sender_public_key_digest(sender_public_key),
+            )
+        return None
+
+    return _router.read(read)
@@ -0,0 +1,222 @@
+"""Imports user ids collected by check_sid_bot_offline into the users table.
+
+The offline worker stores every user id as a key of the TELEGRAM_USERS KV
+namespace. Keys are read either from a JSON-lines export or page by page
+from the Cloudflare API, and upserted into `users` in batches:
+
+    # From an export, one key per line: `123`, `"123"` or `{"name": "123"}`.
+    # `wrangler kv:key list` prints a JSON array, convert it with `jq -c '.[]'`.
+    python import_offline_users.py --keys-file keys.jsonl
+
+    # From the Cloudflare API, needs CLOUDFLARE_API_TOKEN.
+    python import_offline_users.py \\
+        --cloudflare-account-id ACCOUNT --cloudflare-namespace-id NAMESPACE
+
+Existing users are left untouched, so the import can be re-run at any time.
+Progress is saved to --checkpoint after each batch, and an interrupted
+import continues from there.
+"""
+
+import argparse
+import json
+import logging
+import os
+from collections.abc import Iterator
+from typing import Any
+
+import httpx
+
+import database
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+
+_CLOUDFLARE_KV_KEYS_URL = (
+    "https://api.cloudflare.com/client/v4/accounts/{account_id}"
+    "/storage/kv/namespaces/{namespace_id}/keys"
+)
+_CLOUDFLARE_PAGE_SIZE = 1000
+
+# Every key comes with the position to resume from once it is imported.
+KeysWithPositions = Iterator[tuple[str, dict[str, Any]]]
+
+
+def _key_from_json_line(line: str) -> str:
+    value = json.loads(line)
+    if isinstance(value, dict):
+        value = value["name"]
+    return str(value)
+
+
+def _keys_from_file(path: str, position: dict[str, Any] | None) -> KeysWithPositions:
+    n_lines_to_skip = position["line"] if position else 0
+    with open(path) as f:
+        for line_n, line in enumerate(f, start=1):
+            if line_n <= n_lines_to_skip:
+                continue
+            line = line.strip()
+            if not line:
+                continue
+            yield _key_from_json_line(line), {"line": line_n}
+
+
+def _keys_from_cloudflare(
+    account_id: str,
+    namespace_id: str,
+    api_token: str,
+    position: dict[str, Any] | None,
+) -> KeysWithPositions:
+    url = _CLOUDFLARE_KV_KEYS_URL.format(
+        account_id=account_id, namespace_id=namespace_id
+    )
+    cursor = position["cursor"] if position else None
+    n_keys_to_skip = position["offset"] if position else 0
+
+    with httpx.Client(
+        headers={"Authorization": f"Bearer {api_token}"}, timeout=60
+    ) as client:
+        while True:
+            params: dict[str, Any] = {"limit": _CLOUDFLARE_PAGE_SIZE}
+            if cursor:
+                params["cursor"] = cursor
+            response = client.get(url, params=params)
+            response.raise_for_status()
+            page = response.json()
+            if not page.get("success"):
+                raise ValueError(f"Got error from Cloudflare: {page.get('errors')}")
+
+            for offset, key in enumerate(page["result"], start=1):
+                if offset <= n_keys_to_skip:
+                    continue
+                yield key["name"], {"cursor": cursor, "offset": offset}
+
+            cursor = page.get("result_info", {}).get("cursor")
+            n_keys_to_skip = 0
+            if not cursor:
+                return
+
+
+def _upsert_users(user_ids: list[int]) -> None:
+    statement = (
+        database.dialect_insert()(database.User)
+        .values([{"user_id": x} for x in user_ids])
+        .on_conflict_do_nothing(index_elements=["user_id"])
+    )
+    with database.SessionLocal() as session:
+        with session.begin():
+            session.execute(statement)
+
+
+def _load_checkpoint(path: str | None) -> dict[str, Any] | None:
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_checkpoint(path: str | None, checkpoint: dict[str, Any]) -> None:
+    if path is None:
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def import_users(
+    keys: KeysWithPositions,
+    *,
+    batch_size: int,
+    checkpoint_path: str | None,
+    source: str,
+    n_imported: int = 0,
+) -> int:
+    batch: list[int] = []
+    position = None
+
+    def flush() -> None:
+        nonlocal batch, n_imported
+        if not batch:
+            return
+        _upsert_users(batch)
+        n_imported += len(batch)
+        batch = []
+        _save_checkpoint(
+            checkpoint_path,
+            {"source": source, "position": position, "imported": n_imported},
+        )
+        logger.info(f"Upserted {n_imported} user ids")
+
+    for key, position in keys:
+        try:
+            batch.append(int(key))
+        except ValueError:
+            logger.warning(f"Skipping key that is not a user id: {key!r}")
+            continue
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+
+    return n_imported
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    source_group = parser.add_mutually_exclusive_group(required=True)
+    source_group.add_argument("--keys-file", help="JSON-lines export of KV keys")
+    source_group.add_argument("--cloudflare-account-id")
+    parser.add_argument("--cloudflare-namespace-id")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument(
+        "--checkpoint",
+        help="File to save progress to and resume from",
+    )
+    args = parser.parse_args()
+
+    if args.keys_file:
+        source = f"file:{os.path.abspath(args.keys_file)}"
+    else:
+        if not args.cloudflare_namespace_id:
+            parser.error("--cloudflare-namespace-id is required with the API")
+        source = (
+            f"cloudflare:{args.cloudflare_account_id}/{args.cloudflare_namespace_id}"
+        )
+
+    checkpoint = _load_checkpoint(args.checkpoint)
+    if checkpoint is not None and checkpoint["source"] != source:
+        raise ValueError(
+            f"Checkpoint {args.checkpoint} is for {checkpoint['source']}, not {source}"
+        )
+    position = checkpoint["position"] if checkpoint else None
+    n_imported = checkpoint["imported"] if checkpoint else 0
+    if checkpoint is not None:
+        logger.info(f"Resuming after {n_imported} upserted user ids")
+
+    if args.keys_file:
+        keys = _keys_from_file(args.keys_file, position)
+    else:
+        keys = _keys_from_cloudflare(
+            args.cloudflare_account_id,
+            args.cloudflare_namespace_id,
+            os.environ["CLOUDFLARE_API_TOKEN"],
+            position,
+        )
+
+    n_imported = import_users(
+        keys,
+        batch_size=args.batch_size,
+        checkpoint_path=args.checkpoint,
+        source=source,
+        n_imported=n_imported,
+    )
+    logger.info(f"Done, upserted {n_imported} user ids in total")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""Loads the federal DEG transaction dump into federal_deg_txs.
+
+The dump is JSON lines, one transaction per line with at least `id`,
+`senderPublicKey` and `timestamp` (milliseconds). Lines are parsed in a
+stream and sent to Postgres with COPY in batches of --batch-size rows, so
+memory does not depend on the size of the dump. The table is described in
+federal_deg.py.
+
+By default transactions are appended: every batch is copied into a
+temporary table and only transactions that are not loaded yet are inserted.
+With --replace the table is truncated and the hash index is dropped during
+the load and built once at the end, which is much faster for the full dump.
+
+    python load_federal_deg_dump.py --replace federal_dump/*.jsonl
+"""
+
+import argparse
+import io
+import json
+import logging
+import time
+from collections.abc import Iterable, Iterator
+
+from sqlalchemy import create_engine
+
+import config
+import federal_deg
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+
+_COLUMNS = "(TxIdDigest, SenderPublicKeyDigest, Timestamp)"
+
+_CREATE_BATCH_TABLE = (
+    "CREATE TEMPORARY TABLE federal_deg_txs_batch "
+    "(LIKE federal_deg_txs) ON COMMIT DROP"
+)
+
+_INSERT_NEW_FROM_BATCH = f"""
+INSERT INTO federal_deg_txs {_COLUMNS}
+SELECT DISTINCT ON (b.TxIdDigest) b.TxIdDigest, b.SenderPublicKeyDigest, b.Timestamp
+FROM federal_deg_txs_batch AS b
+WHERE NOT EXISTS (
+    SELECT 1 FROM federal_deg_txs AS t WHERE t.TxIdDigest = b.TxIdDigest
+)
+"""
+
+_DROP_INDEX = "DROP INDEX IF EXISTS federal_deg_txs_tx_id"
+_CREATE_INDEX = (
+    "CREATE INDEX federal_deg_txs_tx_id ON federal_deg_txs USING HASH (TxIdDigest)"
+)
+
+
+def _copy_lines(paths: list[str]) -> Iterator[str]:
+    """Rows in the COPY text format, bytea as hex."""
+    n_skipped = 0
+    for path in paths:
+        logger.info(f"Reading {path}")
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    tx = json.loads(line)
+                    tx_id = tx["id"]
+                    sender_public_key = tx["senderPublicKey"]
+                    timestamp = int(tx["timestamp"])
+                except (ValueError, KeyError, TypeError):
+                    n_skipped += 1
+                    continue
+                if not isinstance(tx_id, str) or not isinstance(sender_public_key, str):
+                    n_skipped += 1
+                    continue
+                tx_id_digest = federal_deg.tx_id_digest(tx_id).hex()
+                key_digest = federal_deg.sender_public_key_digest(
+                    sender_public_key
+                ).hex()
+                yield f"\\\\x{tx_id_digest}\t\\\\x{key_digest}\t{timestamp}\n"
+    if n_skipped:
+        logger.warning(f"Skipped {n_skipped} lines without a transaction")
+
+
+def _batches(lines: Iterable[str], batch_size: int) -> Iterator[tuple[str, int]]:
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) == batch_size:
+            yield "".join(batch), len(batch)
+            batch = []
+    if batch:
+        yield "".join(batch), len(batch)
+
+
+def load(database_url: str, paths: list[str], batch_size: int, replace: bool) -> None:
+    engine = create_engine(database_url)
+    # COPY is only available on the psycopg2 connection.
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        if replace:
+            cursor.execute(_DROP_INDEX)
+            cursor.execute("TRUNCATE federal_deg_txs")
+
+        start_time = time.perf_counter()
+        n_read = 0
+        n_inserted = 0
+        for batch, n_rows in _batches(_copy_lines(paths), batch_size):
+            if replace:
+                cursor.copy_expert(
+                    f"COPY federal_deg_txs {_COLUMNS} FROM STDIN", io.StringIO(batch)
+                )
+                n_inserted += n_rows
+            else:
+                cursor.execute(_CREATE_BATCH_TABLE)
+                cursor.copy_expert(
+                    f"COPY federal_deg_txs_batch {_COLUMNS} FROM STDIN",
+                    io.StringIO(batch),
+                )
+                cursor.execute(_INSERT_NEW_FROM_BATCH)
+                n_inserted += cursor.rowcount
+                connection.commit()
+            n_read += n_rows
+            logger.info(
+                f"Read {n_read} transactions, inserted {n_inserted}, "
+                f"{n_read / (time.perf_counter() - start_time):.0f} per second"
+            )
+
+        if replace:
+            logger.info("Building the hash index")
+            cursor.execute(_CREATE_INDEX)
+            connection.commit()
+        cursor.execute("ANALYZE federal_deg_txs")
+        connection.commit()
+    finally:
+        connection.close()
+    logger.info(
+        f"Loaded {n_inserted} transactions in {time.perf_counter() - start_time:.0f}s"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--batch-size", type=int, default=500000)
+    parser.add_argument(
+        "--replace",
+        action="store_true",
+        help="Replace all loaded transactions instead of appending",
+    )
+    parser.add_argument(
+        "--database-url",
+        default=config.FEDERAL_DEG_DATABASE_URL,
+        help="Defaults to FEDERAL_DEG_DATABASE_URL",
+    )
+    args = parser.parse_args()
+
+    if not args.database_url:
+        parser.error("--database-url or FEDERAL_DEG_DATABASE_URL must be set")
+    load(args.database_url, args.paths, args.batch_size, args.replace)
+
+
+if __name__ == "__main__":
+    main()
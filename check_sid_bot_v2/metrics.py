@@ -0,0 +1,96 @@
+import logging
+
+import prometheus_client
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+USER_DATA_ENTRIES = prometheus_client.Gauge(
+    "bot_user_data_entries",
+    "Number of users with data in context.user_data",
+)
+USER_DATA_APPROX_BYTES = prometheus_client.Gauge(
+    "bot_user_data_approx_bytes",
+    "Approximate size of all context.user_data in bytes",
+)
+TRACKED_USERS = prometheus_client.Gauge(
+    "bot_tracked_users",
+    "Number of users seen within the conversation timeout",
+)
+USER_DATA_EVICTIONS = prometheus_client.Counter(
+    "bot_user_data_evictions_total",
+    "Number of context.user_data entries dropped by the sweep",
+    ["reason"],
+)
+
+UPDATE_QUEUE_DEPTH = prometheus_client.Gauge(
+    "bot_update_queue_depth",
+    "Number of updates waiting in the application update queue",
+)
+UPDATE_AGE_SECONDS = prometheus_client.Histogram(
+    "bot_update_age_seconds",
+    "Time between the user sending a message and the bot starting to process it",
+    buckets=(0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300),
+)
+UPDATES_ADMITTED = prometheus_client.Counter(
+    "bot_updates_admitted_total",
+    "Number of updates passed to the handlers",
+    ["priority"],
+)
+UPDATES_SHED = prometheus_client.Counter(
+    "bot_updates_shed_total",
+    "Number of updates dropped by admission control",
+    ["priority", "reason"],
+)
+
+DECODE_SUBSCRIPTIONS_PENDING = prometheus_client.Gauge(
+    "bot_decode_subscriptions_pending",
+    "Number of subscriptions to decodes that were not notified yet",
+)
+DECODE_NOTIFICATIONS = prometheus_client.Counter(
+    "bot_decode_notifications_total",
+    "Number of notifications about decoded votes",
+    ["result"],
+)
+
+MOSCOW_DB_QUERY_SECONDS = prometheus_client.Histogram(
+    "bot_moscow_db_query_seconds",
+    "Time of reads from the Moscow database, by primary or replica",
+    ["database"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+MOSCOW_DB_IN_FLIGHT = prometheus_client.Gauge(
+    "bot_moscow_db_in_flight",
+    "Number of reads from the Moscow database in progress",
+    ["database"],
+)
+MOSCOW_DB_ERRORS = prometheus_client.Counter(
+    "bot_moscow_db_errors_total",
+    "Number of failed reads from the Moscow database",
+    ["database"],
+)
+
+DISTINCT_SIDS_CHECKED = prometheus_client.Gauge(
+    "bot_distinct_sids_checked",
+    "Approximate number of distinct SIDs checked, over all bot replicas",
+)
+DISTINCT_FOUND_SIDS = prometheus_client.Gauge(
+    "bot_distinct_found_sids",
+    "Approximate number of distinct SIDs checked and found, over all bot replicas",
+)
+DISTINCT_USERS_PER_HOUR = prometheus_client.Gauge(
+    "bot_distinct_users_per_hour",
+    "Approximate number of distinct users in the current or previous hour",
+    ["hour"],
+)
+
+
+def start_metrics_server() -> None:
+    if config.METRICS_PORT is None:
+        logger.info("METRICS_PORT is not set, not exporting metrics")
+        return
+
+    logger.info(f"Exporting metrics on port {config.METRICS_PORT}")
+    prometheus_client.start_http_server(config.METRICS_PORT)
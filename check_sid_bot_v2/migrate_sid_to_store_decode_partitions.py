@@ -0,0 +1,174 @@
+"""Migrates sid_to_store_decode to the table partitioned by election.
+
+Before partitioning, sid_to_store_decode was keyed by sid alone and had no
+voting_id. This script builds the partitioned table described in
+refresh_sid_to_store_decode.py next to it, in one transaction:
+
+1. Creates sid_to_store_decode_partitioned with a partition for every
+   VotingId of the ballots in moscow_blockchain_txs.
+2. Copies every row and takes voting_id from the VotingId of the first ballot
+   transaction of its SID, the ballot the refresh keeps. Rows without such a
+   transaction are left out and counted, because the refresh does not keep
+   them either.
+3. Renames the old table to sid_to_store_decode_unpartitioned and the new one
+   to sid_to_store_decode. Then it recreates the storage timestamp index of
+   vote_rollups.py and the grants of the old table on the new one.
+
+The old table is locked against writes during the copy, but the bot keeps
+reading it until the swap. Stop refresh_sid_to_store_decode.py first, because
+its old version upserts on sid alone. Run this script, then deploy the bot and
+the refresh that know about voting_id. The rollups now only count the active
+election (see vote_rollups.py), so rebuild them once:
+
+    python migrate_sid_to_store_decode_partitions.py
+    psql -c 'TRUNCATE ballot_tx_counts_by_minute, candidate_votes_by_minute'
+    python refresh_sid_to_store_decode.py --full
+
+Drop sid_to_store_decode_unpartitioned once the new table is verified.
+"""
+
+import argparse
+import logging
+import time
+
+import sqlalchemy
+from sqlalchemy import create_engine, text
+
+import config
+import refresh_sid_to_store_decode
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+
+_OLD_TABLE = "sid_to_store_decode_unpartitioned"
+_NEW_TABLE = "sid_to_store_decode_partitioned"
+
+_LOCK_OLD_TABLE = text("LOCK TABLE sid_to_store_decode IN EXCLUSIVE MODE")
+
+_CREATE_NEW_TABLE = text(
+    f"""
+CREATE TABLE {_NEW_TABLE} (
+    voting_id TEXT NOT NULL,
+    sid TEXT NOT NULL,
+    storageballot JSONB,
+    storagedecodeballot JSONB,
+    PRIMARY KEY (sid, voting_id)
+) PARTITION BY LIST (voting_id)
+"""
+)
+
+_VOTING_IDS = text(
+    """
+SELECT DISTINCT VotingId FROM moscow_blockchain_txs
+WHERE StorageBallot IS NOT NULL AND Sid IS NOT NULL AND VotingId IS NOT NULL
+"""
+)
+
+_BACKFILL = text(
+    f"""
+INSERT INTO {_NEW_TABLE} (voting_id, sid, storageballot, storagedecodeballot)
+SELECT v.VotingId, s.sid, s.storageballot, s.storagedecodeballot
+FROM sid_to_store_decode AS s
+JOIN (
+    SELECT DISTINCT ON (Sid) Sid, VotingId
+    FROM moscow_blockchain_txs
+    WHERE StorageBallot IS NOT NULL AND Sid IS NOT NULL AND VotingId IS NOT NULL
+    ORDER BY Sid, Timestamp
+) AS v ON v.Sid = s.sid
+"""
+)
+
+_COUNT_OLD_ROWS = text("SELECT COUNT(*) FROM sid_to_store_decode")
+
+_OLD_TABLE_GRANTS = text(
+    """
+SELECT grantee, privilege_type FROM information_schema.role_table_grants
+WHERE table_schema = current_schema() AND table_name = 'sid_to_store_decode'
+    AND grantee <> (
+        SELECT tableowner FROM pg_tables
+        WHERE schemaname = current_schema() AND tablename = 'sid_to_store_decode'
+    )
+"""
+)
+
+_SWAP = [
+    text(f"ALTER TABLE sid_to_store_decode RENAME TO {_OLD_TABLE}"),
+    text(
+        "ALTER INDEX IF EXISTS sid_to_store_decode_storage_timestamp "
+        f"RENAME TO {_OLD_TABLE}_storage_timestamp"
+    ),
+    text(f"ALTER TABLE {_NEW_TABLE} RENAME TO sid_to_store_decode"),
+    # See vote_rollups.py.
+    text(
+        "CREATE INDEX sid_to_store_decode_storage_timestamp "
+        "ON sid_to_store_decode (((storageballot->>'Timestamp')::BIGINT))"
+    ),
+]
+
+
+def _quote_grantee(x: str) -> str:
+    if x == "PUBLIC":
+        return x
+    return '"' + x.replace('"', '""') + '"'
+
+
+def migrate(engine: sqlalchemy.Engine) -> None:
+    start_time = time.perf_counter()
+    with engine.begin() as connection:
+        connection.execute(_LOCK_OLD_TABLE)
+        grants = connection.execute(_OLD_TABLE_GRANTS).all()
+
+        connection.execute(_CREATE_NEW_TABLE)
+        for (voting_id,) in connection.execute(_VOTING_IDS).all():
+            refresh_sid_to_store_decode.create_partition(
+                connection, voting_id, _NEW_TABLE
+            )
+
+        n_old_rows = connection.execute(_COUNT_OLD_ROWS).scalar()
+        n_rows = connection.execute(_BACKFILL).rowcount
+        logger.info(f"Copied {n_rows} of {n_old_rows} rows")
+        if n_rows != n_old_rows:
+            logger.warning(
+                f"{n_old_rows - n_rows} rows have no ballot transaction with a "
+                f"VotingId and are only kept in {_OLD_TABLE}"
+            )
+
+        for statement in _SWAP:
+            connection.execute(statement)
+        for grantee, privilege_type in grants:
+            connection.execute(
+                text(
+                    f"GRANT {privilege_type} ON sid_to_store_decode "
+                    f"TO {_quote_grantee(grantee)}"
+                )
+            )
+        connection.execute(text("ANALYZE sid_to_store_decode"))
+
+    logger.info(
+        f"Migrated sid_to_store_decode in {time.perf_counter() - start_time:.0f}s, "
+        f"the old table is {_OLD_TABLE}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--database-url",
+        default=config.MOSCOW_SID_DATABASE_URL,
+        help="Defaults to MOSCOW_SID_DATABASE_URL",
+    )
+    args = parser.parse_args()
+
+    if not args.database_url:
+        parser.error("--database-url or MOSCOW_SID_DATABASE_URL must be set")
+    migrate(create_engine(args.database_url))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+import asyncio
+import collections
+import dataclasses
+import logging
+import os
+import sys
+import threading
+import time
+import types
+
+logger = logging.getLogger(__name__)
+
+_SAMPLE_INTERVAL_SECONDS = 0.005
+_LOOP_LAG_INTERVAL_SECONDS = 0.1
+
+_TELEGRAM_IO_MODULE_PREFIXES = ("telegram", "httpx", "httpcore", "anyio", "ssl")
+_IDLE_FUNCTIONS = {"select", "poll", "epoll", "wait", "_run_once"}
+# Where idle threads of asyncio.to_thread wait for work.
+_IDLE_THREAD_FUNCTIONS = _IDLE_FUNCTIONS | {"_worker"}
+_THREADS_STACK_ROOT = "threads"
+
+
+@dataclasses.dataclass(frozen=True)
+class ProfileResult:
+    duration_seconds: float
+    # "outer;...;inner" -> number of samples of the event loop thread
+    stacks: dict[str, int]
+    # category -> number of samples of the event loop thread
+    categories: dict[str, int]
+    # The same for the other threads, e.g. queries run with asyncio.to_thread,
+    # counting only the samples in which a thread was busy.
+    thread_stacks: dict[str, int]
+    thread_categories: dict[str, int]
+    loop_lag_seconds: list[float]
+
+    @property
+    def n_samples(self) -> int:
+        return sum(self.stacks.values())
+
+    def to_folded(self) -> str:
+        stacks = {
+            **self.stacks,
+            **{
+                f"{_THREADS_STACK_ROOT};{stack}": count
+                for stack, count in self.thread_stacks.items()
+            },
+        }
+        return "".join(
+            f"{stack} {count}\n"
+            for stack, count in sorted(stacks.items(), key=lambda x: -x[1])
+        )
+
+    def summary(self, top_n: int = 10) -> str:
+        n_samples = max(self.n_samples, 1)
+        lines = [f"Profiled {self.duration_seconds:.1f}s, {self.n_samples} samples"]
+
+        lines.append("")
+        lines.append("Time by category:")
+        for category, count in sorted(self.categories.items(), key=lambda x: -x[1]):
+            lines.append(f"  {category}: {count / n_samples * 100:.1f}%")
+
+        if self.thread_categories:
+            # Above 100% when several threads were busy at once.
+            lines.append("")
+            lines.append("Busy time of other threads by category:")
+            for category, count in sorted(
+                self.thread_categories.items(), key=lambda x: -x[1]
+            ):
+                lines.append(f"  {category}: {count / n_samples * 100:.1f}%")
+
+        leaf_counts: collections.Counter[str] = collections.Counter()
+        for stack, count in self.stacks.items():
+            leaf_counts[stack.rsplit(";", 1)[-1]] += count
+        lines.append("")
+        lines.append(f"Top {top_n} functions (self time):")
+        for function, count in leaf_counts.most_common(top_n):
+            lines.append(f"  {count / n_samples * 100:5.1f}% {function}")
+
+        lines.append("")
+        if self.loop_lag_seconds:
+            lags = sorted(self.loop_lag_seconds)
+            p99 = lags[min(len(lags) - 1, int(len(lags) * 0.99))]
+            lines.append(
+                "Event loop lag: "
+                f"mean {sum(lags) / len(lags) * 1000:.1f}ms, "
+                f"p99 {p99 * 1000:.1f}ms, "
+                f"max {lags[-1] * 1000:.1f}ms"
+            )
+        else:
+            lines.append("Event loop lag: no measurements")
+        return "\n".join(lines)
+
+
+def _frame_name(frame: types.FrameType) -> str:
+    module = frame.f_globals.get("__name__")
+    if module is None:
+        module = os.path.basename(frame.f_code.co_filename)
+    return f"{module}:{frame.f_code.co_qualname}"
+
+
+def _stack_category(frames: list[types.FrameType]) -> str:
+    if any(frame.f_code.co_name == "query_sid" for frame in frames):
+        return "query_sid"
+    if frames and frames[-1].f_code.co_name in _IDLE_FUNCTIONS:
+        return "idle (waiting for I/O)"
+    if any(
+        frame.f_globals.get("__name__", "").startswith(_TELEGRAM_IO_MODULE_PREFIXES)
+        for frame in frames
+    ):
+        return "telegram I/O"
+    return "other"
+
+
+class _SamplingThread(threading.Thread):
+    def __init__(self, target_thread_id: int):
+        super().__init__(name="profiler", daemon=True)
+        self._target_thread_id = target_thread_id
+        self._stop_event = threading.Event()
+        self.stacks: collections.Counter[str] = collections.Counter()
+        self.categories: collections.Counter[str] = collections.Counter()
+        self.thread_stacks: collections.Counter[str] = collections.Counter()
+        self.thread_categories: collections.Counter[str] = collections.Counter()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(_SAMPLE_INTERVAL_SECONDS):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+                frames = []
+                while frame is not None:
+                    frames.append(frame)
+                    frame = frame.f_back
+                frames.reverse()
+                stack = ";".join(_frame_name(x) for x in frames)
+                if thread_id == self._target_thread_id:
+                    self.stacks[stack] += 1
+                    self.categories[_stack_category(frames)] += 1
+                elif frames and frames[-1].f_code.co_name not in _IDLE_THREAD_FUNCTIONS:
+                    self.thread_stacks[stack] += 1
+                    self.thread_categories[_stack_category(frames)] += 1
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+
+
+async def _measure_loop_lag(lags: list[float]) -> None:
+    while True:
+        expected = time.perf_counter() + _LOOP_LAG_INTERVAL_SECONDS
+        await asyncio.sleep(_LOOP_LAG_INTERVAL_SECONDS)
+        lags.append(max(0.0, time.perf_counter() - expected))
+
+
+_is_profiling = False
+
+
+def try_start_profiling() -> bool:
+    """Claims the profiler without waiting, False if a profile is running.
+
+    Must be followed by profile(), which releases it.
+    """
+    global _is_profiling
+    if _is_profiling:
+        return False
+    _is_profiling = True
+    return True
+
+
+async def profile(duration_seconds: float) -> ProfileResult:
+    # Nothing is sampled outside of this function, so there is no overhead
+    # when nobody asked for a profile.
+    global _is_profiling
+    assert _is_profiling, "Call try_start_profiling() first"
+    try:
+        sampler = _SamplingThread(threading.get_ident())
+        lags: list[float] = []
+        lag_task = asyncio.create_task(_measure_loop_lag(lags))
+
+        start_time = time.perf_counter()
+        sampler.start()
+        try:
+            await asyncio.sleep(duration_seconds)
+        finally:
+            sampler.stop()
+            lag_task.cancel()
+
+        return ProfileResult(
+            duration_seconds=time.perf_counter() - start_time,
+            stacks=dict(sampler.stacks),
+            categories=dict(sampler.categories),
+            thread_stacks=dict(sampler.thread_stacks),
+            thread_categories=dict(sampler.thread_categories),
+            loop_lag_seconds=lags,
+        )
+    finally:
+        _is_profiling = False
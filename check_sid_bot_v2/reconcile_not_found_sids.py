@@ -0,0 +1,166 @@
+"""Finds out which SIDs that were not found when checked appeared later.
+
+Every SID recorded in checking_sids as not found (without an error) is added
+to sid_resolutions. After each refresh of sid_to_store_decode the unresolved
+SIDs are looked up in bulk, chunk by chunk, and the found ones are marked with
+the resolution time and refresh generation. Every run is recorded in
+sid_reconciliation_runs with the totals:
+
+    python reconcile_not_found_sids.py --interval-seconds 300
+"""
+
+import argparse
+import datetime
+import logging
+import time
+
+import sqlalchemy
+from sqlalchemy import func, select, update
+
+import check_sid
+import database
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+
+
+def _last_run() -> database.SidReconciliationRun | None:
+    with database.SessionLocal() as session:
+        return session.scalars(
+            select(database.SidReconciliationRun)
+            .order_by(database.SidReconciliationRun.run_id.desc())
+            .limit(1)
+        ).first()
+
+
+def _add_new_not_found_sids(session, last_row_id: int) -> int:
+    """Adds SIDs checked after last_row_id, returns the new last row id."""
+    max_row_id = session.scalar(select(func.max(database.CheckingSids.row_id)))
+    if max_row_id is None or max_row_id <= last_row_id:
+        return last_row_id
+
+    not_found = (
+        select(
+            database.CheckingSids.sid,
+            func.min(database.CheckingSids.check_timestamp),
+        )
+        .where(
+            database.CheckingSids.row_id > last_row_id,
+            database.CheckingSids.row_id <= max_row_id,
+            database.CheckingSids.found_sid.is_(False),
+            database.CheckingSids.error_info.is_(None),
+        )
+        .group_by(database.CheckingSids.sid)
+    )
+    session.execute(
+        database.dialect_insert()(database.SidResolution)
+        .from_select(["sid", "first_not_found_at"], not_found)
+        .on_conflict_do_nothing(index_elements=["sid"])
+    )
+    return max_row_id
+
+
+def reconcile(refresh_generation: int, chunk_size: int) -> None:
+    start_time = time.perf_counter()
+    last_run = _last_run()
+    last_row_id = last_run.last_checking_sids_row_id if last_run else 0
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    # Committed after every step, so that a failed run keeps its progress.
+    with database.SessionLocal() as session:
+        last_row_id = _add_new_not_found_sids(session, last_row_id)
+        session.commit()
+        unresolved = session.scalars(
+            select(database.SidResolution.sid).where(
+                database.SidResolution.resolved_at.is_(None)
+            )
+        ).all()
+
+        n_resolved = 0
+        for i in range(0, len(unresolved), chunk_size):
+            found = check_sid.existing_sids(unresolved[i : i + chunk_size])
+            if not found:
+                continue
+            session.execute(
+                update(database.SidResolution)
+                .where(database.SidResolution.sid.in_(found))
+                .values(
+                    resolved_at=now,
+                    resolved_refresh_generation=refresh_generation,
+                )
+            )
+            session.commit()
+            n_resolved += len(found)
+
+        total_not_found, total_resolved = session.execute(
+            select(
+                func.count(),
+                func.count(database.SidResolution.resolved_at),
+            )
+        ).one()
+        session.add(
+            database.SidReconciliationRun(
+                run_timestamp=now,
+                refresh_generation=refresh_generation,
+                last_checking_sids_row_id=last_row_id,
+                n_checked=len(unresolved),
+                n_resolved=n_resolved,
+                total_not_found=total_not_found,
+                total_resolved=total_resolved,
+            )
+        )
+        session.commit()
+
+    logger.info(
+        f"Resolved {n_resolved} of {len(unresolved)} unresolved SIDs in "
+        f"{time.perf_counter() - start_time:.1f}s. In total {total_resolved} of "
+        f"{total_not_found} not found SIDs appeared later, "
+        f"{total_not_found - total_resolved} are still missing"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument(
+        "--interval-seconds",
+        type=int,
+        default=None,
+        help="Keep checking for new refresh generations with this interval",
+    )
+    args = parser.parse_args()
+
+    while True:
+        generation = check_sid.current_refresh_generation()
+        last_run = _last_run()
+        # Generation 0 means the refresh generation is not known, so every
+        # run reconciles.
+        if (
+            last_run is None
+            or generation == 0
+            or last_run.refresh_generation != generation
+        ):
+            try:
+                reconcile(generation, args.chunk_size)
+            except sqlalchemy.exc.DBAPIError:
+                if args.interval_seconds is None:
+                    raise
+                logger.exception(
+                    "Reconciliation failed, retrying on the next interval"
+                )
+        else:
+            logger.info(f"Already reconciled refresh generation {generation}")
+
+        if args.interval_seconds is None:
+            return
+        time.sleep(args.interval_seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""Incrementally refreshes sid_to_store_decode from moscow_blockchain_txs.
+
+Each run only reads transactions with Timestamp above the watermark of the
+previous run, minus --overlap-seconds to pick up transactions that were
+ingested late. Ballots are upserted and decodes are merged into existing rows
+in bulk, so the cost of a run depends on the number of new transactions, not
+on the size of the tables. The Grafana rollups in vote_rollups.py are
+updated in the same transaction. Every run records a new refresh generation,
+which the bot uses to invalidate its caches.
+
+    python refresh_sid_to_store_decode.py --interval-seconds 300
+
+The watermark is the event Timestamp of the transactions, because the ingest
+schema has no ingestion order. This assumes dumps are loaded roughly in the
+order of their transactions: a dump loaded late, with transactions older than
+the watermark minus --overlap-seconds, is not picked up by the incremental
+runs. After loading such a dump, re-read it once with --since-timestamp set to
+its first Timestamp, or rebuild everything with --full:
+
+    python refresh_sid_to_store_decode.py --since-timestamp 1710460800
+
+Needs these tables and index in addition to the ingest schema:
+
+CREATE TABLE sid_to_store_decode_refresh (
+    Generation BIGSERIAL PRIMARY KEY,
+    Watermark BIGINT NOT NULL,
+    RefreshedAt TIMESTAMP WITH TIME ZONE NOT NULL,
+    NBallots BIGINT NOT NULL,
+    NDecodeBallots BIGINT NOT NULL
+);
+
+CREATE INDEX moscow_blockchain_txs_timestamp ON moscow_blockchain_txs (Timestamp);
+
+sid_to_store_decode is partitioned by the election, so the index of every
+election stays the size of that election and lookups of the active election
+only touch its partition (see MOSCOW_VOTING_IDS in config.py):
+
+CREATE TABLE sid_to_store_decode (
+    voting_id TEXT NOT NULL,
+    sid TEXT NOT NULL,
+    storageballot JSONB,
+    storagedecodeballot JSONB,
+    PRIMARY KEY (sid, voting_id)
+) PARTITION BY LIST (voting_id);
+
+sid comes first in the key, so lookups by sid alone, without
+MOSCOW_VOTING_IDS, still use the index of every partition. Every run creates
+the partitions of the elections it sees for the first time, named by
+partition_name(). Creating a partition needs the owner of
+sid_to_store_decode. Transactions without a VotingId are not refreshed. A
+table created before the partitioning is migrated by
+migrate_sid_to_store_decode_partitions.py.
+
+GRANT CREATE ON SCHEMA public TO check_sid_moscow_ingest;
+ALTER TABLE sid_to_store_decode OWNER TO check_sid_moscow_ingest;
+GRANT INSERT, SELECT ON sid_to_store_decode_refresh TO check_sid_moscow_ingest;
+GRANT USAGE ON SEQUENCE sid_to_store_decode_refresh_generation_seq TO check_sid_moscow_ingest;
+"""
+
+import argparse
+import datetime
+import hashlib
+import logging
+import time
+
+import sqlalchemy
+from sqlalchemy import create_engine, text
+
+import config
+import vote_rollups
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+
+_LAST_WATERMARK = text(
+    "SELECT Watermark FROM sid_to_store_decode_refresh "
+    "ORDER BY Generation DESC LIMIT 1"
+)
+
+_MAX_TIMESTAMP = text("SELECT MAX(Timestamp) FROM moscow_blockchain_txs")
+
+# Partitions are created with a single VotingId each, so their bound is
+# compared as text.
+_VOTING_IDS_WITHOUT_PARTITION = text(
+    """
+SELECT DISTINCT t.VotingId FROM moscow_blockchain_txs AS t
+WHERE t.Timestamp > :since AND t.Timestamp <= :until
+    AND t.StorageBallot IS NOT NULL AND t.Sid IS NOT NULL AND t.VotingId IS NOT NULL
+    AND NOT EXISTS (
+        SELECT 1 FROM pg_inherits AS i
+        JOIN pg_class AS c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'sid_to_store_decode'::regclass
+            AND pg_get_expr(c.relpartbound, c.oid)
+                = 'FOR VALUES IN (' || quote_literal(t.VotingId) || ')'
+    )
+"""
+)
+
+_UPSERT_BALLOTS = text(
+    """
+INSERT INTO sid_to_store_decode (voting_id, sid, storageballot, storagedecodeballot)
+SELECT DISTINCT ON (VotingId, Sid) VotingId, Sid, StorageBallot, NULL
+FROM moscow_blockchain_txs
+WHERE Timestamp > :since AND Timestamp <= :until
+    AND StorageBallot IS NOT NULL AND Sid IS NOT NULL AND VotingId IS NOT NULL
+ORDER BY VotingId, Sid, Timestamp
+ON CONFLICT (voting_id, sid) DO UPDATE SET storageballot = EXCLUDED.storageballot
+WHERE sid_to_store_decode.storageballot IS DISTINCT FROM EXCLUDED.storageballot
+"""
+)
+
+# Decodes are only merged into rows that already have a ballot: the bot
+# cannot show a decode without the ballot. Ballots are always older than
+# their decodes, so they are inserted by this or an earlier run.
+_MERGE_DECODE_BALLOTS = text(
+    """
+UPDATE sid_to_store_decode AS t
+SET storagedecodeballot = new.StorageDecodeBallot
+FROM (
+    SELECT DISTINCT ON (VotingId, Sid) VotingId, Sid, StorageDecodeBallot
+    FROM moscow_blockchain_txs
+    WHERE Timestamp > :since AND Timestamp <= :until
+        AND StorageDecodeBallot IS NOT NULL AND Sid IS NOT NULL
+        AND VotingId IS NOT NULL
+    ORDER BY VotingId, Sid, Timestamp DESC
+) AS new
+WHERE t.voting_id = new.VotingId AND t.sid = new.Sid
+    AND t.storagedecodeballot IS DISTINCT FROM new.StorageDecodeBallot
+"""
+)
+
+_RECORD_REFRESH = text(
+    """
+INSERT INTO sid_to_store_decode_refresh
+    (Watermark, RefreshedAt, NBallots, NDecodeBallots)
+VALUES (:watermark, :refreshed_at, :n_ballots, :n_decode_ballots)
+RETURNING Generation
+"""
+)
+
+
+def partition_name(voting_id: str) -> str:
+    """Name of the sid_to_store_decode partition of an election."""
+    # VotingIds are too long for identifiers and may contain any character.
+    return f"sid_to_store_decode_{hashlib.md5(voting_id.encode()).hexdigest()[:16]}"
+
+
+def create_partition(
+    connection: sqlalchemy.Connection, voting_id: str, table: str
+) -> None:
+    partition = partition_name(voting_id)
+    logger.info(f"Creating partition {partition} for VotingId {voting_id}")
+    # psycopg2 binds parameters on the client, so they work in DDL.
+    connection.execute(
+        text(
+            f"CREATE TABLE {partition} PARTITION OF {table} "
+            "FOR VALUES IN (:voting_id)"
+        ),
+        {"voting_id": voting_id},
+    )
+
+
+def refresh(
+    engine: sqlalchemy.Engine,
+    overlap_seconds: int,
+    full: bool,
+    since_timestamp: int | None = None,
+) -> None:
+    start_time = time.perf_counter()
+    with engine.begin() as connection:
+        last_watermark = None if full else connection.execute(_LAST_WATERMARK).scalar()
+        until = connection.execute(_MAX_TIMESTAMP).scalar()
+        if until is None:
+            logger.info("moscow_blockchain_txs is empty, nothing to refresh")
+            return
+
+        if since_timestamp is not None:
+            since = since_timestamp - 1
+        elif last_watermark is None:
+            since = -1
+        else:
+            since = last_watermark - overlap_seconds
+        logger.info(f"Refreshing transactions with {since} < Timestamp <= {until}")
+
+        params = {"since": since, "until": until}
+        for (voting_id,) in connection.execute(
+            _VOTING_IDS_WITHOUT_PARTITION, params
+        ).all():
+            create_partition(connection, voting_id, "sid_to_store_decode")
+        n_ballots = connection.execute(_UPSERT_BALLOTS, params).rowcount
+        n_decode_ballots = connection.execute(_MERGE_DECODE_BALLOTS, params).rowcount
+        vote_rollups.refresh_rollups(
+            connection, since, until, config.MOSCOW_ACTIVE_VOTING_ID
+        )
+
+        generation = connection.execute(
+            _RECORD_REFRESH,
+            {
+                "watermark": until,
+                "refreshed_at": datetime.datetime.now(datetime.timezone.utc),
+                "n_ballots": n_ballots,
+                "n_decode_ballots": n_decode_ballots,
+            },
+        ).scalar()
+
+    logger.info(
+        f"Refresh generation {generation}: {n_ballots} ballots and "
+        f"{n_decode_ballots} decodes changed, took "
+        f"{time.perf_counter() - start_time:.1f}s"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--database-url",
+        default=config.MOSCOW_SID_DATABASE_URL,
+        help="Defaults to MOSCOW_SID_DATABASE_URL",
+    )
+    parser.add_argument("--overlap-seconds", type=int, default=600)
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Ignore the watermark and re-read all transactions",
+    )
+    parser.add_argument(
+        "--since-timestamp",
+        type=int,
+        default=None,
+        help="Re-read transactions from this Timestamp on, e.g. of a late dump",
+    )
+    parser.add_argument(
+        "--interval-seconds",
+        type=int,
+        default=None,
+        help="Keep refreshing with this interval instead of running once",
+    )
+    args = parser.parse_args()
+
+    if not args.database_url:
+        parser.error("--database-url or MOSCOW_SID_DATABASE_URL must be set")
+    engine = create_engine(args.database_url, pool_pre_ping=True)
+
+    if args.full and args.since_timestamp is not None:
+        parser.error("--full and --since-timestamp are mutually exclusive")
+    refresh(engine, args.overlap_seconds, args.full, args.since_timestamp)
+    while args.interval_seconds is not None:
+        time.sleep(args.interval_seconds)
+        try:
+            refresh(engine, args.overlap_seconds, full=False)
+        except sqlalchemy.exc.DBAPIError:
+            logger.exception("Refresh failed, retrying on the next interval")
+
+
+if __name__ == "__main__":
+    main()
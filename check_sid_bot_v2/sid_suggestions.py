@@ -0,0 +1,135 @@
+import array
+import asyncio
+import bisect
+import logging
+import struct
+import time
+import uuid
+from collections.abc import Iterable
+
+from telegram.ext import ContextTypes
+
+import check_sid
+
+logger = logging.getLogger(__name__)
+
+# SIDs are indexed as 32 hex digits split into 4 segments of 8. An input
+# within edit distance 2 of a SID contains at least one of its segments
+# unchanged, shifted by at most 2 positions, so every candidate is found by
+# looking up all shifted segments of the input.
+_SID_HEX_LENGTH = 32
+_SEGMENT_LENGTH = 8
+_N_SEGMENTS = _SID_HEX_LENGTH // _SEGMENT_LENGTH
+_MAX_DISTANCE = 2
+_HEX_DIGITS = set("0123456789abcdef")
+
+
+def _bounded_edit_distance(a: str, b: str, bound: int) -> int | None:
+    """Levenshtein distance between a and b, None if it is above bound."""
+    if abs(len(a) - len(b)) > bound:
+        return None
+    previous = list(range(len(b) + 1))
+    for i, a_char in enumerate(a, start=1):
+        current = [i] + [0] * len(b)
+        for j, b_char in enumerate(b, start=1):
+            current[j] = min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (a_char != b_char),
+            )
+        if min(current) > bound:
+            return None
+        previous = current
+    return previous[-1] if previous[-1] <= bound else None
+
+
+class SidSuggestionIndex:
+    def __init__(self, sids: Iterable[str]):
+        # SIDs as 16 raw bytes each, 8 times smaller than a list of strings.
+        self._sids = bytearray()
+        for sid in sids:
+            try:
+                self._sids += uuid.UUID(sid).bytes
+            except ValueError:
+                logger.warning(f"Not indexing invalid SID {sid!r}")
+
+        # Every SID is 4 big-endian 32-bit segments. For every segment, a
+        # sorted array of (segment value << 32 | SID number).
+        segments = list(zip(*struct.iter_unpack(">IIII", self._sids)))
+        self._segments: list[array.array] = [
+            array.array("Q", sorted(x << 32 | i for i, x in enumerate(values)))
+            for values in segments
+        ] or [array.array("Q") for _ in range(_N_SEGMENTS)]
+
+    def __len__(self) -> int:
+        return len(self._sids) // 16
+
+    def _sid_hex(self, i: int) -> str:
+        return self._sids[i * 16 : (i + 1) * 16].hex()
+
+    def _candidates(self, query: str) -> set[int]:
+        candidates = set()
+        for segment, keys in enumerate(self._segments):
+            for shift in range(-_MAX_DISTANCE, _MAX_DISTANCE + 1):
+                start = segment * _SEGMENT_LENGTH + shift
+                part = query[start : start + _SEGMENT_LENGTH]
+                if start < 0 or len(part) != _SEGMENT_LENGTH:
+                    continue
+                low = int(part, 16) << 32
+                i = bisect.bisect_left(keys, low)
+                while i < len(keys) and keys[i] >> 32 == low >> 32:
+                    candidates.add(keys[i] & 0xFFFFFFFF)
+                    i += 1
+        return candidates
+
+    def suggest(self, sid: str, limit: int = 3) -> list[str]:
+        """Known SIDs within edit distance 2 of sid, closest first."""
+        query = sid.lower().replace("-", "")
+        if (
+            abs(len(query) - _SID_HEX_LENGTH) > _MAX_DISTANCE
+            or not set(query) <= _HEX_DIGITS
+        ):
+            return []
+
+        # A set, because a SID voted in several elections is indexed once for
+        # each of them.
+        suggestions = set()
+        for i in self._candidates(query):
+            candidate = self._sid_hex(i)
+            distance = _bounded_edit_distance(query, candidate, _MAX_DISTANCE)
+            if distance is not None and distance > 0:
+                suggestions.add((distance, str(uuid.UUID(candidate))))
+        return [x for _, x in sorted(suggestions)[:limit]]
+
+
+_index: SidSuggestionIndex | None = None
+_index_generation: int | None = None
+
+
+def suggest(sid: str) -> list[str]:
+    """Suggestions for a SID that was not found, empty until the index is built."""
+    if _index is None:
+        return []
+    return _index.suggest(sid)
+
+
+def _build_index() -> SidSuggestionIndex:
+    start_time = time.perf_counter()
+    index = SidSuggestionIndex(check_sid.all_sids())
+    logger.info(
+        f"Built SID suggestion index of {len(index)} SIDs in "
+        f"{time.perf_counter() - start_time:.1f}s"
+    )
+    return index
+
+
+async def refresh_index(context: ContextTypes.DEFAULT_TYPE) -> None:
+    del context
+    global _index, _index_generation
+    generation = check_sid.current_refresh_generation()
+    # Generation 0 means the refresh generation is not known, so the index is
+    # rebuilt every time.
+    if generation != 0 and generation == _index_generation:
+        return
+    _index = await asyncio.to_thread(_build_index)
+    _index_generation = generation
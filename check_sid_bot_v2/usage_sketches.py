@@ -0,0 +1,219 @@
+"""Distinct users and SIDs counted with HyperLogLog sketches.
+
+Counting distinct values in checking_sids and users needs a scan of the
+whole tables, and users must never be linked to SIDs. Instead every bot
+replica adds users and SIDs to separate sketches in memory and periodically
+writes them to usage_sketches, one row per sketch, period and replica.
+Sketches are merged by taking the maximum of every register, so the counts
+over all replicas are merged from these rows. With 2**14 registers a sketch
+is 16 KiB and counts are within about 1% of the exact ones. Rows of hourly
+sketches are deleted after USAGE_SKETCHES_RETENTION_DAYS.
+"""
+
+import asyncio
+import datetime
+import hashlib
+import logging
+import math
+import threading
+
+from sqlalchemy import delete, select
+from telegram.ext import ContextTypes
+
+import config
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_PRECISION = 14
+
+SIDS_CHECKED = "sids_checked"
+FOUND_SIDS = "found_sids"
+USERS = "users"
+
+# Period of the sketches that are not split by hour.
+_ALL_TIME = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class HyperLogLog:
+    def __init__(self, registers: bytes | None = None):
+        self.registers = bytearray(registers or bytes(2**_PRECISION))
+        if len(self.registers) != 2**_PRECISION:
+            raise ValueError(f"Expected {2**_PRECISION} registers")
+
+    def add(self, value: str | int) -> None:
+        x = int.from_bytes(
+            hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big"
+        )
+        index = x >> (64 - _PRECISION)
+        rest = x & ((1 << (64 - _PRECISION)) - 1)
+        # Position of the first 1 bit in the remaining 50 bits.
+        rank = 64 - _PRECISION - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog") -> None:
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0**-x for x in self.registers)
+        n_zeros = self.registers.count(0)
+        # Linear counting is more accurate for small cardinalities.
+        if estimate <= 2.5 * m and n_zeros:
+            estimate = m * math.log(m / n_zeros)
+        return round(estimate)
+
+
+# (name, period start) -> sketch of this replica
+_sketches: dict[tuple[str, datetime.datetime], HyperLogLog] = {}
+# SIDs are added from the threads that query them.
+_sketches_lock = threading.Lock()
+_restored = False
+
+
+def _current_hour() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc).replace(
+        minute=0, second=0, microsecond=0
+    )
+
+
+def _sketch(name: str, period_start: datetime.datetime) -> HyperLogLog:
+    key = (name, period_start)
+    if key not in _sketches:
+        _sketches[key] = HyperLogLog()
+    return _sketches[key]
+
+
+def add_user(user_id: int) -> None:
+    with _sketches_lock:
+        _sketch(USERS, _current_hour()).add(user_id)
+
+
+def add_checked_sid(sid: str, found: bool) -> None:
+    with _sketches_lock:
+        _sketch(SIDS_CHECKED, _ALL_TIME).add(sid)
+        if found:
+            _sketch(FOUND_SIDS, _ALL_TIME).add(sid)
+
+
+def _as_utc(x: datetime.datetime) -> datetime.datetime:
+    # SQLite returns naive datetimes.
+    if x.tzinfo is None:
+        return x.replace(tzinfo=datetime.timezone.utc)
+    return x
+
+
+def _restore() -> None:
+    """Merges what this replica wrote before a restart."""
+    current_hour = _current_hour()
+    with database.SessionLocal() as session:
+        rows = session.execute(
+            select(database.UsageSketch).where(
+                database.UsageSketch.replica_id == config.BOT_REPLICA_ID,
+                database.UsageSketch.period_start.in_([_ALL_TIME, current_hour]),
+            )
+        ).scalars()
+        for row in rows:
+            with _sketches_lock:
+                _sketch(row.name, _as_utc(row.period_start)).merge(
+                    HyperLogLog(row.registers)
+                )
+
+
+def _save() -> None:
+    insert = database.dialect_insert()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    with _sketches_lock:
+        rows = [
+            {
+                "name": name,
+                "period_start": period_start,
+                "replica_id": config.BOT_REPLICA_ID,
+                "registers": bytes(sketch.registers),
+                "updated_at": now,
+            }
+            for (name, period_start), sketch in _sketches.items()
+        ]
+    statement = insert(database.UsageSketch).values(rows)
+    statement = statement.on_conflict_do_update(
+        index_elements=["name", "period_start", "replica_id"],
+        set_={
+            "registers": statement.excluded.registers,
+            "updated_at": statement.excluded.updated_at,
+        },
+    )
+    with database.SessionLocal() as session:
+        with session.begin():
+            session.execute(statement)
+
+
+def _delete_expired(current_hour: datetime.datetime) -> None:
+    expires_before = current_hour - datetime.timedelta(
+        days=config.USAGE_SKETCHES_RETENTION_DAYS
+    )
+    with database.SessionLocal() as session:
+        with session.begin():
+            n_deleted = session.execute(
+                delete(database.UsageSketch).where(
+                    database.UsageSketch.period_start != _ALL_TIME,
+                    database.UsageSketch.period_start < expires_before,
+                )
+            ).rowcount
+    if n_deleted:
+        logger.info(f"Deleted {n_deleted} usage sketches before {expires_before}")
+
+
+def merged_counts(
+    periods: list[datetime.datetime],
+) -> dict[tuple[str, datetime.datetime], int]:
+    """Distinct counts over all replicas for the given periods."""
+    merged: dict[tuple[str, datetime.datetime], HyperLogLog] = {}
+    with database.SessionLocal() as session:
+        rows = session.execute(
+            select(database.UsageSketch).where(
+                database.UsageSketch.period_start.in_(periods)
+            )
+        ).scalars()
+        for row in rows:
+            key = (row.name, _as_utc(row.period_start))
+            merged.setdefault(key, HyperLogLog()).merge(HyperLogLog(row.registers))
+    return {key: sketch.count() for key, sketch in merged.items()}
+
+
+def _flush(
+    current_hour: datetime.datetime, previous_hour: datetime.datetime
+) -> dict[tuple[str, datetime.datetime], int]:
+    global _restored
+    if not _restored:
+        _restore()
+        _restored = True
+
+    if _sketches:
+        _save()
+    # Sketches of past hours are written and will not change anymore.
+    with _sketches_lock:
+        for name, period_start in list(_sketches):
+            if period_start != _ALL_TIME and period_start < current_hour:
+                del _sketches[name, period_start]
+
+    _delete_expired(current_hour)
+    return merged_counts([_ALL_TIME, current_hour, previous_hour])
+
+
+async def flush_sketches(context: ContextTypes.DEFAULT_TYPE) -> None:
+    del context
+    current_hour = _current_hour()
+    previous_hour = current_hour - datetime.timedelta(hours=1)
+    # Database queries run in a thread, so updates are processed meanwhile.
+    counts = await asyncio.to_thread(_flush, current_hour, previous_hour)
+    metrics.DISTINCT_SIDS_CHECKED.set(counts.get((SIDS_CHECKED, _ALL_TIME), 0))
+    metrics.DISTINCT_FOUND_SIDS.set(counts.get((FOUND_SIDS, _ALL_TIME), 0))
+    metrics.DISTINCT_USERS_PER_HOUR.labels(hour="current").set(
+        counts.get((USERS, current_hour), 0)
+    )
+    metrics.DISTINCT_USERS_PER_HOUR.labels(hour="previous").set(
+        counts.get((USERS, previous_hour), 0)
+    )
@@ -0,0 +1,81 @@
+import logging
+import sys
+import time
+from typing import Any
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+import config
+import metrics
+import usage_sketches
+
+logger = logging.getLogger(__name__)
+
+# user_id -> time.monotonic() of the last update we got from this user
+_last_seen: dict[int, float] = {}
+
+
+async def track_user_activity(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+) -> None:
+    del context
+    if update.effective_user is None:
+        return
+    _last_seen[update.effective_user.id] = time.monotonic()
+    usage_sketches.add_user(update.effective_user.id)
+
+
+def approximate_size(value: Any) -> int:
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(
+            approximate_size(k) + approximate_size(v) for k, v in value.items()
+        )
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(approximate_size(x) for x in value)
+    return size
+
+
+async def sweep_user_data(context: ContextTypes.DEFAULT_TYPE) -> None:
+    application = context.application
+    idle_deadline = time.monotonic() - config.CONVERSATION_TIMEOUT_SECONDS
+
+    for user_id, last_seen in list(_last_seen.items()):
+        if last_seen < idle_deadline:
+            del _last_seen[user_id]
+
+    n_idle = 0
+    n_oversized = 0
+    total_bytes = 0
+    for user_id, user_data in list(application.user_data.items()):
+        # Every update goes through track_user_activity first, so data of a
+        # user that is not in _last_seen belongs to an expired conversation.
+        if user_id not in _last_seen:
+            application.drop_user_data(user_id)
+            n_idle += 1
+            continue
+
+        user_data_size = approximate_size(user_data)
+        if user_data_size > config.MAX_USER_DATA_BYTES:
+            logger.warning(
+                f"user_data of {user_id} is {user_data_size} bytes, "
+                f"more than {config.MAX_USER_DATA_BYTES}. Clearing it."
+            )
+            user_data.clear()
+            n_oversized += 1
+            user_data_size = approximate_size(user_data)
+        total_bytes += user_data_size
+
+    metrics.USER_DATA_EVICTIONS.labels(reason="idle").inc(n_idle)
+    metrics.USER_DATA_EVICTIONS.labels(reason="oversized").inc(n_oversized)
+    metrics.USER_DATA_ENTRIES.set(len(application.user_data))
+    metrics.USER_DATA_APPROX_BYTES.set(total_bytes)
+    metrics.TRACKED_USERS.set(len(_last_seen))
+
+    logger.info(
+        f"Swept user_data: dropped {n_idle} idle and cleared {n_oversized} "
+        f"oversized entries, {len(application.user_data)} entries left "
+        f"(~{total_bytes} bytes)"
+    )
@@ -0,0 +1,267 @@
+"""Public HTTP API to verify SIDs against the Moscow database.
+
+    GET  /v1/sid/<sid>    one SID, as JSON
+    POST /v1/sids         {"sids": [...]} with up to --max-batch-size SIDs,
+                          answered as newline-delimited JSON, one line per SID
+                          in request order, streamed as chunks are looked up
+
+Every result has `sid`, `status` ("found", "not_found" or "invalid") and, when
+found, `result` in the format of SidQueryResult.to_json(). Results are cached
+in memory until the next refresh generation of sid_to_store_decode, and every
+client IP is limited to --rate-limit SIDs per second with bursts of
+--rate-limit-burst.
+
+    python verification_api.py --port 8081
+
+Any database with a sid_to_store_decode table works, e.g. a local SQLite
+fixture: MOSCOW_SID_DATABASE_URL=sqlite:///fixture.db. Needs the packages from
+requirements-api.txt.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import time
+from collections.abc import Callable
+from typing import Any
+
+from aiohttp import web
+
+import check_sid
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+
+_LOOKUP_CHUNK_SIZE = 100
+
+QuerySids = Callable[[list[str]], dict[str, check_sid.SidQueryResult]]
+
+
+class _ResultCache:
+    """LRU of sid -> result, only valid for one refresh generation."""
+
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        self._generation: int | None = None
+        self._results: collections.OrderedDict[str, dict[str, Any]] = (
+            collections.OrderedDict()
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def set_generation(self, generation: int) -> None:
+        if generation != self._generation:
+            self._generation = generation
+            self._results.clear()
+
+    def get(self, sid: str) -> dict[str, Any] | None:
+        result = self._results.get(sid)
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._results.move_to_end(sid)
+        return result
+
+    def put(self, sid: str, result: dict[str, Any]) -> None:
+        self._results[sid] = result
+        self._results.move_to_end(sid)
+        if len(self._results) > self._max_size:
+            self._results.popitem(last=False)
+
+
+class _TokenBuckets:
+    def __init__(self, rate: float, burst: float, max_clients: int = 100000):
+        self._rate = rate
+        self._burst = burst
+        self._max_clients = max_clients
+        # client -> (tokens, time.monotonic() of the last update)
+        self._buckets: collections.OrderedDict[str, tuple[float, float]] = (
+            collections.OrderedDict()
+        )
+
+    def take(self, client: str, cost: float) -> float:
+        """Takes cost tokens, returns 0 or seconds to wait before retrying."""
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.pop(client, (self._burst, now))
+        tokens = min(self._burst, tokens + (now - updated_at) * self._rate)
+        if tokens >= cost:
+            tokens -= cost
+            wait_seconds = 0.0
+        else:
+            wait_seconds = (cost - tokens) / self._rate
+        self._buckets[client] = (tokens, now)
+        # Clients that were idle for longest are forgotten first, they would
+        # have a full bucket anyway.
+        if len(self._buckets) > self._max_clients:
+            self._buckets.popitem(last=False)
+        return wait_seconds
+
+
+def _result_json(sid: str, sid_data: check_sid.SidQueryResult | None) -> dict:
+    if sid_data is None:
+        return {"sid": sid, "status": "not_found"}
+    return {"sid": sid, "status": "found", "result": sid_data.to_json()}
+
+
+class VerificationApi:
+    def __init__(
+        self,
+        *,
+        query_sids: QuerySids,
+        current_generation: Callable[[], int],
+        cache_size: int,
+        rate_limit: float,
+        rate_limit_burst: float,
+        max_batch_size: int,
+        trust_forwarded_for: bool,
+    ):
+        self._query_sids = query_sids
+        self._current_generation = current_generation
+        self._cache = _ResultCache(cache_size)
+        self._rate_limits = _TokenBuckets(rate_limit, rate_limit_burst)
+        self._max_batch_size = max_batch_size
+        self._trust_forwarded_for = trust_forwarded_for
+
+    def _client(self, request: web.Request) -> str:
+        forwarded_for = request.headers.get("X-Forwarded-For")
+        if self._trust_forwarded_for and forwarded_for:
+            return forwarded_for.split(",")[0].strip()
+        return request.remote or ""
+
+    def _check_rate_limit(self, request: web.Request, cost: int) -> None:
+        wait_seconds = self._rate_limits.take(self._client(request), cost)
+        if wait_seconds > 0:
+            raise web.HTTPTooManyRequests(
+                headers={"Retry-After": str(int(wait_seconds) + 1)}
+            )
+
+    async def _lookup(self, messages: list[str]) -> list[dict[str, Any]]:
+        """Results for the SIDs in messages, from the cache or the database."""
+        self._cache.set_generation(
+            await asyncio.to_thread(self._current_generation)
+        )
+        # Not message_to_sid(), which logs every SID.
+        sids = [check_sid.parse_sid(x) for x in messages]
+        results: list[dict[str, Any] | None] = []
+        to_query = set()
+        for message, sid in zip(messages, sids):
+            if not check_sid.is_valid_sid(sid):
+                results.append({"sid": message, "status": "invalid"})
+                continue
+            result = self._cache.get(sid)
+            if result is None:
+                to_query.add(sid)
+            results.append(result)
+
+        queried: dict[str, dict[str, Any]] = {}
+        if to_query:
+            # SQLAlchemy is synchronous, so the query runs in a thread.
+            found = await asyncio.to_thread(self._query_sids, sorted(to_query))
+            for sid in to_query:
+                queried[sid] = _result_json(sid, found.get(sid))
+                self._cache.put(sid, queried[sid])
+        return [x if x is not None else queried[sid] for x, sid in zip(results, sids)]
+
+    async def get_sid(self, request: web.Request) -> web.Response:
+        self._check_rate_limit(request, 1)
+        (result,) = await self._lookup([request.match_info["sid"]])
+        status = 400 if result["status"] == "invalid" else 200
+        return web.json_response(
+            result, status=status, dumps=lambda x: json.dumps(x, ensure_ascii=False)
+        )
+
+    async def post_sids(self, request: web.Request) -> web.StreamResponse:
+        try:
+            body = await request.json()
+            messages = body["sids"]
+        except (ValueError, KeyError, TypeError):
+            raise web.HTTPBadRequest(text='Expected {"sids": [...]}')
+        if not isinstance(messages, list) or not all(
+            isinstance(x, str) for x in messages
+        ):
+            raise web.HTTPBadRequest(text='Expected {"sids": [...]}')
+        if len(messages) > self._max_batch_size:
+            raise web.HTTPRequestEntityTooLarge(
+                max_size=self._max_batch_size, actual_size=len(messages)
+            )
+        self._check_rate_limit(request, len(messages))
+
+        response = web.StreamResponse(
+            headers={"Content-Type": "application/x-ndjson; charset=utf-8"}
+        )
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        for i in range(0, len(messages), _LOOKUP_CHUNK_SIZE):
+            results = await self._lookup(messages[i : i + _LOOKUP_CHUNK_SIZE])
+            await response.write(
+                "".join(json.dumps(x, ensure_ascii=False) + "\n" for x in results)
+                .encode()
+            )
+        await response.write_eof()
+        return response
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        del request
+        return web.json_response(
+            {"cache_hits": self._cache.hits, "cache_misses": self._cache.misses}
+        )
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes(
+            [
+                web.get("/v1/sid/{sid}", self.get_sid),
+                web.post("/v1/sids", self.post_sids),
+                web.get("/v1/stats", self.get_stats),
+            ]
+        )
+        return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--cache-size", type=int, default=1000000)
+    parser.add_argument("--rate-limit", type=float, default=20)
+    parser.add_argument("--rate-limit-burst", type=float, default=1000)
+    parser.add_argument("--max-batch-size", type=int, default=1000)
+    parser.add_argument("--keepalive-timeout", type=float, default=75)
+    parser.add_argument(
+        "--trust-forwarded-for",
+        action="store_true",
+        help="Rate limit by X-Forwarded-For, only behind a reverse proxy",
+    )
+    args = parser.parse_args()
+    # A batch costs one token per SID, so a bigger one could never be served.
+    if args.max_batch_size > args.rate_limit_burst:
+        parser.error("--max-batch-size must not exceed --rate-limit-burst")
+
+    api = VerificationApi(
+        query_sids=check_sid.query_sids,
+        current_generation=check_sid.current_refresh_generation,
+        cache_size=args.cache_size,
+        rate_limit=args.rate_limit,
+        rate_limit_burst=args.rate_limit_burst,
+        max_batch_size=args.max_batch_size,
+        trust_forwarded_for=args.trust_forwarded_for,
+    )
+    web.run_app(
+        api.create_app(),
+        host=args.host,
+        port=args.port,
+        keepalive_timeout=args.keepalive_timeout,
+    )
+
+
+if __name__ == "__main__":
+    main()
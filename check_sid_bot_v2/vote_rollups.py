@@ -0,0 +1,135 @@
+"""Per-minute rollups of moscow_blockchain_txs for the Grafana dashboards.
+
+The dashboards used to aggregate the store_issue_ballot_by_time and
+time_to_candidate_minute_trunc views on every refresh. These tables have the
+same columns and are maintained by refresh_sid_to_store_decode.py in the same
+transaction as sid_to_store_decode: every minute bucket touched by the new
+transactions is recomputed from scratch, so the totals stay exact even when
+the overlap window re-reads transactions.
+
+Both tables only count the transactions and votes of the active election, the
+first of MOSCOW_VOTING_IDS, or of all elections if it is not set. After
+switching to a new election, empty them and rebuild them with
+`refresh_sid_to_store_decode.py --full`.
+
+CREATE TABLE ballot_tx_counts_by_minute (
+    tx_time TIMESTAMP WITH TIME ZONE NOT NULL,
+    tx_source TEXT NOT NULL,
+    tx_type TEXT NOT NULL,
+    transaction_cnt BIGINT NOT NULL,
+    PRIMARY KEY (tx_time, tx_source, tx_type)
+);
+
+CREATE TABLE candidate_votes_by_minute (
+    storage_timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+    source TEXT NOT NULL,
+    candidate_id INT NOT NULL,
+    cnt BIGINT NOT NULL,
+    PRIMARY KEY (storage_timestamp, source, candidate_id)
+);
+
+CREATE INDEX sid_to_store_decode_storage_timestamp
+    ON sid_to_store_decode (((storageballot->>'Timestamp')::BIGINT));
+
+GRANT INSERT, SELECT, DELETE ON ballot_tx_counts_by_minute TO check_sid_moscow_ingest;
+GRANT INSERT, SELECT, DELETE ON candidate_votes_by_minute TO check_sid_moscow_ingest;
+GRANT SELECT ON ballot_tx_counts_by_minute, candidate_votes_by_minute TO grafana;
+"""
+
+import logging
+
+import sqlalchemy
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# tx_source keeps the JSON quotes ('"DEG"'), as in store_issue_ballot_by_time.
+_RECOMPUTE_BALLOT_TX_COUNTS = [
+    text(
+        """
+DELETE FROM ballot_tx_counts_by_minute
+WHERE tx_time >= to_timestamp((:since + 1) / 60 * 60)
+    AND tx_time <= to_timestamp(:until)
+"""
+    ),
+    text(
+        """
+INSERT INTO ballot_tx_counts_by_minute (tx_time, tx_source, tx_type, transaction_cnt)
+SELECT
+    to_timestamp(Timestamp / 60 * 60),
+    COALESCE(IssueBallot->'Source', StorageBallot->'Source')::TEXT,
+    Type,
+    COUNT(*)
+FROM moscow_blockchain_txs
+WHERE Timestamp >= (:since + 1) / 60 * 60 AND Timestamp <= :until
+    AND Type IN ('issueBallot', 'storeBallot')
+    AND (CAST(:voting_id AS TEXT) IS NULL OR VotingId = :voting_id)
+GROUP BY 1, 2, 3
+HAVING COALESCE(IssueBallot->'Source', StorageBallot->'Source') IS NOT NULL
+"""
+    ),
+]
+
+# Votes are bucketed by the time the ballot was stored, but arrive with the
+# decode transaction, so the affected buckets are looked up through the decoded
+# SIDs.
+_RECOMPUTE_CANDIDATE_VOTES = [
+    text(
+        """
+CREATE TEMPORARY TABLE affected_storage_minutes ON COMMIT DROP AS
+SELECT DISTINCT (s.storageballot->>'Timestamp')::BIGINT / 60 * 60 AS minute
+FROM moscow_blockchain_txs AS t
+JOIN sid_to_store_decode AS s ON s.voting_id = t.VotingId AND s.sid = t.Sid
+WHERE t.Timestamp > :since AND t.Timestamp <= :until
+    AND t.StorageDecodeBallot IS NOT NULL
+    AND (CAST(:voting_id AS TEXT) IS NULL OR t.VotingId = :voting_id)
+"""
+    ),
+    text(
+        """
+DELETE FROM candidate_votes_by_minute
+WHERE storage_timestamp IN (
+    SELECT to_timestamp(minute) FROM affected_storage_minutes
+)
+"""
+    ),
+    text(
+        """
+INSERT INTO candidate_votes_by_minute (storage_timestamp, source, candidate_id, cnt)
+SELECT
+    to_timestamp(a.minute),
+    s.storageballot->>'Source',
+    c.candidate_id::INT,
+    COUNT(*)
+FROM affected_storage_minutes AS a
+JOIN sid_to_store_decode AS s
+    ON (s.storageballot->>'Timestamp')::BIGINT >= a.minute
+    AND (s.storageballot->>'Timestamp')::BIGINT < a.minute + 60
+CROSS JOIN LATERAL jsonb_array_elements_text(
+    s.storagedecodeballot->'DecryptedValue'
+) AS c(candidate_id)
+WHERE s.storagedecodeballot IS NOT NULL
+    AND (CAST(:voting_id AS TEXT) IS NULL OR s.voting_id = :voting_id)
+GROUP BY 1, 2, 3
+"""
+    ),
+]
+
+
+def refresh_rollups(
+    connection: sqlalchemy.Connection, since: int, until: int, voting_id: str | None
+) -> None:
+    """voting_id is the election of the rollups, None for all."""
+    params = {"since": since, "until": until, "voting_id": voting_id}
+    for statement in _RECOMPUTE_BALLOT_TX_COUNTS:
+        connection.execute(statement, params)
+    for statement in _RECOMPUTE_CANDIDATE_VOTES:
+        connection.execute(statement, params)
+
+    n_minutes = connection.execute(
+        text("SELECT COUNT(*) FROM affected_storage_minutes")
+    ).scalar()
+    logger.info(
+        f"Recomputed rollups for transactions after {since} "
+        f"and {n_minutes} storage minutes with new decodes"
+    )